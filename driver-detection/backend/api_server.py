@@ -2,20 +2,20 @@
 FastAPI server for driver state detection with WebSocket video streaming
 """
 import cv2
-import mediapipe as mp
 import numpy as np
 import asyncio
-import base64
 import json
-from fastapi import FastAPI, WebSocket, HTTPException
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, WebSocket, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 import uvicorn
 
-from driver_state_detection.attention_scorer import AttentionScorer as AttentionScorer
-from driver_state_detection.eye_detector import EyeDetector
-from driver_state_detection.pose_estimation import HeadPoseEstimator
-from driver_state_detection.utils import get_landmarks
+from driver_state_detection.utils import parse_resolution
+from sessions import DEFAULT_SESSION_ID, SessionLimitError, SessionManager
+from streaming import AdaptiveStreamer, MetricsDiffer, hello_message
 
 # Make sure the path includes the driver_state_detection directory
 import sys
@@ -33,80 +33,123 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global state
-detection_state = {
-    "is_running": False,
-    "camera": None,
-    "detector": None,
-    "eye_det": None,
-    "head_pose": None,
-    "scorer": None,
-    "fps": 0.0,
-    "ear": None,
-    "gaze": None,
-    "perclos": None,
-    "roll": None,
-    "pitch": None,
-    "yaw": None,
-    "tired": False,
-    "asleep": False,
-    "looking_away": False,
-    "distracted": False,
+# JPEG encoding runs on its own workers so that it never blocks the event loop
+ENCODE_WORKERS = 2
+encode_executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+
+# Execution layer health, reported by /api/status
+loop_stats = {
+    "lag_ms": 0.0,
+    "avg_lag_ms": 0.0,
+    "max_lag_ms": 0.0,
+}
+encode_stats = {
+    "pending": 0,
+    "frames": 0,
+    "busy_time": 0.0,
 }
+# guards the encode counters (global and per session) updated by the encode workers
+encode_stats_lock = threading.Lock()
+lag_monitor = None
+
+# Ids of the connected /ws/video clients
+_next_client_id = 0
+
+# MJPEG /api/video encoding settings
+MJPEG_QUALITY = 95
+
+# Maximum number of time buckets returned by /api/history
+MAX_HISTORY_BUCKETS = 10000
+
+# Maximum number of camera sessions running on this server (the default session included)
+MAX_SESSIONS = int(os.environ.get("DRIVER_DETECTION_MAX_SESSIONS", "4"))
+# Inference worker processes shared by the sessions, 0 runs the inference in the session threads
+INFERENCE_WORKERS = int(os.environ.get("DRIVER_DETECTION_INFERENCE_WORKERS", "0"))
+
+
+async def monitor_event_loop_lag(interval=0.1):
+    """Measure how late the event loop wakes up compared to the requested sleep"""
+    while True:
+        t_start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag_ms = max(0.0, (time.perf_counter() - t_start - interval) * 1000)
+        loop_stats["lag_ms"] = lag_ms
+        loop_stats["avg_lag_ms"] = 0.9 * loop_stats["avg_lag_ms"] + 0.1 * lag_ms
+        loop_stats["max_lag_ms"] = max(loop_stats["max_lag_ms"], lag_ms)
+
+
+def _encode_jpeg(frame, quality, scale, session_stats):
+    t_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    if scale != 1.0:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    busy_time = time.perf_counter() - t_start
+    cpu_time = time.thread_time() - cpu_start
+    with encode_stats_lock:
+        for stats in (encode_stats, session_stats):
+            stats["busy_time"] += busy_time
+            stats["frames"] += 1
+        session_stats["cpu_time"] += cpu_time
+    return buffer.tobytes()
+
+
+async def encode_jpeg(frame, quality=95, scale=1.0, session_stats=None):
+    """Encode the frame as JPEG on the encode workers, resized by scale"""
+    if session_stats is None:
+        session_stats = {"frames": 0, "busy_time": 0.0, "cpu_time": 0.0}
+    loop = asyncio.get_running_loop()
+    encode_stats["pending"] += 1
+    try:
+        return await loop.run_in_executor(
+            encode_executor, _encode_jpeg, frame, quality, scale, session_stats
+        )
+    finally:
+        encode_stats["pending"] -= 1
+
+
+# Camera sessions, each with its own pipeline and scorer state
+sessions = SessionManager(
+    encode=encode_jpeg, max_sessions=MAX_SESSIONS, inference_workers=INFERENCE_WORKERS
+)
 
 
-async def get_detection_state():
+def get_session(session_id):
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Unknown session {session_id}")
+    return session
+
+
+def get_pipeline_stats(session):
+    """Get event loop lag, per-stage queue depth, CPU usage and clients of the session"""
+    stats = session.pipeline_stats()
+    stats["stages"]["encode"].update(
+        queue_depth=encode_stats["pending"], workers=ENCODE_WORKERS
+    )
+    stats["event_loop"] = {key: round(value, 3) for key, value in loop_stats.items()}
+    return stats
+
+
+async def get_detection_state(session):
     """Get current detection metrics"""
     # Return only serializable data
-    return {
-        "is_running": detection_state.get("is_running", False),
-        "fps": detection_state.get("fps", 0),
-        "ear": detection_state.get("ear"),
-        "gaze": detection_state.get("gaze"),
-        "perclos": detection_state.get("perclos", 0),
-        "roll": detection_state.get("roll"),
-        "pitch": detection_state.get("pitch"),
-        "yaw": detection_state.get("yaw"),
-        "tired": detection_state.get("tired", False),
-        "asleep": detection_state.get("asleep", False),
-        "looking_away": detection_state.get("looking_away", False),
-        "distracted": detection_state.get("distracted", False),
-        "proc_time": detection_state.get("proc_time"),
-    }
+    return session.status()
 
 
 @app.on_event("startup")
 async def startup():
-    """Initialize MediaPipe detector"""
-    detection_state["detector"] = mp.solutions.face_mesh.FaceMesh(
-        static_image_mode=False,
-        min_detection_confidence=0.5,
-        min_tracking_confidence=0.5,
-        refine_landmarks=True,
-    )
-    detection_state["eye_det"] = EyeDetector(show_processing=False)
-    detection_state["head_pose"] = HeadPoseEstimator(show_axis=False)
-    
-    import time
-    detection_state["scorer"] = AttentionScorer(
-        t_now=time.perf_counter(),
-        ear_thresh=0.2,
-        gaze_thresh=0.3,
-        ear_time_thresh=2.0,
-        gaze_time_thresh=2.0,
-        roll_thresh=15,
-        pitch_thresh=15,
-        yaw_thresh=15,
-        pose_time_thresh=2.0,
-        verbose=False,
-    )
+    """Initialize the default session (MediaPipe detector and estimators)"""
+    global lag_monitor
+    sessions.get_or_create(DEFAULT_SESSION_ID, source=0)
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
 
 
 @app.on_event("shutdown")
 async def shutdown():
     """Clean up resources"""
-    if detection_state["camera"]:
-        detection_state["camera"].release()
+    sessions.close()
+    encode_executor.shutdown(wait=False)
     cv2.destroyAllWindows()
 
 
@@ -116,272 +159,340 @@ async def root():
     return {"message": "Driver State Detection API", "version": "1.0.0"}
 
 
-@app.get("/api/status")
-async def get_status():
-    """Get current detection status"""
-    return await get_detection_state()
+async def session_status(session):
+    status = await get_detection_state(session)
+    status["pipeline"] = get_pipeline_stats(session)
+    return status
 
 
-@app.post("/api/start")
-async def start_detection():
-    """Start camera and detection"""
+def parse_resolutions(capture_size, inference_size, display_size):
+    """Capture, inference and display WIDTHxHEIGHT query parameters as (width, height) tuples, 400 if invalid"""
+    resolutions = {}
+    for name, value in (
+        ("capture_size", capture_size),
+        ("inference_size", inference_size),
+        ("display_size", display_size),
+    ):
+        try:
+            resolutions[name] = parse_resolution(value) if value else None
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"{name}: {e}")
+    return resolutions
+
+
+async def start_session(session, detect_interval, source=None, resolutions=None):
     try:
-        if detection_state["is_running"]:
+        if session.is_running:
             return {"message": "Detection already running"}
-        
-        # Open camera
-        detection_state["camera"] = cv2.VideoCapture(0)
-        if not detection_state["camera"].isOpened():
+
+        # two sessions cannot read the same camera
+        requested_source = session.source if source is None else source
+        for other in sessions.running():
+            if other is not session and str(other.source) == str(requested_source):
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Source {requested_source} is used by session {other.id}",
+                )
+
+        # Start capture and inference on their worker threads, results are published on the event loop
+        if not session.start(
+            asyncio.get_running_loop(), detect_interval, source, **(resolutions or {})
+        ):
             raise HTTPException(status_code=500, detail="Cannot open camera")
-        
-        detection_state["is_running"] = True
-        
-        # Start detection loop in background
-        asyncio.create_task(process_frames())
-        
+
         return {"message": "Detection started", "status": "running"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def stop_session(session):
+    # joining the worker threads blocks, keep it off the event loop
+    await asyncio.get_running_loop().run_in_executor(None, session.stop)
+    session.clear()
+    return {"message": "Detection stopped", "status": "stopped"}
+
+
+def _json_values(values, digits):
+    """Rounded list of the values, None for NaN"""
+    values = np.asarray(values, dtype=np.float64)
+    out = np.round(values, digits).astype(object)
+    out[np.isnan(values)] = None
+    return out.tolist()
+
+
+def _history_response(history, t_from, t_to, resolution):
+    series = history.query(t_from, t_to, resolution)
+    response = {
+        "from": series["from"],
+        "to": series["to"],
+        "resolution": series["resolution"],
+        "t": _json_values(series["t"], 3),
+        "count": series["count"].tolist(),
+    }
+    for name in history.metrics:
+        response[name] = {
+            stat: _json_values(values, 4) for stat, values in series[name].items()
+        }
+    return response
+
+
+async def session_history(session, t_from, t_to, resolution):
+    # negative times are relative to now
+    now = time.time()
+    if t_from is not None and t_from < 0:
+        t_from += now
+    if t_to is not None and t_to < 0:
+        t_to += now
+    if resolution is not None:
+        if resolution <= 0:
+            raise HTTPException(status_code=400, detail="resolution must be positive")
+        # only the buckets with frames are returned: the recorded time range bounds their number
+        time_range = session.history.time_range()
+        if time_range is not None:
+            start = time_range[0] if t_from is None else max(t_from, time_range[0])
+            end = time_range[1] if t_to is None else min(t_to, time_range[1])
+            if (end - start) / resolution > MAX_HISTORY_BUCKETS:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"More than {MAX_HISTORY_BUCKETS} buckets, use a coarser resolution",
+                )
+    # downsampling an hour of frames takes a few milliseconds: keep it off the event loop
+    return await asyncio.get_running_loop().run_in_executor(
+        None, _history_response, session.history, t_from, t_to, resolution
+    )
+
+
+@app.get("/api/status")
+async def get_status():
+    """Get current detection status of the default session"""
+    return await session_status(get_session(DEFAULT_SESSION_ID))
+
+
+@app.get("/api/history")
+async def get_history(
+    t_from: float = Query(None, alias="from"),
+    t_to: float = Query(None, alias="to"),
+    resolution: float = None,
+):
+    """
+    Downsampled metrics history of the default session
+
+    from and to are Unix times in seconds, negative values are relative to now (from=-3600 is the last hour),
+    default is the whole history. resolution is the bucket duration in seconds, default is 1/500 of the window.
+    Returns the start time and frame count of every non-empty bucket, and the min, max and mean of EAR, gaze,
+    PERCLOS, roll, pitch and yaw per bucket (null without a face)
+    """
+    return await session_history(get_session(DEFAULT_SESSION_ID), t_from, t_to, resolution)
+
+
+@app.post("/api/start")
+async def start_detection(
+    detect_interval: int = 1,
+    capture_size: str = None,
+    inference_size: str = None,
+    display_size: str = None,
+):
+    """
+    Start camera and detection of the default session
+
+    detect_interval > 1 runs the face mesh detector every detect_interval frames and tracks
+    the landmarks with optical flow in between
+
+    capture_size (requested from the camera), inference_size (frames given to FaceMesh) and display_size
+    (streamed frames) are WIDTHxHEIGHT resolutions, the last two are bounds that keep the aspect ratio
+    """
+    resolutions = parse_resolutions(capture_size, inference_size, display_size)
+    return await start_session(
+        get_session(DEFAULT_SESSION_ID), detect_interval, resolutions=resolutions
+    )
+
+
 @app.post("/api/stop")
 async def stop_detection():
-    """Stop camera and detection"""
-    detection_state["is_running"] = False
-    if detection_state["camera"]:
-        detection_state["camera"].release()
-        detection_state["camera"] = None
-    return {"message": "Detection stopped", "status": "stopped"}
+    """Stop camera and detection of the default session"""
+    return await stop_session(get_session(DEFAULT_SESSION_ID))
 
 
-async def process_frames():
-    """Process video frames in background"""
-    import time
-    
-    prev_time = time.perf_counter()
-    frame_count = 0
-    
-    while detection_state["is_running"]:
-        if not detection_state["camera"] or not detection_state["is_running"]:
-            break
-        
-        # Start the tick counter for computing the processing time for each frame
-        e1 = cv2.getTickCount()
-        
-        ret, frame = detection_state["camera"].read()
-        if not ret:
-            await asyncio.sleep(0.1)
-            continue
-        
-        # Flip frame for mirror effect
-        frame = cv2.flip(frame, 1)
-        
-        # Calculate FPS
-        t_now = time.perf_counter()
-        elapsed = t_now - prev_time
-        if elapsed > 0:
-            detection_state["fps"] = 1 / elapsed
-        prev_time = t_now
-        
-        # Convert BGR to RGB for MediaPipe
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = np.expand_dims(gray, axis=2)
-        gray = np.concatenate([gray, gray, gray], axis=2)
-        
-        # Detect faces
-        lms = detection_state["detector"].process(gray).multi_face_landmarks
-        
-        if lms:
-            landmarks = get_landmarks(lms)
-            frame_size = (frame.shape[1], frame.shape[0])
-            
-            # Draw eye keypoints (dots around the eyes)
-            detection_state["eye_det"].show_eye_keypoints(
-                color_frame=frame, landmarks=landmarks, frame_size=frame_size
-            )
-            
-            # Calculate EAR
-            ear = detection_state["eye_det"].get_EAR(landmarks=landmarks)
-            detection_state["ear"] = float(round(ear, 3)) if ear else None
-            
-            # Calculate PERCLOS
-            tired, perclos = detection_state["scorer"].get_rolling_PERCLOS(t_now, ear)
-            detection_state["tired"] = bool(tired)
-            detection_state["perclos"] = float(round(perclos, 3))
-            
-            # Calculate Gaze
-            gaze = detection_state["eye_det"].get_Gaze_Score(
-                frame=gray, landmarks=landmarks, frame_size=frame_size
-            )
-            detection_state["gaze"] = float(round(gaze, 3)) if gaze else None
-            
-            # Calculate Head Pose (returns frame with 3D axis drawn)
-            frame_det, roll, pitch, yaw = detection_state["head_pose"].get_pose(
-                frame=frame, landmarks=landmarks, frame_size=frame_size
-            )
-            # Use the frame with axis drawn if available
-            if frame_det is not None:
-                frame = frame_det
-            
-            detection_state["roll"] = float(roll[0]) if roll is not None and len(roll) > 0 else None
-            detection_state["pitch"] = float(pitch[0]) if pitch is not None and len(pitch) > 0 else None
-            detection_state["yaw"] = float(yaw[0]) if yaw is not None and len(yaw) > 0 else None
-            
-            # Evaluate scores
-            asleep, looking_away, distracted = detection_state["scorer"].eval_scores(
-                t_now=t_now,
-                ear_score=ear,
-                gaze_score=gaze,
-                head_roll=roll,
-                head_pitch=pitch,
-                head_yaw=yaw,
-            )
-            detection_state["asleep"] = bool(asleep)
-            detection_state["looking_away"] = bool(looking_away)
-            detection_state["distracted"] = bool(distracted)
-            
-            # Store processing time
-            e2 = cv2.getTickCount()
-            proc_time_frame_ms = ((e2 - e1) / cv2.getTickFrequency()) * 1000
-            detection_state["proc_time"] = proc_time_frame_ms
-        
-        frame_count += 1
-        await asyncio.sleep(0.033)  # ~30 FPS
+@app.get("/api/sessions")
+async def list_sessions():
+    """List the camera sessions"""
+    return dict(sessions.stats(), sessions=[session.info() for session in sessions])
 
 
-@app.websocket("/ws/video")
-async def websocket_video(websocket: WebSocket):
-    """WebSocket endpoint for video streaming"""
+@app.post("/api/sessions/{session_id}/start")
+async def start_session_detection(
+    session_id: str,
+    source: str = None,
+    detect_interval: int = 1,
+    capture_size: str = None,
+    inference_size: str = None,
+    display_size: str = None,
+):
+    """
+    Start camera and detection of a session, creating the session if needed
+
+    source is a camera index, a video file path or a stream URL (default: the session source, 0 for a new session),
+    the resolutions are the same as for /api/start
+    """
+    resolutions = parse_resolutions(capture_size, inference_size, display_size)
+    created = sessions.get(session_id) is None
+    try:
+        session = sessions.get_or_create(session_id, source=0 if source is None else source)
+    except SessionLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    try:
+        return await start_session(session, detect_interval, source, resolutions)
+    except HTTPException:
+        # do not keep a session that never started
+        if created:
+            sessions.remove(session_id)
+            session.close()
+        raise
+
+
+@app.post("/api/sessions/{session_id}/stop")
+async def stop_session_detection(session_id: str):
+    """Stop camera and detection of a session"""
+    return await stop_session(get_session(session_id))
+
+
+@app.get("/api/sessions/{session_id}/status")
+async def get_session_status(session_id: str):
+    """Get current detection status of a session"""
+    return await session_status(get_session(session_id))
+
+
+@app.get("/api/sessions/{session_id}/history")
+async def get_session_history(
+    session_id: str,
+    t_from: float = Query(None, alias="from"),
+    t_to: float = Query(None, alias="to"),
+    resolution: float = None,
+):
+    """Downsampled metrics history of a session, same as /api/history"""
+    return await session_history(get_session(session_id), t_from, t_to, resolution)
+
+
+@app.delete("/api/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """Stop a session and release its resources"""
+    if session_id == DEFAULT_SESSION_ID:
+        raise HTTPException(status_code=400, detail="The default session cannot be deleted")
+    session = get_session(session_id)
+    await stop_session(session)
+    sessions.remove(session_id)
+    session.close()
+    return {"message": f"Session {session_id} deleted"}
+
+
+async def stream_video(websocket, session, protocol):
+    """
+    Streams the frames and metrics of a session to a WebSocket client (see streaming.py for the protocols)
+
+    protocol=binary: JPEG frames as binary messages, metrics as separate messages when they change
+    protocol=json: legacy format, one JSON message per frame with the base64 JPEG and all the metrics
+
+    The JPEG quality, resolution and frame rate of every client adapt to how fast its frames are sent.
+    """
+    global _next_client_id
+
+    if session is None or protocol not in ("binary", "json"):
+        await websocket.close(code=1008)
+        return
     await websocket.accept()
-    import time as time_module
+
+    _next_client_id += 1
+    client_id = _next_client_id
+    streamer = AdaptiveStreamer()
+    session.clients[client_id] = streamer
     
     try:
-        while detection_state["is_running"]:
-            if not detection_state["camera"]:
-                await asyncio.sleep(0.1)
+        if protocol == "binary":
+            await websocket.send_text(hello_message())
+        metrics_differ = MetricsDiffer()
+
+        last_frame_id = None
+        while session.is_running:
+            # respect the frame rate of the client tier, then take the freshest frame
+            delay = streamer.wait_time(time.perf_counter())
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            result = await session.latest_frame.wait_next(last_frame_id)
+            if result is None:
                 continue
+            last_frame_id = result.frame_id
+            streamer.on_frame(result.frame_id)
+            tier = streamer.tier
             
-            # Start tick counter for processing time
-            e1 = cv2.getTickCount()
-            
-            ret, frame = detection_state["camera"].read()
-            if not ret:
-                break
-            
-            # Flip for mirror effect
-            frame = cv2.flip(frame, 1)
-            
-            # Process frame with detections
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            gray = np.expand_dims(gray, axis=2)
-            gray = np.concatenate([gray, gray, gray], axis=2)
-            
-            # Detect faces
-            lms = detection_state["detector"].process(gray).multi_face_landmarks
-            
-            if lms:
-                landmarks = get_landmarks(lms)
-                frame_size = (frame.shape[1], frame.shape[0])
-                
-                # Draw eye keypoints
-                detection_state["eye_det"].show_eye_keypoints(
-                    color_frame=frame, landmarks=landmarks, frame_size=frame_size
-                )
-                
-                # Get and draw head pose with 3D axis
-                frame_det, roll, pitch, yaw = detection_state["head_pose"].get_pose(
-                    frame=frame, landmarks=landmarks, frame_size=frame_size
-                )
-                if frame_det is not None:
-                    frame = frame_det
-            
-            # Get current metrics
-            metrics = await get_detection_state()
-            
-            # Draw overlays on frame
-            if metrics.get("ear") is not None:
-                cv2.putText(frame, f"EAR: {metrics['ear']:.3f}", (10, 50),
-                           cv2.FONT_HERSHEY_PLAIN, 2, (255, 255, 255), 1, cv2.LINE_AA)
-            
-            if metrics.get("gaze") is not None:
-                cv2.putText(frame, f"Gaze: {metrics['gaze']:.3f}", (10, 80),
-                           cv2.FONT_HERSHEY_PLAIN, 2, (255, 255, 255), 1, cv2.LINE_AA)
-            
-            cv2.putText(frame, f"PERCLOS: {metrics['perclos']:.3f}", (10, 110),
-                       cv2.FONT_HERSHEY_PLAIN, 2, (255, 255, 255), 1, cv2.LINE_AA)
-            
-            if metrics.get("roll") is not None:
-                cv2.putText(frame, f"Roll: {metrics['roll']:.1f}", (450, 40),
-                           cv2.FONT_HERSHEY_PLAIN, 1.5, (255, 0, 255), 1, cv2.LINE_AA)
-            
-            if metrics.get("pitch") is not None:
-                cv2.putText(frame, f"Pitch: {metrics['pitch']:.1f}", (450, 70),
-                           cv2.FONT_HERSHEY_PLAIN, 1.5, (255, 0, 255), 1, cv2.LINE_AA)
-            
-            if metrics.get("yaw") is not None:
-                cv2.putText(frame, f"Yaw: {metrics['yaw']:.1f}", (450, 100),
-                           cv2.FONT_HERSHEY_PLAIN, 1.5, (255, 0, 255), 1, cv2.LINE_AA)
-            
-            cv2.putText(frame, f"FPS: {metrics['fps']:.0f}", (10, 400),
-                       cv2.FONT_HERSHEY_PLAIN, 2, (255, 0, 255), 1)
-            
-            # Show processing time frame
-            if 'proc_time' in metrics and metrics['proc_time']:
-                cv2.putText(frame, f"PROC. TIME FRAME: {metrics['proc_time']:.0f}ms", (10, 430),
-                           cv2.FONT_HERSHEY_PLAIN, 2, (255, 0, 255), 1)
-            
-            # Alerts
-            if metrics.get("tired"):
-                cv2.putText(frame, "TIRED!", (10, 280),
-                           cv2.FONT_HERSHEY_PLAIN, 1, (0, 0, 255), 1, cv2.LINE_AA)
-            
-            if metrics.get("asleep"):
-                cv2.putText(frame, "ASLEEP!", (10, 300),
-                           cv2.FONT_HERSHEY_PLAIN, 1, (0, 0, 255), 1, cv2.LINE_AA)
-            
-            if metrics.get("looking_away"):
-                cv2.putText(frame, "LOOKING AWAY!", (10, 320),
-                           cv2.FONT_HERSHEY_PLAIN, 1, (0, 0, 255), 1, cv2.LINE_AA)
-            
-            if metrics.get("distracted"):
-                cv2.putText(frame, "DISTRACTED!", (10, 340),
-                           cv2.FONT_HERSHEY_PLAIN, 1, (0, 0, 255), 1, cv2.LINE_AA)
-            
-            # Encode frame as JPEG
-            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
-            frame_bytes = base64.b64encode(buffer).decode('utf-8')
-            
-            # Send frame with metrics
-            data = {
-                "image": f"data:image/jpeg;base64,{frame_bytes}",
-                "metrics": await get_detection_state()
-            }
-            
-            await websocket.send_json(data)
-            await asyncio.sleep(0.033)  # ~30 FPS
+            # Encode frame as JPEG, once for all the clients of the same tier
+            t_start = time.perf_counter()
+            encoded = await session.encoded_frames.get(result, tier.quality, tier.scale)
+            t_encoded = time.perf_counter()
+
+            if protocol == "json":
+                message = encoded.json_message(session.is_running)
+                await websocket.send_text(message)
+            else:
+                message = encoded.binary_message
+                await websocket.send_bytes(message)
+            t_sent = time.perf_counter()
+            streamer.on_sent(
+                len(message), result.timestamp, t_encoded - t_start, t_sent - t_encoded, t_sent
+            )
+
+            if protocol == "binary":
+                metrics_message = metrics_differ.message(result.frame_id, result.metrics, t_sent)
+                if metrics_message is not None:
+                    await websocket.send_text(metrics_message)
             
     except Exception as e:
         print(f"WebSocket error: {e}")
     finally:
+        session.clients.pop(client_id, None)
         await websocket.close()
 
 
-@app.get("/api/video")
-async def video_stream():
-    """HTTP video stream endpoint"""
+@app.websocket("/ws/video")
+async def websocket_video(websocket: WebSocket, protocol: str = "binary"):
+    """WebSocket endpoint for video streaming of the default session"""
+    await stream_video(websocket, sessions.get(DEFAULT_SESSION_ID), protocol)
+
+
+@app.websocket("/ws/sessions/{session_id}/video")
+async def websocket_session_video(websocket: WebSocket, session_id: str, protocol: str = "binary"):
+    """WebSocket endpoint for video streaming of a session"""
+    await stream_video(websocket, sessions.get(session_id), protocol)
+
+
+def mjpeg_response(session):
     async def generate():
-        while detection_state["is_running"]:
-            if detection_state["camera"]:
-                ret, frame = detection_state["camera"].read()
-                if ret:
-                    _, buffer = cv2.imencode('.jpg', cv2.flip(frame, 1))
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-            await asyncio.sleep(0.033)
+        last_frame_id = None
+        while session.is_running:
+            result = await session.latest_frame.wait_next(last_frame_id)
+            if result is None:
+                continue
+            last_frame_id = result.frame_id
+            encoded = await session.encoded_frames.get(result, MJPEG_QUALITY)
+            yield encoded.mjpeg_part
     
     return StreamingResponse(generate(), media_type="multipart/x-mixed-replace; boundary=frame")
 
 
+@app.get("/api/video")
+async def video_stream():
+    """HTTP video stream endpoint of the default session"""
+    return mjpeg_response(get_session(DEFAULT_SESSION_ID))
+
+
+@app.get("/api/sessions/{session_id}/video")
+async def session_video_stream(session_id: str):
+    """HTTP video stream endpoint of a session"""
+    return mjpeg_response(get_session(session_id))
+
+
 if __name__ == "__main__":
     uvicorn.run("api_server:app", host="0.0.0.0", port=8001, reload=True)
 
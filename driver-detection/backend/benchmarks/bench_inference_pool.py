@@ -0,0 +1,85 @@
+"""
+Throughput of several streams analyzed by threads of a single process vs. by an InferenceWorkerPool
+
+Every stream replays seeded synthetic landmarks (or FaceMesh when the mediapipe solutions API is available) on
+synthetic frames, and runs the whole FrameAnalyzer on each frame. The frames per second of all the streams
+together are reported for both executions, the process pool one should scale with the number of cores.
+
+Usage:
+    python benchmarks/bench_inference_pool.py --streams 4 --workers 4 --frames 200
+"""
+import argparse
+import os
+import threading
+import time
+
+from common import ReplayDetector, synthetic_frames, synthetic_landmarks
+from driver_state_detection.attention_scorer import AttentionScorer
+from driver_state_detection.eye_detector import EyeDetector
+from driver_state_detection.inference_pool import InferenceWorkerPool
+from driver_state_detection.pipeline import FrameAnalyzer
+from driver_state_detection.pose_estimation import HeadPoseEstimator
+
+FRAME_SIZE = (640, 480)
+
+
+def create_analyzer():
+    """Analyzer factory of the benchmark, also called in the worker processes"""
+    try:
+        import mediapipe as mp
+
+        detector = mp.solutions.face_mesh.FaceMesh(refine_landmarks=True)
+    except (ImportError, AttributeError):
+        detector = ReplayDetector(synthetic_landmarks(100, frame_size=FRAME_SIZE))
+    return FrameAnalyzer(
+        detector=detector,
+        eye_det=EyeDetector(),
+        head_pose=HeadPoseEstimator(),
+        scorer=AttentionScorer(t_now=0.0, ear_thresh=0.2, gaze_thresh=0.3),
+    )
+
+
+def run_streams(analyzers, frames, n_frames):
+    """Runs one thread per analyzer over n_frames frames, returns the total frames per second"""
+
+    def run(analyzer):
+        for i in range(n_frames):
+            frame = frames[i % len(frames)].copy()
+            analyzer.analyze(frame, i / 30)
+
+    threads = [threading.Thread(target=run, args=(analyzer,)) for analyzer in analyzers]
+    t_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(analyzers) * n_frames / (time.perf_counter() - t_start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="InferenceWorkerPool throughput benchmark")
+    parser.add_argument("--streams", type=int, default=4, help="Number of concurrent streams")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--frames", type=int, default=200, help="Frames per stream")
+    args = parser.parse_args()
+
+    frames = synthetic_frames(30, frame_size=FRAME_SIZE)
+
+    threads_fps = run_streams(
+        [create_analyzer() for _ in range(args.streams)], frames, args.frames
+    )
+
+    with InferenceWorkerPool(create_analyzer, n_workers=args.workers) as pool:
+        analyzers = [pool.attach() for _ in range(args.streams)]
+        # warm up the workers: the first frame creates the analyzers
+        for analyzer in analyzers:
+            analyzer.analyze(frames[0].copy(), 0.0)
+        pool_fps = run_streams(analyzers, frames, args.frames)
+
+    print(f"cpus: {os.cpu_count()}, streams: {args.streams}, workers: {args.workers}")
+    print(f"{'threads (1 process)':<22}{threads_fps:>10.1f} fps")
+    print(f"{'worker processes':<22}{pool_fps:>10.1f} fps ({pool_fps / threads_fps:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of the face mesh landmarks extraction (utils.get_landmarks)
+
+Compares the per-frame cost of the previous implementation (one numpy array per landmark point and masked
+clipping) with the vectorized one, on face mesh results with 1 to 3 faces of 478 landmarks.
+
+Usage:
+    python benchmarks/bench_landmarks.py [--repeat 2000]
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from common import N_LANDMARKS, to_face_mesh_face
+from driver_state_detection.utils import get_landmarks
+
+
+def get_landmarks_reference(lms):
+    """Previous implementation of utils.get_landmarks, kept as the benchmark baseline"""
+    surface = 0
+    for lms0 in lms:
+        landmarks = [np.array([point.x, point.y, point.z]) for point in lms0.landmark]
+
+        landmarks = np.array(landmarks)
+
+        landmarks[landmarks[:, 0] < 0.0, 0] = 0.0
+        landmarks[landmarks[:, 0] > 1.0, 0] = 1.0
+        landmarks[landmarks[:, 1] < 0.0, 1] = 0.0
+        landmarks[landmarks[:, 1] > 1.0, 1] = 1.0
+
+        dx = landmarks[:, 0].max() - landmarks[:, 0].min()
+        dy = landmarks[:, 1].max() - landmarks[:, 1].min()
+        new_surface = dx * dy
+        if new_surface > surface:
+            surface = new_surface
+            biggest_face = landmarks
+
+    return biggest_face
+
+
+def make_face_mesh_result(n_faces, seed=0):
+    """
+    Builds a multi_face_landmarks list with random landmarks, using the mediapipe protobuf messages
+    when they are available
+    """
+    rng = np.random.default_rng(seed)
+    faces = []
+    for n in range(n_faces):
+        center = rng.uniform(0.3, 0.7, size=2)
+        points = np.empty((N_LANDMARKS, 3))
+        points[:, :2] = center + rng.normal(scale=0.05 * (n + 1), size=(N_LANDMARKS, 2))
+        points[:, 2] = rng.normal(scale=0.02, size=N_LANDMARKS)
+        faces.append(points)
+
+    return [to_face_mesh_face(points) for points in faces]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="get_landmarks micro-benchmark")
+    parser.add_argument("--repeat", type=int, default=2000, help="calls per measure")
+    args = parser.parse_args()
+
+    print(f"{'faces':>5} {'before (us)':>12} {'after (us)':>12} {'speedup':>8}")
+    for n_faces in (1, 2, 3):
+        lms = make_face_mesh_result(n_faces)
+
+        assert np.allclose(
+            get_landmarks_reference(lms), get_landmarks(lms), atol=1e-6
+        ), "vectorized get_landmarks differs from the reference implementation"
+
+        before = min(
+            timeit.repeat(lambda: get_landmarks_reference(lms), number=args.repeat, repeat=3)
+        )
+        after = min(timeit.repeat(lambda: get_landmarks(lms), number=args.repeat, repeat=3))
+        before_us = before / args.repeat * 1e6
+        after_us = after / args.repeat * 1e6
+        print(f"{n_faces:>5} {before_us:>12.1f} {after_us:>12.1f} {before_us / after_us:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
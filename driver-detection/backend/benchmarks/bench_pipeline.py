@@ -0,0 +1,446 @@
+"""
+Per-stage benchmark suite of the driver_state_detection pipeline
+
+Every stage of the per-frame pipeline is timed in isolation on the same recorded inputs, then the whole pipeline
+is timed end-to-end. For each stage the suite reports p50/p95/p99 latency and the memory allocated by a call
+(tracemalloc peak, measured in a separate pass so that tracing does not skew the timings).
+
+Inputs are reproducible:
+- frames: a recorded video (--video) or, by default, seeded synthetic textured frames
+- landmarks: a recorded (T, 478, 3) .npy array (--landmarks) or, by default, the canonical face model projected
+  with a seeded random head pose. Use --record_landmarks with --video to record them with FaceMesh.
+
+The FaceMesh.process stage only runs when the legacy mediapipe solutions API is installed, otherwise it is reported
+as skipped and the end-to-end pipeline replays the recorded landmarks instead.
+
+Usage:
+    python benchmarks/bench_pipeline.py --output results.json
+    python benchmarks/bench_pipeline.py --baseline benchmarks/baseline.json --tolerance 0.2
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from common import ReplayDetector, synthetic_frames, synthetic_landmarks, to_face_mesh_face
+from driver_state_detection.attention_scorer import AttentionScorer, RollingPERCLOS
+from driver_state_detection.eye_detector import EyeDetector
+from driver_state_detection.face_geometry import get_metric_landmarks
+from driver_state_detection.face_roi import FaceROIDetector
+from driver_state_detection.pipeline import (
+    FrameAnalyzer,
+    FrameResult,
+    OverlayRenderer,
+    draw_overlays,
+)
+from driver_state_detection.pose_estimation import HeadPoseEstimator
+from driver_state_detection.preprocessing import FramePreprocessor
+from driver_state_detection.utils import get_landmarks
+
+PERCENTILES = (50, 95, 99)
+
+
+def get_face_mesh():
+    """Returns a mediapipe FaceMesh model, or None if the solutions API is not available"""
+    try:
+        import mediapipe as mp
+
+        return mp.solutions.face_mesh.FaceMesh(
+            static_image_mode=False,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5,
+            refine_landmarks=True,
+        )
+    except (ImportError, AttributeError):
+        return None
+
+
+def load_frames(args):
+    if args.video is None:
+        return synthetic_frames(args.frames, frame_size=(args.width, args.height))
+
+    cap = cv2.VideoCapture(args.video)
+    frames = []
+    while len(frames) < args.frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        sys.exit(f"Cannot read frames from {args.video}")
+    return frames
+
+
+def load_landmarks(args, frames):
+    if args.landmarks is not None:
+        return np.load(args.landmarks).astype(np.float32)
+
+    if args.record_landmarks is not None:
+        face_mesh = get_face_mesh()
+        if face_mesh is None:
+            sys.exit("Recording landmarks needs the mediapipe solutions API")
+        recorded = []
+        for frame in frames:
+            lms = face_mesh.process(to_model_input(frame)).multi_face_landmarks
+            if lms:
+                recorded.append(get_landmarks(lms))
+        landmarks = np.stack(recorded)
+        np.save(args.record_landmarks, landmarks)
+        return landmarks
+
+    height, width = frames[0].shape[:2]
+    return synthetic_landmarks(len(frames), frame_size=(width, height))
+
+
+def to_model_input(frame):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    gray = np.expand_dims(gray, axis=2)
+    return np.concatenate([gray, gray, gray], axis=2)
+
+
+def new_scorer():
+    return AttentionScorer(
+        t_now=0.0,
+        ear_thresh=0.2,
+        gaze_thresh=0.3,
+        perclos_windows=(300, 900),
+    )
+
+
+def check_perclos_capacity(window=60, max_fps=60):
+    """The rolling PERCLOS buffer keeps its initial size at max_fps and only grows above it"""
+    for fps, grows in ((max_fps - 1, False), (max_fps, False), (2 * max_fps, True)):
+        perclos = RollingPERCLOS(windows=(window,), max_fps=max_fps)
+        capacity = perclos.capacity
+        for i in range(3 * window * fps):
+            perclos.update(i / fps, i % 4 == 0)
+        assert (perclos.capacity > capacity) == grows, (
+            f"rolling PERCLOS buffer at {fps} fps: {capacity} -> {perclos.capacity} samples"
+        )
+
+
+def build_stages(frames, landmarks, args):
+    """
+    Returns the list of (stage name, callable(i)) of the benchmark, i being the index of the input frame
+    """
+    n_frames = len(frames)
+    n_landmarks = len(landmarks)
+    height, width = frames[0].shape[:2]
+    frame_size = (width, height)
+    fps = 30.0
+
+    eye_det = EyeDetector()
+    head_pose = HeadPoseEstimator()
+    head_pose._get_camera_parameters(frame_size)
+    scorer = new_scorer()
+
+    jpegs = [cv2.imencode(".jpg", frame)[1] for frame in frames]
+    gray_frames = [to_model_input(frame) for frame in frames]
+    faces = [[to_face_mesh_face(points)] for points in landmarks]
+    model_ids = head_pose.model_lms_ids
+    model_img_lms = [np.clip(lms[model_ids, :2], 0.0, 1.0) * frame_size for lms in landmarks]
+    model_metric_lms = [
+        get_metric_landmarks(lms.T, head_pose.pcf, landmark_ids=model_ids)[0].T
+        for lms in landmarks
+    ]
+    ears = [eye_det.get_EAR(lms) for lms in landmarks]
+    metrics = {
+        "fps": fps,
+        "ear": 0.3,
+        "gaze": 0.1,
+        "perclos": 0.1,
+        "roll": 1.0,
+        "pitch": 2.0,
+        "yaw": 3.0,
+        "proc_time": 10.0,
+        "tired": True,
+        "asleep": True,
+        "looking_away": True,
+        "distracted": True,
+    }
+
+    def solve_pnp(i):
+        k = i % n_landmarks
+        _, rvec, tvec = cv2.solvePnP(
+            model_metric_lms[k],
+            model_img_lms[k],
+            head_pose.camera_matrix,
+            head_pose.dist_coeffs,
+            flags=cv2.SOLVEPNP_ITERATIVE,
+        )
+        cv2.solvePnPRefineVVS(
+            model_metric_lms[k],
+            model_img_lms[k],
+            head_pose.camera_matrix,
+            head_pose.dist_coeffs,
+            rvec,
+            tvec,
+        )
+
+    def overlay(i):
+        frame = frames[i % n_frames].copy()
+        k = i % n_landmarks
+        eye_det.show_eye_keypoints(frame, landmarks[k], frame_size)
+        head_pose._draw_nose_axes(
+            frame, np.zeros((3, 1)), np.array([[0.0], [0.0], [60.0]]), model_img_lms[k]
+        )
+        draw_overlays(frame, metrics)
+
+    preprocessor = FramePreprocessor(flip=True)
+    # grayscale frames at half the capture resolution (--inference_size)
+    half_preprocessor = FramePreprocessor(flip=True, inference_size=(width // 2, height // 2))
+
+    stages = []
+    if args.video is not None:
+        stages.append(("capture_decode", capture_decode(args.video, n_frames)))
+    else:
+        stages.append(
+            ("capture_decode", lambda i: cv2.imdecode(jpegs[i % n_frames], cv2.IMREAD_COLOR))
+        )
+    stages += [
+        ("flip", lambda i: cv2.flip(frames[i % n_frames], 1)),
+        ("cvtColor_stack", lambda i: to_model_input(frames[i % n_frames])),
+        ("preprocess", lambda i: preprocessor.process(frames[i % n_frames])),
+        ("preprocess_half_size", lambda i: half_preprocessor.process(frames[i % n_frames])),
+    ]
+
+    face_mesh = get_face_mesh()
+    if face_mesh is not None:
+        stages.append(("FaceMesh.process", lambda i: face_mesh.process(gray_frames[i % n_frames])))
+        # cropped to the face of the previous frame, falls back to the full frame without a face (--video)
+        roi_face_mesh = FaceROIDetector(get_face_mesh())
+        stages.append(
+            ("FaceMesh.process_roi", lambda i: roi_face_mesh.process(gray_frames[i % n_frames]))
+        )
+    else:
+        stages.append(("FaceMesh.process", None))
+        stages.append(("FaceMesh.process_roi", None))
+
+    stages += [
+        ("get_landmarks", lambda i: get_landmarks(faces[i % n_landmarks])),
+        ("get_EAR", lambda i: eye_det.get_EAR(landmarks[i % n_landmarks])),
+        (
+            "get_Gaze_Score",
+            lambda i: eye_det.get_Gaze_Score(
+                gray_frames[i % n_frames], landmarks[i % n_landmarks], frame_size
+            ),
+        ),
+        # one call covers the whole landmark stack (--frames faces)
+        (
+            "EAR_gaze_batch",
+            lambda i: (eye_det.get_EAR_batch(landmarks), eye_det.get_gaze_batch(landmarks)),
+        ),
+        (
+            "get_metric_landmarks",
+            lambda i: get_metric_landmarks(
+                landmarks[i % n_landmarks].T, head_pose.pcf, landmark_ids=model_ids
+            ),
+        ),
+        ("solvePnP", solve_pnp),
+        ("get_pose", lambda i: head_pose.get_pose(None, landmarks[i % n_landmarks], frame_size)),
+        # one call covers the whole landmark stack (--frames faces)
+        ("get_pose_batch", lambda i: head_pose.get_pose_batch(landmarks, frame_size)),
+        (
+            "eval_scores",
+            lambda i: scorer.eval_scores(i / fps, ears[i % n_landmarks], 0.1, 1.0, 2.0, 3.0),
+        ),
+        (
+            "get_rolling_PERCLOS",
+            lambda i: scorer.get_rolling_PERCLOS(i / fps, ears[i % n_landmarks]),
+        ),
+        ("overlay", overlay),
+        (
+            "jpeg_encode",
+            lambda i: cv2.imencode(
+                ".jpg", frames[i % n_frames], [cv2.IMWRITE_JPEG_QUALITY, 80]
+            ),
+        ),
+    ]
+
+    # end-to-end: preprocessing, detection (or replay), all the estimators, overlay and encoding,
+    # and the same without a viewer (no overlay, no encoding)
+    analyzer = FrameAnalyzer(
+        detector=face_mesh if face_mesh is not None else ReplayDetector(landmarks),
+        eye_det=EyeDetector(),
+        head_pose=HeadPoseEstimator(),
+        scorer=new_scorer(),
+    )
+
+    e2e_preprocessor = FramePreprocessor(flip=True)
+    renderer = OverlayRenderer()
+
+    def end_to_end(i):
+        frame, gray_1ch, gray = e2e_preprocessor.process(frames[i % n_frames])
+        lms, frame_metrics = analyzer.analyze(frame, i / fps, gray_1ch=gray_1ch, gray=gray)
+        result = FrameResult(
+            i, i / fps, frame, lms, dict(metrics, **(frame_metrics or {})), analyzer.pose
+        )
+        cv2.imencode(".jpg", renderer.render(result), [cv2.IMWRITE_JPEG_QUALITY, 80])
+
+    def end_to_end_no_viewer(i):
+        frame, gray_1ch, gray = e2e_preprocessor.process(frames[i % n_frames])
+        analyzer.analyze(frame, i / fps, gray_1ch=gray_1ch, gray=gray)
+
+    stages.append(("end_to_end", end_to_end))
+    stages.append(("end_to_end_no_viewer", end_to_end_no_viewer))
+    return stages
+
+
+def capture_decode(video, n_frames):
+    cap = cv2.VideoCapture(video)
+
+    def read(i):
+        if i % n_frames == 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        cap.read()
+
+    return read
+
+
+def measure(fn, iterations, warmup):
+    """Returns the latencies in milliseconds and the median allocated bytes of the calls of fn"""
+    for i in range(warmup):
+        fn(i)
+
+    latencies = np.empty(iterations)
+    for i in range(iterations):
+        t_start = time.perf_counter()
+        fn(i)
+        latencies[i] = time.perf_counter() - t_start
+
+    # separate pass: tracemalloc slows down every allocation
+    allocations = np.empty(min(iterations, 200))
+    tracemalloc.start()
+    for i in range(allocations.size):
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        fn(i)
+        allocations[i] = tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    return latencies * 1000, float(np.median(allocations))
+
+
+def run(args):
+    frames = load_frames(args)
+    landmarks = load_landmarks(args, frames)
+
+    results = {
+        "meta": {
+            "frames": len(frames),
+            "landmarks": len(landmarks),
+            "frame_size": [frames[0].shape[1], frames[0].shape[0]],
+            "iterations": args.iterations,
+            "video": args.video,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+        },
+        "stages": {},
+    }
+
+    for name, fn in build_stages(frames, landmarks, args):
+        if fn is None:
+            results["stages"][name] = {"skipped": "mediapipe solutions API not available"}
+            continue
+        latencies, allocated = measure(fn, args.iterations, args.warmup)
+        stage = {
+            f"p{p}_ms": round(float(np.percentile(latencies, p)), 4) for p in PERCENTILES
+        }
+        stage["mean_ms"] = round(float(latencies.mean()), 4)
+        stage["alloc_kb"] = round(allocated / 1024, 2)
+        results["stages"][name] = stage
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the p50 latencies with the baseline ones
+
+    Returns the list of (stage name, baseline p50, current p50) of the stages slower than tolerance
+    """
+    regressions = []
+    for name, stage in results["stages"].items():
+        base = baseline.get("stages", {}).get(name, {})
+        if "p50_ms" not in stage or "p50_ms" not in base:
+            continue
+        if stage["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+            regressions.append((name, base["p50_ms"], stage["p50_ms"]))
+    return regressions
+
+
+def print_table(results, baseline=None):
+    header = f"{'stage':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'alloc KB':>10}"
+    if baseline is not None:
+        header += f"{'base p50':>10}{'delta':>9}"
+    print(header)
+    for name, stage in results["stages"].items():
+        if "skipped" in stage:
+            print(f"{name:<22}  skipped: {stage['skipped']}")
+            continue
+        line = (
+            f"{name:<22}{stage['p50_ms']:>10.3f}{stage['p95_ms']:>10.3f}"
+            f"{stage['p99_ms']:>10.3f}{stage['alloc_kb']:>10.1f}"
+        )
+        base = (baseline or {}).get("stages", {}).get(name, {})
+        if "p50_ms" in base:
+            delta = stage["p50_ms"] / base["p50_ms"] - 1 if base["p50_ms"] else 0.0
+            line += f"{base['p50_ms']:>10.3f}{delta:>+9.1%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="driver_state_detection per-stage benchmark")
+    parser.add_argument("--video", type=str, help="Recorded video used as input frames")
+    parser.add_argument("--landmarks", type=str, help="Recorded (T, 478, 3) landmarks .npy file")
+    parser.add_argument(
+        "--record_landmarks", type=str, help="Record the landmarks of --video with FaceMesh to this .npy file"
+    )
+    parser.add_argument("--frames", type=int, default=120, help="Number of input frames")
+    parser.add_argument("--width", type=int, default=640, help="Synthetic frames width")
+    parser.add_argument("--height", type=int, default=480, help="Synthetic frames height")
+    parser.add_argument("--iterations", type=int, default=500, help="Timed calls per stage")
+    parser.add_argument("--warmup", type=int, default=20, help="Untimed calls per stage")
+    parser.add_argument("--output", type=str, help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", type=str, help="Compare with the results stored in this JSON file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed p50 slowdown against the baseline before failing, default is 0.2 (20%%)",
+    )
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    check_perclos_capacity()
+    results = run(args)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+
+    print_table(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, base, current in regressions:
+            print(f"REGRESSION {name}: p50 {base:.3f}ms -> {current:.3f}ms")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
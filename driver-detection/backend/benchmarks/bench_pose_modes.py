@@ -0,0 +1,115 @@
+"""
+Head pose modes benchmark: solvePnP ("pnp"), solvePnP warm-started from the previous frame ("pnp temporal") and the
+pose transform of the Procrustes alignment ("procrustes")
+
+All the modes run HeadPoseEstimator.estimate_pose on the same landmarks, seeded synthetic ones (optionally with
+landmark noise) or recorded ones. The angular agreement of each mode with "pnp" (roll, pitch, yaw and the angle
+between the two rotations) and the per-frame latency of every mode are reported.
+
+Usage:
+    python benchmarks/bench_pose_modes.py --frames 500 --noise 0.002
+    python benchmarks/bench_pose_modes.py --landmarks recorded_landmarks.npy
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from common import synthetic_landmarks
+from driver_state_detection.pose_estimation import HeadPoseEstimator
+from driver_state_detection.utils import load_camera_parameters
+
+
+MODES = {
+    "pnp": {"pose_mode": "pnp"},
+    "pnp temporal": {"pose_mode": "pnp", "temporal": True},
+    "procrustes": {"pose_mode": "procrustes"},
+}
+
+
+def run_mode(options, landmarks, frame_size, camera_matrix, dist_coeffs, warmup=20):
+    """Returns the (T, 3) angles, the (T, 3, 3) rotations and the per-frame latencies in ms of a pose mode"""
+    head_pose = HeadPoseEstimator(
+        camera_matrix=camera_matrix, dist_coeffs=dist_coeffs, **options
+    )
+    for points in landmarks[:warmup]:
+        head_pose.estimate_pose(points, frame_size)
+    # the warm-up frames are not followed by the first one
+    head_pose.reset()
+
+    angles = np.full((len(landmarks), 3), np.nan)
+    rotations = np.full((len(landmarks), 3, 3), np.nan)
+    times = np.empty(len(landmarks))
+    for t, points in enumerate(landmarks):
+        t_start = time.perf_counter()
+        rvec, _, roll, pitch, yaw = head_pose.estimate_pose(points, frame_size)
+        times[t] = time.perf_counter() - t_start
+        if rvec is not None:
+            angles[t] = roll[0], pitch[0], yaw[0]
+            rotations[t] = cv2.Rodrigues(rvec)[0]
+    return angles, rotations, times * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Head pose modes benchmark")
+    parser.add_argument("--landmarks", type=str, help="Recorded (T, 478, 3) landmarks .npy file")
+    parser.add_argument("--frames", type=int, default=500, help="Number of synthetic frames")
+    parser.add_argument(
+        "--noise", type=float, default=0.0, help="Std of the noise added to the synthetic landmarks"
+    )
+    parser.add_argument("--width", type=int, default=640, help="Frame width")
+    parser.add_argument("--height", type=int, default=480, help="Frame height")
+    parser.add_argument("--camera_params", type=str, help="Camera parameters file (JSON or YAML)")
+    args = parser.parse_args()
+
+    frame_size = (args.width, args.height)
+    if args.landmarks is not None:
+        landmarks = np.load(args.landmarks).astype(np.float64)
+    else:
+        landmarks = synthetic_landmarks(args.frames, frame_size=frame_size).astype(np.float64)
+        if args.noise > 0:
+            rng = np.random.default_rng(0)
+            landmarks += rng.normal(scale=args.noise, size=landmarks.shape)
+
+    if args.camera_params:
+        camera_matrix, dist_coeffs = load_camera_parameters(args.camera_params)
+    else:
+        camera_matrix, dist_coeffs = None, None
+
+    results = {
+        name: run_mode(options, landmarks, frame_size, camera_matrix, dist_coeffs)
+        for name, options in MODES.items()
+    }
+
+    pnp_angles, pnp_rotations, pnp_times = results["pnp"]
+    print(f"frames: {len(landmarks)}")
+    print(f"{'agreement (deg)':<26}{'mean':>10}{'p95':>10}{'max':>10}")
+    for name, (angles, rotations, _) in results.items():
+        if name == "pnp":
+            continue
+        valid = ~(np.isnan(pnp_angles).any(axis=1) | np.isnan(angles).any(axis=1))
+        diffs = np.abs(angles[valid] - pnp_angles[valid])
+        # angle of the relative rotation between the two poses
+        relative = np.einsum("tji,tjk->tik", pnp_rotations[valid], rotations[valid])
+        cos = np.clip((np.trace(relative, axis1=1, axis2=2) - 1) / 2, -1.0, 1.0)
+        geodesic = np.degrees(np.arccos(cos))
+        for angle, values in zip(("roll", "pitch", "yaw", "rotation"), (*diffs.T, geodesic)):
+            if values.size == 0:
+                continue
+            print(
+                f"{name + ' ' + angle:<26}{values.mean():>10.4f}"
+                f"{np.percentile(values, 95):>10.4f}{values.max():>10.4f}"
+            )
+
+    print(f"\n{'latency (ms)':<26}{'p50':>10}{'p95':>10}{'mean':>10}{'saved p50':>12}")
+    for name, (_, _, times) in results.items():
+        saved = np.median(pnp_times) - np.median(times)
+        print(
+            f"{name:<26}{np.median(times):>10.3f}{np.percentile(times, 95):>10.3f}"
+            f"{times.mean():>10.3f}{saved:>12.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
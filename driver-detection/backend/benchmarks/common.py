@@ -0,0 +1,105 @@
+"""
+Helpers shared by the benchmarks: synthetic inputs and face mesh result builders
+"""
+import os
+import sys
+import types
+
+import numpy as np
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BACKEND_DIR)
+
+from driver_state_detection.face_geometry import canonical_metric_landmarks  # noqa: E402
+
+N_LANDMARKS = 478
+
+
+class _Point:
+    __slots__ = ("x", "y", "z")
+
+    def __init__(self, x, y, z):
+        self.x, self.y, self.z = x, y, z
+
+
+class _FaceLandmarks:
+    def __init__(self, points):
+        self.landmark = [_Point(*map(float, point)) for point in points]
+
+
+def to_face_mesh_face(points):
+    """
+    Converts a (478, 3) landmarks array into a face mesh NormalizedLandmarkList, using the mediapipe protobuf
+    messages when they are available
+    """
+    try:
+        from mediapipe.framework.formats import landmark_pb2
+    except ImportError:
+        return _FaceLandmarks(points)
+
+    face = landmark_pb2.NormalizedLandmarkList()
+    for x, y, z in points:
+        face.landmark.add(x=x, y=y, z=z)
+    return face
+
+
+class ReplayDetector:
+    """Face mesh detector stand-in that returns recorded landmarks, one frame after the other"""
+
+    def __init__(self, landmarks):
+        self.faces = [to_face_mesh_face(points) for points in landmarks]
+        self.index = 0
+
+    def process(self, frame):
+        face = self.faces[self.index % len(self.faces)]
+        self.index += 1
+        return types.SimpleNamespace(multi_face_landmarks=[face])
+
+
+def synthetic_landmarks(n_frames, frame_size=(640, 480), seed=0):
+    """
+    Builds a (n_frames, 478, 3) array of normalized face mesh landmarks, projecting the canonical face model
+    with a slowly changing random head pose, as seen by a camera with focal length equal to the frame width
+    """
+    rng = np.random.default_rng(seed)
+    width, height = frame_size
+    model = canonical_metric_landmarks.T.copy()
+    model[:, 2] *= -1
+
+    angles = np.cumsum(rng.normal(scale=0.02, size=(n_frames, 3)), axis=0)
+    angles = np.clip(angles, -0.5, 0.5)
+    landmarks = np.empty((n_frames, N_LANDMARKS, 3), dtype=np.float32)
+    for t, (pitch, yaw, roll) in enumerate(angles):
+        cx, sx = np.cos(pitch), np.sin(pitch)
+        cy, sy = np.cos(yaw), np.sin(yaw)
+        cz, sz = np.cos(roll), np.sin(roll)
+        rot_x = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+        rot_y = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+        rot_z = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+        points = model @ (rot_z @ rot_y @ rot_x).T + np.array([0.0, 0.0, 60.0])
+
+        x = (width * points[:, 0] / points[:, 2] + width / 2) / width
+        y = (-width * points[:, 1] / points[:, 2] + height / 2) / height
+        z = (points[:, 2] - points[:, 2].mean()) / points[:, 2].mean()
+        face = np.stack([x, y, z], axis=1)
+
+        # iris landmarks: centered between the eye corners
+        left_iris = face[[33, 133]].mean(axis=0)
+        right_iris = face[[362, 263]].mean(axis=0)
+        landmarks[t, :468] = face
+        landmarks[t, 468:473] = left_iris
+        landmarks[t, 473:] = right_iris
+    return landmarks
+
+
+def synthetic_frames(n_frames, frame_size=(640, 480), seed=0):
+    """Builds n_frames textured BGR frames, slowly panning over a noise image"""
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    width, height = frame_size
+    texture = (rng.random((height + n_frames, width + n_frames, 3)) * 255).astype(
+        np.uint8
+    )
+    texture = cv2.GaussianBlur(texture, (7, 7), 0)
+    return [texture[t : t + height, t : t + width].copy() for t in range(n_frames)]
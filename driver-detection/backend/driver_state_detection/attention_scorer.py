@@ -2,6 +2,110 @@ import time
 import numpy as np
 
 
+class RollingPERCLOS:
+    def __init__(self, windows=(60,), max_fps=60):
+        """
+        Rolling PERCLOS over one or more time windows, computed from the same stream of eye closure samples.
+
+        The samples are stored in a circular buffer. Each window keeps the index of its oldest sample and a running
+        count of the closed-eye samples inside it, so every update costs O(1) amortized per window. The buffer is
+        sized for max_fps and doubles when it is full while its oldest sample is still inside the longest window,
+        so the windows always cover their whole duration: it only allocates until it fits the actual frame rate.
+
+        Parameters
+        ----------
+        windows: tuple of float or int, optional
+            Lengths in seconds of the rolling windows (default is (60,) -> 1 minute)
+        max_fps: int, optional
+            Expected maximum frame rate, used for the initial size of the buffer (default is 60). The buffer grows
+            at higher frame rates
+
+        Methods
+        ----------
+        - update: adds a sample and returns the PERCLOS score of every window
+        - scores: returns the last PERCLOS score of every window
+        """
+        self.windows = tuple(windows)
+        self.capacity = int(np.ceil(max(self.windows) * max_fps)) + 1
+
+        self.timestamps = np.empty((self.capacity,), dtype=np.float64)
+        self.closed_flags = np.zeros((self.capacity,), dtype=bool)
+
+        # monotonic sample counters: the buffer position of a sample is its counter modulo the capacity
+        self.head = 0
+        self.tails = [0] * len(self.windows)
+        self.closed_counts = [0] * len(self.windows)
+        self.perclos_scores = [0.0] * len(self.windows)
+
+    def update(self, t_now, eye_closed):
+        """
+        Adds the eye closure sample of the current frame and updates the PERCLOS of every window
+
+        Parameters
+        ----------
+        t_now: float or int
+            The current time in seconds.
+        eye_closed: bool
+            True if the eyes are closed in the current frame
+
+        Returns
+        --------
+        perclos_scores: list of float
+            The PERCLOS score of every window, in the same order as windows
+        """
+        capacity = self.capacity
+
+        # drop the samples that are no longer inside the windows, before checking if the buffer is full
+        for k, window in enumerate(self.windows):
+            tail = self.tails[k]
+            t_start = t_now - window
+            while tail < self.head and self.timestamps[tail % capacity] < t_start:
+                self.closed_counts[k] -= int(self.closed_flags[tail % capacity])
+                tail += 1
+            self.tails[k] = tail
+
+        # the buffer is full and its oldest sample is still inside the longest window: make room for it
+        if self.head - capacity == min(self.tails):
+            self._grow()
+            capacity = self.capacity
+
+        pos = self.head % capacity
+        self.timestamps[pos] = t_now
+        self.closed_flags[pos] = eye_closed
+        self.head += 1
+
+        for k in range(len(self.windows)):
+            self.closed_counts[k] += int(eye_closed)
+            closed_count = self.closed_counts[k]
+            total_frames = self.head - self.tails[k]
+            self.perclos_scores[k] = (
+                closed_count / total_frames if total_frames > 0 else 0.0
+            )
+
+        return self.perclos_scores
+
+    def _grow(self):
+        # double the buffer, the samples keep their counter: position = counter modulo the new capacity
+        capacity = 2 * self.capacity
+        counters = np.arange(self.head - self.capacity, self.head)
+        timestamps = np.empty((capacity,), dtype=np.float64)
+        closed_flags = np.zeros((capacity,), dtype=bool)
+        timestamps[counters % capacity] = self.timestamps[counters % self.capacity]
+        closed_flags[counters % capacity] = self.closed_flags[counters % self.capacity]
+        self.timestamps = timestamps
+        self.closed_flags = closed_flags
+        self.capacity = capacity
+
+    def scores(self):
+        """
+        Returns
+        --------
+        scores: dict
+            The last PERCLOS score of every window, keyed by the window length in seconds
+        """
+        return dict(zip(self.windows, self.perclos_scores))
+
+
 class AttentionScorer:
     """
     Attention Scorer class that contains methods for estimating EAR, Gaze_Score, PERCLOS and Head Pose over time,
@@ -26,6 +130,8 @@ class AttentionScorer:
         gaze_time_thresh=2.0,
         pose_time_thresh=4.0,
         decay_factor=0.9,
+        perclos_windows=None,
+        max_fps=60,
         verbose=False,
     ):
         """
@@ -76,6 +182,14 @@ class AttentionScorer:
         decay_factor: float, optional
             Decay factor for the attention scores. This value should be between 0 and 1. The decay factor is used to reduce the score over time when a distraction condition is not met, simulating a decay effect. A value of 0 means istant decay to 0, while a value of 1 means the score will not decay at all. (default is 0.9)
 
+        perclos_windows: tuple of float or int, optional
+            Additional rolling PERCLOS windows in seconds, tracked together with the 60 seconds one
+            (e.g. (300, 900) for 5 and 15 minutes). Default is None (only the 60 seconds window)
+
+        max_fps: int, optional
+            Expected maximum frame rate, used for the initial size of the rolling PERCLOS buffer, which grows at
+            higher frame rates (default is 60)
+
         verbose: bool, optional
             If set to True, print additional information about the scores (default is False)
         """
@@ -101,8 +215,10 @@ class AttentionScorer:
 
         # PERCLOS parameters
         self.PERCLOS_TIME_PERIOD = 60
-        self.timestamps = np.empty((0,), dtype=np.float64)
-        self.closed_flags = np.empty((0,), dtype=bool)
+        windows = [self.PERCLOS_TIME_PERIOD]
+        if perclos_windows is not None:
+            windows += [w for w in perclos_windows if w != self.PERCLOS_TIME_PERIOD]
+        self.rolling_perclos = RollingPERCLOS(windows=windows, max_fps=max_fps)
         self.eye_closure_counter = 0
         self.prev_time = t_now
 
@@ -261,7 +377,8 @@ class AttentionScorer:
 
     def get_rolling_PERCLOS(self, t_now, ear_score):
         """
-        Compute the rolling PERCLOS score using NumPy vectorized operations.
+        Compute the rolling PERCLOS score over the last PERCLOS_TIME_PERIOD seconds.
+        The additional perclos_windows are updated too, see get_rolling_PERCLOS_windows.
 
         Parameters
         ----------
@@ -280,20 +397,16 @@ class AttentionScorer:
         # Determine if the current frame indicates closed eyes
         eye_closed = (ear_score is not None) and (ear_score <= self.ear_thresh)
 
-        # Append new values to the NumPy arrays. (np.concatenate creates new arrays.)
-        self.timestamps = np.concatenate((self.timestamps, [t_now]))
-        self.closed_flags = np.concatenate((self.closed_flags, [eye_closed]))
-
-        # Create a boolean mask of entries within the rolling window.
-        valid_mask = self.timestamps >= (t_now - self.PERCLOS_TIME_PERIOD)
-        self.timestamps = self.timestamps[valid_mask]
-        self.closed_flags = self.closed_flags[valid_mask]
-
-        total_frames = self.timestamps.size
-        if total_frames > 0:
-            perclos_score = np.sum(self.closed_flags) / total_frames
-        else:
-            perclos_score = 0.0
+        perclos_score = self.rolling_perclos.update(t_now, eye_closed)[0]
 
         tired = perclos_score >= self.perclos_thresh
         return tired, perclos_score
+
+    def get_rolling_PERCLOS_windows(self):
+        """
+        Returns
+        -------
+        perclos_scores : dict
+            The last rolling PERCLOS score of every tracked window, keyed by the window length in seconds.
+        """
+        return self.rolling_perclos.scores()
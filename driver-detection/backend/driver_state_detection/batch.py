@@ -0,0 +1,445 @@
+"""
+Offline analysis of recorded videos
+
+Every video is decoded as fast as the CPU allows, without display, and runs through the same FrameAnalyzer as the
+live pipeline. The AttentionScorer is driven by the timestamps of the video, so the time thresholds and the rolling
+PERCLOS windows cover video time instead of processing time. Videos are analyzed in parallel by worker processes,
+one FrameAnalyzer (face mesh model, estimators and scorer) per video.
+
+The per-frame metrics and the per-video summaries are written to a columnar file as the videos complete, so the
+memory used does not grow with the number of videos, and a video that fails is reported in the "error" column of
+its summary instead of aborting the run:
+- .npz: one array per column, named "frames/<column>" and "videos/<column>"
+- .parquet (requires pyarrow): the frames table, one row group per video, with the videos table next to it in
+  <name>.videos.parquet
+The frames of a video are contiguous, in the order the videos complete; the videos table is in input order.
+
+Usage:
+    python batch.py recordings/ other_video.mp4 -o metrics.npz --jobs 8
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import cv2
+import mediapipe as mp
+import numpy as np
+
+try:
+    from .attention_scorer import AttentionScorer
+    from .eye_detector import EyeDetector
+    from .face_roi import FaceROIDetector
+    from .landmark_tracker import LandmarkTracker, get_tracked_lms_ids
+    from .parser import get_batch_args
+    from .pipeline import FrameAnalyzer
+    from .pose_estimation import HeadPoseEstimator
+    from .preprocessing import FramePreprocessor
+    from .utils import load_camera_parameters
+except ImportError:
+    from attention_scorer import AttentionScorer
+    from eye_detector import EyeDetector
+    from face_roi import FaceROIDetector
+    from landmark_tracker import LandmarkTracker, get_tracked_lms_ids
+    from parser import get_batch_args
+    from pipeline import FrameAnalyzer
+    from pose_estimation import HeadPoseEstimator
+    from preprocessing import FramePreprocessor
+    from utils import load_camera_parameters
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov", ".m4v", ".webm", ".mpg", ".mpeg")
+
+# per-frame columns and their dtypes, the float metrics are NaN on the frames without a face
+FRAME_COLUMNS = {
+    "video_id": np.int32,
+    "frame": np.int64,
+    "timestamp": np.float64,
+    "face_detected": np.bool_,
+    "ear": np.float32,
+    "gaze": np.float32,
+    "perclos": np.float32,
+    "roll": np.float32,
+    "pitch": np.float32,
+    "yaw": np.float32,
+    "tired": np.bool_,
+    "asleep": np.bool_,
+    "looking_away": np.bool_,
+    "distracted": np.bool_,
+}
+FLOAT_METRICS = ("ear", "gaze", "perclos", "roll", "pitch", "yaw")
+ALERTS = ("tired", "asleep", "looking_away", "distracted")
+
+
+def find_videos(inputs, recursive=False):
+    """Expands the input directories into their video files, sorted by path. Files are kept as given."""
+    videos = []
+    for path in inputs:
+        if os.path.isdir(path):
+            if recursive:
+                walk = (
+                    os.path.join(root, name)
+                    for root, _, names in os.walk(path)
+                    for name in names
+                )
+            else:
+                walk = (os.path.join(path, name) for name in os.listdir(path))
+            videos += sorted(
+                file
+                for file in walk
+                if file.lower().endswith(VIDEO_EXTENSIONS) and os.path.isfile(file)
+            )
+        else:
+            videos.append(path)
+    return videos
+
+
+def create_analyzer(options, t_start, max_fps):
+    """Face mesh model, estimators and scorer of a video, with the thresholds of the command line"""
+    if options.camera_params:
+        camera_matrix, dist_coeffs = load_camera_parameters(options.camera_params)
+    else:
+        camera_matrix, dist_coeffs = None, None
+
+    detector = mp.solutions.face_mesh.FaceMesh(
+        static_image_mode=False,
+        min_detection_confidence=0.5,
+        min_tracking_confidence=0.5,
+        refine_landmarks=True,
+    )
+    if options.face_roi:
+        detector = FaceROIDetector(detector)
+    eye_det = EyeDetector(show_processing=False)
+    head_pose = HeadPoseEstimator(
+        show_axis=False,
+        camera_matrix=camera_matrix,
+        dist_coeffs=dist_coeffs,
+        pose_mode=options.pose_mode,
+        temporal=options.temporal_pose,
+    )
+    scorer = AttentionScorer(
+        t_now=t_start,
+        ear_thresh=options.ear_thresh,
+        gaze_thresh=options.gaze_thresh,
+        roll_thresh=options.roll_thresh,
+        pitch_thresh=options.pitch_thresh,
+        yaw_thresh=options.yaw_thresh,
+        ear_time_thresh=options.ear_time_thresh,
+        gaze_time_thresh=options.gaze_time_thresh,
+        pose_time_thresh=options.pose_time_thresh,
+        max_fps=max_fps,
+    )
+    tracker = None
+    if options.detect_interval > 1:
+        tracker = LandmarkTracker(
+            detector,
+            tracked_ids=get_tracked_lms_ids(eye_det, head_pose),
+            detect_interval=options.detect_interval,
+        )
+    return FrameAnalyzer(detector, eye_det, head_pose, scorer, tracker=tracker)
+
+
+def analyze_video(video_id, path, options):
+    """
+    Runs the detection pipeline on every frame of a video (called in the worker processes)
+
+    Parameters
+    ----------
+    video_id: int
+        Index of the video in the output file
+    path: str
+        Path of the video file
+    options: argparse.Namespace
+        Command line options (thresholds, camera parameters, detection interval)
+
+    Returns
+    --------
+    columns: dict
+        Per-frame columns of the video, see FRAME_COLUMNS
+    summary: dict
+        Per-video summary
+    """
+    columns = {name: [] for name in FRAME_COLUMNS}
+    summary = {"path": path, "error": ""}
+
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        summary["error"] = "cannot open the video"
+        return _to_arrays(columns), _summarize(summary, columns, 0.0, 0.0)
+
+    video_fps = cap.get(cv2.CAP_PROP_FPS)
+    if not video_fps or video_fps <= 0 or not np.isfinite(video_fps):
+        video_fps = 30.0
+
+    t_start = time.perf_counter()
+    analyzer = None
+    captured = None
+    timestamp = None
+    frame_index = 0
+    try:
+        analyzer = create_analyzer(
+            options, t_start=0.0, max_fps=max(60, int(np.ceil(video_fps)))
+        )
+        preprocessor = FramePreprocessor(
+            flip=False, inference_size=options.inference_size
+        )
+        while True:
+            ret, captured = cap.read(captured)
+            if not ret:
+                break
+
+            # timestamp of the decoded frame, from the frame index when the container has none
+            # (or it is not monotonic)
+            pos = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            if timestamp is not None and not pos > timestamp:
+                pos = frame_index / video_fps
+                if not pos > timestamp:
+                    pos = timestamp + 1 / video_fps
+            timestamp = pos
+
+            frame, gray_1ch, gray = preprocessor.process(captured)
+            _, metrics = analyzer.analyze(frame, timestamp, gray_1ch, gray)
+
+            columns["video_id"].append(video_id)
+            columns["frame"].append(frame_index)
+            columns["timestamp"].append(timestamp)
+            columns["face_detected"].append(metrics is not None)
+            for name in FLOAT_METRICS:
+                value = metrics.get(name) if metrics is not None else None
+                columns[name].append(np.nan if value is None else value)
+            for name in ALERTS:
+                columns[name].append(metrics is not None and metrics[name])
+            frame_index += 1
+    except Exception as e:
+        # a corrupted video must not abort the batch: keep the frames analyzed before the error
+        summary["error"] = f"{type(e).__name__}: {e}"
+        n_frames = min(len(values) for values in columns.values())
+        for values in columns.values():
+            del values[n_frames:]
+    finally:
+        cap.release()
+        if analyzer is not None:
+            analyzer.detector.close()
+
+    processing_time = time.perf_counter() - t_start
+    duration = timestamp + 1 / video_fps if timestamp is not None else 0.0
+    summary["video_fps"] = video_fps
+    return _to_arrays(columns), _summarize(summary, columns, duration, processing_time)
+
+
+def _to_arrays(columns):
+    return {
+        name: np.asarray(values, dtype=FRAME_COLUMNS[name])
+        for name, values in columns.items()
+    }
+
+
+def _summarize(summary, columns, duration, processing_time):
+    n_frames = len(columns["frame"])
+    detected = np.asarray(columns["face_detected"], dtype=bool)
+    summary.setdefault("video_fps", 0.0)
+    summary["frames"] = n_frames
+    summary["duration_s"] = duration
+    summary["face_ratio"] = float(detected.mean()) if n_frames else 0.0
+    with np.errstate(all="ignore"):
+        ear = np.asarray(columns["ear"], dtype=np.float64)
+        gaze = np.asarray(columns["gaze"], dtype=np.float64)
+        perclos = np.asarray(columns["perclos"], dtype=np.float64)
+        summary["ear_mean"] = float(np.nanmean(ear)) if np.any(~np.isnan(ear)) else np.nan
+        summary["gaze_mean"] = (
+            float(np.nanmean(gaze)) if np.any(~np.isnan(gaze)) else np.nan
+        )
+        summary["perclos_max"] = (
+            float(np.nanmax(perclos)) if np.any(~np.isnan(perclos)) else np.nan
+        )
+    # share of the frames with a face in which the alert was raised
+    for name in ALERTS:
+        alerts = np.asarray(columns[name], dtype=bool)
+        summary[f"{name}_ratio"] = (
+            float(alerts.sum() / detected.sum()) if detected.any() else 0.0
+        )
+    summary["processing_time_s"] = processing_time
+    summary["realtime_factor"] = (
+        duration / processing_time if processing_time > 0 else 0.0
+    )
+    return summary
+
+
+def _failed_video(path, error):
+    columns = {name: [] for name in FRAME_COLUMNS}
+    summary = {"path": path, "error": error}
+    return _to_arrays(columns), _summarize(summary, columns, 0.0, 0.0)
+
+
+def _videos_table(summaries):
+    # summaries by video id
+    summaries = [summary for _, summary in sorted(summaries.items())]
+    return {name: [summary[name] for summary in summaries] for name in summaries[0]}
+
+
+class NpzWriter:
+    def __init__(self, path):
+        """
+        Writes the frames of the videos to a .npz file as they are analyzed, without keeping them in memory.
+
+        The frame columns of every video are appended to raw spool files in a temporary directory next to the
+        output, and streamed into the compressed members of the archive when the writer is closed, so that the
+        output is a regular .npz file (np.load(path)["frames/ear"]).
+
+        Methods
+        ----------
+        - write_video: appends the frames and the summary of a video
+        - close: writes the archive and removes the spool files
+        """
+        self.path = path
+        self.spool_dir = tempfile.mkdtemp(
+            prefix=".batch-", dir=os.path.dirname(os.path.abspath(path))
+        )
+        self.spools = {
+            name: open(os.path.join(self.spool_dir, name), "wb")
+            for name in FRAME_COLUMNS
+        }
+        self.rows = 0
+        self.summaries = {}
+
+    def write_video(self, video_id, columns, summary):
+        for name, values in columns.items():
+            values.astype(FRAME_COLUMNS[name], copy=False).tofile(self.spools[name])
+        self.rows += len(columns["frame"])
+        self.summaries[video_id] = summary
+
+    def close(self):
+        for spool in self.spools.values():
+            spool.close()
+        try:
+            with zipfile.ZipFile(
+                self.path, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True
+            ) as archive:
+                for name, dtype in FRAME_COLUMNS.items():
+                    header = {
+                        "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                        "fortran_order": False,
+                        "shape": (self.rows,),
+                    }
+                    with archive.open(
+                        f"frames/{name}.npy", "w", force_zip64=True
+                    ) as member:
+                        np.lib.format.write_array_header_1_0(member, header)
+                        with open(self.spools[name].name, "rb") as spool:
+                            shutil.copyfileobj(spool, member, 1 << 20)
+                if self.summaries:
+                    for name, values in _videos_table(self.summaries).items():
+                        with archive.open(f"videos/{name}.npy", "w") as member:
+                            np.lib.format.write_array(member, np.asarray(values))
+        finally:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+
+class ParquetWriter:
+    def __init__(self, path):
+        """
+        Writes the frames of the videos to a .parquet file as they are analyzed, one row group per video, and the
+        videos table to <name>.videos.parquet when closed
+
+        Methods
+        ----------
+        - write_video: appends the frames and the summary of a video
+        - close: closes the frames file and writes the videos table
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.pq = pq
+        self.path = path
+        self.schema = pa.schema(
+            [
+                (name, pa.from_numpy_dtype(np.dtype(dtype)))
+                for name, dtype in FRAME_COLUMNS.items()
+            ]
+        )
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.rows = 0
+        self.summaries = {}
+
+    def write_video(self, video_id, columns, summary):
+        if len(columns["frame"]):
+            self.writer.write_table(self.pa.table(columns, schema=self.schema))
+        self.rows += len(columns["frame"])
+        self.summaries[video_id] = summary
+
+    def close(self):
+        self.writer.close()
+        if self.summaries:
+            root, ext = os.path.splitext(self.path)
+            self.pq.write_table(
+                self.pa.table(_videos_table(self.summaries)), f"{root}.videos{ext}"
+            )
+
+
+def main():
+    args = get_batch_args()
+
+    if args.output.endswith(".parquet"):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            sys.exit("Writing .parquet files requires pyarrow, use a .npz output instead")
+    elif not args.output.endswith(".npz"):
+        sys.exit("The output file must be a .npz or .parquet file")
+
+    videos = find_videos(args.inputs, recursive=args.recursive)
+    if not videos:
+        sys.exit("No video found")
+
+    jobs = min(args.jobs or os.cpu_count(), len(videos))
+    print(f"Analyzing {len(videos)} videos with {jobs} processes", file=sys.stderr)
+
+    writer = (
+        ParquetWriter(args.output)
+        if args.output.endswith(".parquet")
+        else NpzWriter(args.output)
+    )
+    t_start = time.perf_counter()
+    duration = 0.0
+    try:
+        # spawned workers: each one loads its own face mesh models
+        with ProcessPoolExecutor(
+            max_workers=jobs, mp_context=get_context("spawn")
+        ) as pool:
+            # video of every pending task, the results are written (and released) as soon as they complete
+            pending = {
+                pool.submit(analyze_video, video_id, path, args): (video_id, path)
+                for video_id, path in enumerate(videos)
+            }
+            for done, future in enumerate(as_completed(pending), 1):
+                video_id, path = pending.pop(future)
+                try:
+                    columns, summary = future.result()
+                except Exception as e:
+                    # e.g. a worker process killed while decoding the video
+                    columns, summary = _failed_video(path, f"{type(e).__name__}: {e}")
+                del future
+                writer.write_video(video_id, columns, summary)
+                duration += summary["duration_s"]
+                status = summary["error"] or (
+                    f"{summary['frames']} frames, {summary['duration_s']:.1f}s of video, "
+                    f"{summary['realtime_factor']:.1f}x real time"
+                )
+                print(f"[{done}/{len(videos)}] {path}: {status}", file=sys.stderr)
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - t_start
+    print(
+        f"{writer.rows} frames ({duration:.1f}s of video) analyzed in {elapsed:.1f}s, "
+        f"written to {args.output}",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,62 @@
 import cv2
 import numpy as np
-from numpy import linalg as LA
 try:
     from .utils import resize
 except ImportError:
     from utils import resize
 
+# face mesh keypoints of the (left, right) eyes: the two eye corners, then two pairs of upper/lower eyelid points
+EYES_LMS = np.array(
+    [[33, 133, 160, 144, 158, 153], [362, 263, 385, 380, 387, 373]], dtype=np.intp
+)
+# (left, right) iris centers
+IRIS_LMS = np.array([468, 473], dtype=np.intp)
+# EAR distances of every eye: (upper eyelid, lower eyelid) x2 and (corner, corner), as gathered index arrays
+EAR_LMS_A = EYES_LMS[:, [2, 4, 0]]
+EAR_LMS_B = EYES_LMS[:, [3, 5, 1]]
+
+
+def ear_kernel(landmarks):
+    """
+    EAR of a stack of faces: mean over the two eyes of (|p2 - p3| + |p4 - p5|) / (2 |p0 - p1|)
+
+    Parameters
+    ----------
+    landmarks: numpy array
+        (T, 478, 2 or 3) face mesh landmarks
+
+    Returns
+    --------
+    ear: numpy array
+        (T,) EAR scores
+    """
+    diff = landmarks[:, EAR_LMS_A, :2] - landmarks[:, EAR_LMS_B, :2]
+    dist = np.sqrt(np.einsum("teki,teki->tek", diff, diff))
+    ear_eyes = (dist[..., 0] + dist[..., 1]) / (2 * dist[..., 2])
+    return (ear_eyes[:, 0] + ear_eyes[:, 1]) / 2
+
+
+def gaze_kernel(landmarks):
+    """
+    Gaze Score of a stack of faces: mean over the two eyes of the distance between the iris center and the center
+    of the eye bounding box, normalized by the x coordinate of the eye center
+
+    Parameters
+    ----------
+    landmarks: numpy array
+        (T, 478, 2 or 3) face mesh landmarks
+
+    Returns
+    --------
+    gaze: numpy array
+        (T,) Gaze Scores
+    """
+    eyes = landmarks[:, EYES_LMS, :2]
+    eye_center = (eyes.min(axis=2) + eyes.max(axis=2)) / 2
+    diff = landmarks[:, IRIS_LMS, :2] - eye_center
+    scores = np.sqrt(np.einsum("tei,tei->te", diff, diff)) / eye_center[..., 0]
+    return (scores[:, 0] + scores[:, 1]) / 2
+
 
 class EyeDetector:
     def __init__(self, show_processing: bool = False):
@@ -23,30 +74,13 @@ class EyeDetector:
         - get_EAR: computes EAR average score for the two eyes of the face
         - get_Gaze_Score: computes the Gaze_Score (normalized euclidean distance between center of eye and pupil)
             of the eyes of the face
+        - get_EAR_batch / get_gaze_batch: same scores for a (T, 478, 3) stack of landmarks, in a single NumPy pass
         """
 
         self.show_processing = show_processing
-        # Eye landmarks numbers constants
-        self.EYES_LMS_NUMS = [33, 133, 160, 144, 158, 153, 362, 263, 385, 380, 387, 373]
-        self.LEFT_IRIS_NUM = 468
-        self.RIGHT_IRIS_NUM = 473
-
-    @staticmethod
-    def _calc_EAR_eye(eye_pts):
-        """
-        Computer the EAR score for a single eyes given it's keypoints
-        :param eye_pts: numpy array of shape (6,2) containing the keypoints of an eye
-        :return: ear_eye
-            EAR of the eye
-        """
-        ear_eye = (
-            LA.norm(eye_pts[2] - eye_pts[3]) + LA.norm(eye_pts[4] - eye_pts[5])
-        ) / (2 * LA.norm(eye_pts[0] - eye_pts[1]))
-        """
-        EAR is computed as the mean of two measures of eye opening (see mediapipe face keypoints for the eye)
-        divided by the eye lenght
-        """
-        return ear_eye
+        # Eye landmarks numbers constants, from the module level arrays used by the kernels
+        self.EYES_LMS_NUMS = EYES_LMS.ravel().tolist()
+        self.LEFT_IRIS_NUM, self.RIGHT_IRIS_NUM = IRIS_LMS.tolist()
 
     def show_eye_keypoints(self, color_frame, landmarks, frame_size):
         """
@@ -98,51 +132,32 @@ class EyeDetector:
             Each eye has his scores and the two scores are averaged
         """
 
-        # numpy array for storing the keypoints positions of the left and right eyes
-        eye_pts_l = np.zeros(shape=(6, 2))
-        eye_pts_r = eye_pts_l.copy()
+        return float(ear_kernel(landmarks[np.newaxis])[0])
 
-        # get the face mesh keypoints
-        for i in range(len(self.EYES_LMS_NUMS) // 2):
-            # array of x,y coordinates for the left eye reference point
-            eye_pts_l[i] = landmarks[self.EYES_LMS_NUMS[i], :2]
-            # array of x,y coordinates for the right eye reference point
-            eye_pts_r[i] = landmarks[self.EYES_LMS_NUMS[i + 6], :2]
-
-        # computing the left eye EAR score
-        ear_left = self._calc_EAR_eye(eye_pts_l)
-        # computing the right eye EAR score
-        ear_right = self._calc_EAR_eye(eye_pts_r)
+    def get_EAR_batch(self, landmarks):
+        """
+        Computes the average eye aperture rate of a stack of faces, e.g. the landmarks of a recorded session
 
-        # computing the average EAR score
-        ear_avg = (ear_left + ear_right) / 2
+        Parameters
+        ----------
+        landmarks: numpy array
+            (T, 478, 3) mediapipe keypoints of T faces
 
-        return ear_avg
+        Returns
+        --------
+        ear_scores: numpy array
+            (T,) EAR average scores between the two eyes
+        """
+        return ear_kernel(np.asarray(landmarks))
 
     @staticmethod
-    def _calc_1eye_score(landmarks, eye_lms_nums, eye_iris_num, frame_size, frame):
-        """Gets each eye score and its picture."""
-        iris = landmarks[eye_iris_num, :2]
-
-        eye_x_min = landmarks[eye_lms_nums, 0].min()
-        eye_y_min = landmarks[eye_lms_nums, 1].min()
-        eye_x_max = landmarks[eye_lms_nums, 0].max()
-        eye_y_max = landmarks[eye_lms_nums, 1].max()
-
-        eye_center = np.array(
-            ((eye_x_min + eye_x_max) / 2, (eye_y_min + eye_y_max) / 2)
-        )
-
-        eye_gaze_score = LA.norm(iris - eye_center) / eye_center[0]
-
-        eye_x_min_frame = int(eye_x_min * frame_size[0])
-        eye_y_min_frame = int(eye_y_min * frame_size[1])
-        eye_x_max_frame = int(eye_x_max * frame_size[0])
-        eye_y_max_frame = int(eye_y_max * frame_size[1])
-
-        eye = frame[eye_y_min_frame:eye_y_max_frame, eye_x_min_frame:eye_x_max_frame]
-
-        return eye_gaze_score, eye
+    def _eye_crop(landmarks, eye_lms_nums, frame_size, frame):
+        """Gets the picture of an eye, from the bounding box of its keypoints."""
+        eye_min = landmarks[eye_lms_nums, :2].min(axis=0) * frame_size
+        eye_max = landmarks[eye_lms_nums, :2].max(axis=0) * frame_size
+        x_min, y_min = eye_min.astype(int)
+        x_max, y_max = eye_max.astype(int)
+        return frame[y_min:y_max, x_min:x_max]
 
     def get_Gaze_Score(self, frame, landmarks, frame_size):
         """
@@ -165,23 +180,31 @@ class EyeDetector:
 
         """
 
-        left_gaze_score, left_eye = self._calc_1eye_score(
-            landmarks, self.EYES_LMS_NUMS[:6], self.LEFT_IRIS_NUM, frame_size, frame
-        )
-        right_gaze_score, right_eye = self._calc_1eye_score(
-            landmarks, self.EYES_LMS_NUMS[6:], self.RIGHT_IRIS_NUM, frame_size, frame
-        )
+        # computes the average gaze score for the 2 eyes
+        avg_gaze_score = float(gaze_kernel(landmarks[np.newaxis])[0])
 
         # if show_processing is True, shows the eyes ROI
         # TODO: show iris and distance from the center of the eye
+        if self.show_processing:
+            left_eye = self._eye_crop(landmarks, EYES_LMS[0], frame_size, frame)
+            right_eye = self._eye_crop(landmarks, EYES_LMS[1], frame_size, frame)
+            cv2.imshow("left eye", resize(left_eye, 1000))
+            cv2.imshow("right eye", resize(right_eye, 1000))
 
-        # computes the average gaze score for the 2 eyes
-        avg_gaze_score = (left_gaze_score + right_gaze_score) / 2
+        return avg_gaze_score
 
-        if self.show_processing and (left_eye is not None) and (right_eye is not None):
-            left_eye = resize(left_eye, 1000)
-            right_eye = resize(right_eye, 1000)
-            cv2.imshow("left eye", left_eye)
-            cv2.imshow("right eye", right_eye)
+    def get_gaze_batch(self, landmarks):
+        """
+        Computes the average Gaze Score of a stack of faces, e.g. the landmarks of a recorded session
 
-        return avg_gaze_score
+        Parameters
+        ----------
+        landmarks: numpy array
+            (T, 478, 3) face mesh keypoints of T faces
+
+        Returns
+        --------
+        gaze_scores: numpy array
+            (T,) average Gaze Scores of the two eyes
+        """
+        return gaze_kernel(np.asarray(landmarks))
@@ -14,6 +14,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import sys
+
 import numpy as np
 
 canonical_metric_landmarks = np.array(
@@ -2492,7 +2495,10 @@ class Debugger(metaclass=Singleton):
 
 
 DEBUG = Debugger()
-DEBUG.set_debug(False)
+# the debug mode is chosen once, at import time: the solvers below carry no debug code and, when the
+# FACE_GEOMETRY_DEBUG environment variable is set to 1, they are replaced by the instrumented ones of
+# face_geometry_validation (see the end of this module)
+DEBUG.set_debug(os.environ.get("FACE_GEOMETRY_DEBUG", "0") == "1")
 
 
 class PCF:
@@ -2542,55 +2548,7 @@ class PCF:
         self.top = 0.5 * height_at_near
 
 
-def log(name, f):
-    """
-    This function is used to log information. If debugging is enabled, the function prints the log message. The
-    purpose of this function is to provide a convenient way to log information during debugging. It allows developers
-    to easily track the flow of their code and inspect the values of variables at different points.
-
-    Parameters:
-    -----------
-    name: Represents the name of the log as a str.
-    f: Represents the content of the log as an object.
-
-    Returns
-    -------
-
-    """
-    if DEBUG.get_debug():
-        print(f"{name} logged:", f)
-        print()
-
-
-def cpp_compare(name, np_matrix):
-    """
-    This function is used to compare a given matrix with a C++ matrix stored in a file. If using debug mode,
-    the function proceeds to compare the matrices. To ensure correct memory alignment, the C++ matrix is loaded from
-    the file and reshaped into a 2D array. Then, the function calculates the sum of squared differences between the
-    C++ matrix and the first rows and cols of the np_matrix. Finally, the function prints the result of the
-    comparison.
-
-    Parameters:
-    -----------
-    name: Name of the file as a str.
-    f: Represents the content of the log as an object.
-
-    Returns
-    -------
-
-    """
-    if DEBUG.get_debug():
-        # reorder cpp matrix as memory alignment is not correct
-        cpp_matrix = np.load(f"{name}_cpp.npy")
-        rows, cols = cpp_matrix.shape
-        cpp_matrix = np.split(np.reshape(cpp_matrix, -1), cols)
-        cpp_matrix = np.stack(cpp_matrix, 1)
-
-        print(f"{name}:", np.sum(np.abs(cpp_matrix - np_matrix[:rows, :cols]) ** 2))
-        print()
-
-
-def get_metric_landmarks(screen_landmarks, pcf):
+def get_metric_landmarks(screen_landmarks, pcf, landmark_ids=None):
     """
     This function performs several steps to convert the screen landmarks into metric landmarks.
 
@@ -2609,39 +2567,54 @@ def get_metric_landmarks(screen_landmarks, pcf):
     the total scale (product of first and second iteration scales). The metric landmarks are unprojected back to the
     screen space and the handedness is changed again.
 
-    A weighted orthogonal problem is solved using the canonical metric landmarks, the metric landmarks, and landmark
-    weights. The resulting pose transformation matrix is stored and compared using a C++ function.
+    A weighted orthogonal problem is solved between the canonical metric landmarks and the metric landmarks, using the
+    precomputed procrustes_solver. The resulting pose transformation matrix is stored.
 
     The inverse of the pose transformation matrix is calculated to obtain the inverse rotation and translation
     components. The metric landmarks are transformed using the inverse rotation and translation.
 
+    Apart from the depth offset, every step works column by column and the scale estimations only need the landmarks
+    of the Procrustes basis. When landmark_ids is given, only the basis and the requested landmarks are processed
+    (sparse mode), and only the metric coordinates of the requested landmarks are returned.
+
     Parameters:
     -----------
-    screen_landmarks: Transposed face landmarks as a np.ndarray.
+    screen_landmarks: Transposed face landmarks as a np.ndarray (not modified).
     pcf: A Perspective Camera Frustum (PCF) object.
+    landmark_ids: Indexes of the landmarks to convert, optional (default is all the landmarks).
 
     Returns
     -------
-    metric_landmarks: Metric landmarks as a np.ndarray.
+    metric_landmarks: Metric landmarks as a np.ndarray, one column for each requested landmark.
     pose_transform_mat: Pose transformation matrix as a np.ndarray.
 
     """
-    screen_landmarks = project_xy(screen_landmarks, pcf)
-    depth_offset = np.mean(screen_landmarks[2, :])
+    if landmark_ids is None:
+        landmark_ids = np.arange(screen_landmarks.shape[1])
+    basis_ids = procrustes_solver.landmark_ids
+    n_basis = basis_ids.size
+
+    # project_xy scales z by the frustum width at the near plane, and the mean commutes with the scaling
+    depth_offset = np.mean(screen_landmarks[2, :]) * (pcf.right - pcf.left)
+
+    # the first n_basis columns are the landmarks of the Procrustes basis
+    screen_landmarks = project_xy(
+        screen_landmarks[:, np.concatenate((basis_ids, landmark_ids))], pcf
+    )
 
-    intermediate_landmarks = screen_landmarks.copy()
+    intermediate_landmarks = screen_landmarks[:, :n_basis].copy()
     intermediate_landmarks = change_handedness(intermediate_landmarks)
-    first_iteration_scale = estimate_scale(intermediate_landmarks)
+    first_iteration_scale = estimate_basis_scale(intermediate_landmarks)
 
-    intermediate_landmarks = screen_landmarks.copy()
+    intermediate_landmarks = screen_landmarks[:, :n_basis].copy()
     intermediate_landmarks = move_and_rescale_z(
         pcf, depth_offset, first_iteration_scale, intermediate_landmarks
     )
     intermediate_landmarks = unproject_xy(pcf, intermediate_landmarks)
     intermediate_landmarks = change_handedness(intermediate_landmarks)
-    second_iteration_scale = estimate_scale(intermediate_landmarks)
+    second_iteration_scale = estimate_basis_scale(intermediate_landmarks)
 
-    metric_landmarks = screen_landmarks.copy()
+    metric_landmarks = screen_landmarks
     total_scale = first_iteration_scale * second_iteration_scale
     metric_landmarks = move_and_rescale_z(
         pcf, depth_offset, total_scale, metric_landmarks
@@ -2649,22 +2622,74 @@ def get_metric_landmarks(screen_landmarks, pcf):
     metric_landmarks = unproject_xy(pcf, metric_landmarks)
     metric_landmarks = change_handedness(metric_landmarks)
 
-    pose_transform_mat = solve_weighted_orthogonal_problem(
-        canonical_metric_landmarks, metric_landmarks, landmark_weights
-    )
-    cpp_compare("pose_transform_mat", pose_transform_mat)
+    pose_transform_mat = procrustes_solver.solve_basis(metric_landmarks[:, :n_basis])
 
     inv_pose_transform_mat = np.linalg.inv(pose_transform_mat)
     inv_pose_rotation = inv_pose_transform_mat[:3, :3]
     inv_pose_translation = inv_pose_transform_mat[:3, 3]
 
     metric_landmarks = (
-        inv_pose_rotation @ metric_landmarks + inv_pose_translation[:, None]
+        inv_pose_rotation @ metric_landmarks[:, n_basis:]
+        + inv_pose_translation[:, None]
     )
 
     return metric_landmarks, pose_transform_mat
 
 
+def get_pose_transform_batch(screen_landmarks, pcf):
+    """
+    Batched version of the pose estimation of get_metric_landmarks: computes the pose transformation matrix of T
+    faces at once, with every step of get_metric_landmarks applied to the T faces with stacked array operations
+    (the three Procrustes problems of every face are solved by stacked SVDs, see ProcrustesSolver.solve_basis_batch).
+
+    Only the landmarks of the Procrustes basis are processed, besides the mean depth of all the landmarks.
+
+    Parameters:
+    -----------
+    screen_landmarks: Face landmarks of T faces as a np.ndarray of shape (T, N, 3) (not transposed, not modified).
+    pcf: A Perspective Camera Frustum (PCF) object.
+
+    Returns
+    -------
+    pose_transform_mats: Pose transformation matrixes as a np.ndarray of shape (T, 4, 4).
+
+    """
+    screen_landmarks = np.asarray(screen_landmarks, dtype=np.float64)
+    x_scale = pcf.right - pcf.left
+    y_scale = pcf.top - pcf.bottom
+
+    depth_offset = np.mean(screen_landmarks[:, :, 2], axis=1)[:, None] * x_scale
+
+    # (T, 3, n_basis) projected landmarks of the basis, see project_xy
+    basis = screen_landmarks[:, procrustes_solver.landmark_ids, :].transpose(0, 2, 1)
+    projected = np.empty_like(basis)
+    projected[:, 0] = basis[:, 0] * x_scale + pcf.left
+    projected[:, 1] = (1.0 - basis[:, 1]) * y_scale + pcf.bottom
+    projected[:, 2] = basis[:, 2] * x_scale
+
+    def basis_scale(landmarks):
+        transform_mats = procrustes_solver.solve_basis_batch(landmarks)
+        return np.linalg.norm(transform_mats[:, :3, 0], axis=1)[:, None]
+
+    def to_metric(scale):
+        # move_and_rescale_z, unproject_xy and change_handedness of all the faces
+        landmarks = np.empty_like(projected)
+        landmarks[:, 2] = (projected[:, 2] - depth_offset + pcf.near) / scale
+        landmarks[:, :2] = projected[:, :2] * (landmarks[:, 2] / pcf.near)[:, None]
+        landmarks[:, 2] *= -1.0
+        return landmarks
+
+    intermediate_landmarks = projected.copy()
+    intermediate_landmarks[:, 2] *= -1.0
+    first_iteration_scale = basis_scale(intermediate_landmarks)
+
+    second_iteration_scale = basis_scale(to_metric(first_iteration_scale))
+
+    return procrustes_solver.solve_basis_batch(
+        to_metric(first_iteration_scale * second_iteration_scale)
+    )
+
+
 def project_xy(landmarks, pcf):
     """
     This function first calculates the scaling factors and translation values for the x and y axes based on the difference between the pcf
@@ -2732,7 +2757,6 @@ def move_and_rescale_z(pcf, depth_offset, scale, landmarks):
 
     The function first subtracts the depth_offset from the z-coordinate of each landmark. Then, it adds the near clipping plane value from the pcf object to each z-coordinate. Finally, it divides each z-coordinate by the scaling factor.
 
-
     Parameters:
     -----------
     pcf: A Perspective Camera Frustum (PCF) object.
@@ -2788,9 +2812,25 @@ def estimate_scale(landmarks):
     landmarks: Modified landmarks as a np.ndarray.
 
     """
-    transform_mat = solve_weighted_orthogonal_problem(
-        canonical_metric_landmarks, landmarks, landmark_weights
-    )
+    transform_mat = procrustes_solver.solve(landmarks)
+
+    return np.linalg.norm(transform_mat[:, 0])
+
+
+def estimate_basis_scale(basis_landmarks):
+    """
+    Same as estimate_scale, for landmarks already restricted to the Procrustes basis (procrustes_solver.landmark_ids).
+
+    Parameters:
+    -----------
+    basis_landmarks: Landmarks of the Procrustes basis in a 3D space as a np.ndarray.
+
+    Returns
+    -------
+    scale: Estimated scale as a float.
+
+    """
+    transform_mat = procrustes_solver.solve_basis(basis_landmarks)
 
     return np.linalg.norm(transform_mat[:, 0])
 
@@ -2866,20 +2906,14 @@ def internal_solve_weighted_orthogonal_problem(sources, targets, sqrt_weights):
     result: Transformation matrix as a np.ndarray.
 
     """
-    cpp_compare("sources", sources)
-    cpp_compare("targets", targets)
 
     # tranposed(A_w).
     weighted_sources = sources * sqrt_weights[None, :]
     # tranposed(B_w).
     weighted_targets = targets[:, :468] * sqrt_weights[None, :]
 
-    cpp_compare("weighted_sources", weighted_sources)
-    cpp_compare("weighted_targets", weighted_targets)
-
     # w = tranposed(j_w) j_w.
     total_weight = np.sum(sqrt_weights * sqrt_weights)
-    log("total_weight", total_weight)
 
     # Let C = (j_w tranposed(j_w)) / (tranposed(j_w) j_w).
     # Note that C = tranposed(C), hence (I - C) = tranposed(I - C).
@@ -2890,39 +2924,30 @@ def internal_solve_weighted_orthogonal_problem(sources, targets, sqrt_weights):
     # where c_w = tranposed(A_w) j_w / w is a k x 1 vector calculated here:
     twice_weighted_sources = weighted_sources * sqrt_weights[None, :]
     source_center_of_mass = np.sum(twice_weighted_sources, axis=1) / total_weight
-    log("source_center_of_mass", source_center_of_mass)
 
     # tranposed((I - C) A_w) = tranposed(A_w) (I - C) =
     # tranposed(A_w) - tranposed(A_w) C = tranposed(A_w) - c_w tranposed(j_w).
     centered_weighted_sources = weighted_sources - np.matmul(
         source_center_of_mass[:, None], sqrt_weights[None, :]
     )
-    cpp_compare("centered_weighted_sources", centered_weighted_sources)
 
     design_matrix = np.matmul(weighted_targets, centered_weighted_sources.T)
-    cpp_compare("design_matrix", design_matrix)
-    log("design_matrix_norm", np.linalg.norm(design_matrix))
 
     rotation = compute_optimal_rotation(design_matrix)
 
     scale = compute_optimal_scale(
         centered_weighted_sources, weighted_sources, weighted_targets, rotation
     )
-    log("scale", scale)
 
     rotation_and_scale = scale * rotation
 
     pointwise_diffs = weighted_targets - np.matmul(rotation_and_scale, weighted_sources)
-    cpp_compare("pointwise_diffs", pointwise_diffs)
 
     weighted_pointwise_diffs = pointwise_diffs * sqrt_weights[None, :]
-    cpp_compare("weighted_pointwise_diffs", weighted_pointwise_diffs)
 
     translation = np.sum(weighted_pointwise_diffs, axis=1) / total_weight
-    log("translation", translation)
 
     transform_mat = combine_transform_matrix(rotation_and_scale, translation)
-    cpp_compare("transform_mat", transform_mat)
 
     return transform_mat
 
@@ -2962,16 +2987,32 @@ def compute_optimal_rotation(design_matrix):
     if np.linalg.det(postrotation) * np.linalg.det(prerotation) < 0:
         postrotation[:, 2] = -1 * postrotation[:, 2]
 
-    cpp_compare("postrotation", postrotation)
-    cpp_compare("prerotation", prerotation)
-
     rotation = np.matmul(postrotation, prerotation)
 
-    cpp_compare("rotation", rotation)
-
     return rotation
 
 
+def compute_optimal_rotation_batch(design_matrixes):
+    """
+    Batched version of compute_optimal_rotation: a single stacked SVD of T design matrixes.
+
+    Parameters:
+    -----------
+    design_matrixes: Design matrixes as a np.ndarray of shape (T, 3, 3).
+
+    Returns
+    -------
+    rotations: Optimal rotations as a np.ndarray of shape (T, 3, 3).
+
+    """
+    u, _, vh = np.linalg.svd(design_matrixes, full_matrices=True)
+
+    flip = np.linalg.det(u) * np.linalg.det(vh) < 0
+    u[flip, :, 2] *= -1
+
+    return np.matmul(u, vh)
+
+
 def compute_optimal_scale(
     centered_weighted_sources, weighted_sources, weighted_targets, rotation
 ):
@@ -3036,3 +3077,174 @@ def combine_transform_matrix(r_and_s, t):
     result[:3, :3] = r_and_s
     result[:3, 3] = t
     return result
+
+
+class ProcrustesSolver:
+    def __init__(self, source_points, point_weights):
+        """
+        Weighted orthogonal Procrustes solver with a constant set of source points and weights.
+
+        internal_solve_weighted_orthogonal_problem recomputes, at every call, the weighted sources, the total weight,
+        the source center of mass and the centered weighted sources. All of them only depend on the source points and
+        on the weights, so this class computes them once. Moreover, landmarks with a zero weight do not contribute to
+        any of the sums of the problem: the solver only keeps the columns of the landmarks with a non-zero weight
+        (the procrustes_landmark_basis subset) and gives the same transformation matrix as the full problem.
+
+        Parameters:
+        -----------
+        source_points: Source points as a np.ndarray of shape (3, N).
+        point_weights: Point weights as a np.ndarray of shape (N,).
+
+        Methods
+        -------
+        solve: Solves the problem for a full set of target points.
+        solve_basis: Solves the problem for target points already restricted to landmark_ids.
+        solve_basis_batch: Solves the problems of a stack of target points restricted to landmark_ids.
+
+        """
+        # indexes of the landmarks that contribute to the problem
+        self.landmark_ids = np.flatnonzero(point_weights)
+        self.sqrt_weights = extract_square_root(point_weights[self.landmark_ids])
+
+        # tranposed(A_w).
+        self.weighted_sources = (
+            source_points[:, self.landmark_ids] * self.sqrt_weights[None, :]
+        )
+        # w = tranposed(j_w) j_w.
+        self.total_weight = np.sum(self.sqrt_weights * self.sqrt_weights)
+
+        # c_w = tranposed(A_w) j_w / w
+        twice_weighted_sources = self.weighted_sources * self.sqrt_weights[None, :]
+        self.source_center_of_mass = (
+            np.sum(twice_weighted_sources, axis=1) / self.total_weight
+        )
+
+        # tranposed((I - C) A_w) = tranposed(A_w) - c_w tranposed(j_w).
+        self.centered_weighted_sources = self.weighted_sources - np.matmul(
+            self.source_center_of_mass[:, None], self.sqrt_weights[None, :]
+        )
+
+        # tranposed(A_w) j_w, used by the batched translation
+        self.weighted_sources_sum = self.weighted_sources @ self.sqrt_weights
+
+        # denominator of the optimal scale expression
+        self.scale_denominator = np.sum(
+            self.centered_weighted_sources * self.weighted_sources
+        )
+        if self.scale_denominator < 1e-9:
+            print("Scale expression denominator is too small!")
+
+    def solve(self, target_points):
+        """
+        Solves the weighted orthogonal problem for the given target points.
+
+        Parameters:
+        -----------
+        target_points: Target points as a np.ndarray of shape (3, N), with N >= number of source points.
+
+        Returns
+        -------
+        transform_mat: Transformation matrix as a np.ndarray.
+
+        """
+        return self.solve_basis(target_points[:, self.landmark_ids])
+
+    def solve_basis(self, basis_targets):
+        """
+        Solves the weighted orthogonal problem for target points restricted to the landmark_ids columns.
+
+        Parameters:
+        -----------
+        basis_targets: Target points as a np.ndarray of shape (3, len(landmark_ids)).
+
+        Returns
+        -------
+        transform_mat: Transformation matrix as a np.ndarray.
+
+        """
+        # tranposed(B_w).
+        weighted_targets = basis_targets * self.sqrt_weights[None, :]
+
+        design_matrix = np.matmul(weighted_targets, self.centered_weighted_sources.T)
+
+        rotation = compute_optimal_rotation(design_matrix)
+
+        rotated_centered_weighted_sources = np.matmul(
+            rotation, self.centered_weighted_sources
+        )
+        scale = (
+            np.sum(rotated_centered_weighted_sources * weighted_targets)
+            / self.scale_denominator
+        )
+        if scale < 1e-9:
+            print("Scale is too small!")
+
+        rotation_and_scale = scale * rotation
+
+        pointwise_diffs = weighted_targets - np.matmul(
+            rotation_and_scale, self.weighted_sources
+        )
+        weighted_pointwise_diffs = pointwise_diffs * self.sqrt_weights[None, :]
+
+        translation = np.sum(weighted_pointwise_diffs, axis=1) / self.total_weight
+
+        transform_mat = combine_transform_matrix(rotation_and_scale, translation)
+
+        return transform_mat
+
+    def solve_basis_batch(self, basis_targets):
+        """
+        Solves the weighted orthogonal problems of T sets of target points, with stacked matrix products and a single
+        stacked SVD instead of T calls to solve_basis.
+
+        Parameters:
+        -----------
+        basis_targets: Target points as a np.ndarray of shape (T, 3, len(landmark_ids)).
+
+        Returns
+        -------
+        transform_mats: Transformation matrixes as a np.ndarray of shape (T, 4, 4).
+
+        """
+        n_targets = len(basis_targets)
+        weighted_targets = basis_targets * self.sqrt_weights
+
+        # a single (3T x k) @ (k x 3) product for all the design matrixes
+        design_matrixes = (
+            weighted_targets.reshape(-1, self.landmark_ids.size)
+            @ self.centered_weighted_sources.T
+        ).reshape(n_targets, 3, 3)
+
+        rotations = compute_optimal_rotation_batch(design_matrixes)
+
+        # sum(R C_w * B_w) = sum(R * (B_w tranposed(C_w))): the numerator only needs the design matrix
+        scales = (
+            np.einsum("tij,tij->t", rotations, design_matrixes) / self.scale_denominator
+        )
+
+        rotations_and_scales = scales[:, None, None] * rotations
+
+        # sum((B_w - sR A_w) j_w) / w = (B_w j_w - sR tranposed(A_w) j_w) / w
+        translations = (
+            weighted_targets @ self.sqrt_weights
+            - rotations_and_scales @ self.weighted_sources_sum
+        ) / self.total_weight
+
+        transform_mats = np.zeros((len(basis_targets), 4, 4))
+        transform_mats[:, :3, :3] = rotations_and_scales
+        transform_mats[:, :3, 3] = translations
+        transform_mats[:, 3, 3] = 1.0
+
+        return transform_mats
+
+
+# solver of the canonical face model, shared by all the metric landmarks estimations
+procrustes_solver = ProcrustesSolver(canonical_metric_landmarks, landmark_weights)
+
+if DEBUG.get_debug():
+    try:
+        from .face_geometry_validation import install_instrumentation
+    except ImportError:
+        from face_geometry_validation import install_instrumentation
+
+    install_instrumentation(sys.modules[__name__])
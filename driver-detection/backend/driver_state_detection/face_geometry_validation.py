@@ -0,0 +1,293 @@
+"""
+Validation harness for face_geometry against the C++ implementation from github.com/google/mediapipe
+
+The solvers in face_geometry carry no debug code. This module holds instrumented copies of them that log the
+intermediate values and compare every intermediate matrix with the "<name>_cpp.npy" dumps of the C++ solver.
+
+The instrumented solvers are swapped into face_geometry either:
+- at import time, when the FACE_GEOMETRY_DEBUG environment variable is set to 1 (debug builds)
+- explicitly, running this module:
+
+    python face_geometry_validation.py --landmarks screen_landmarks.npy --fixtures path/to/cpp_dumps
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+try:
+    from . import face_geometry
+except ImportError:
+    import face_geometry
+
+# directory containing the "<name>_cpp.npy" C++ dumps
+FIXTURES_DIR = os.environ.get("FACE_GEOMETRY_FIXTURES", ".")
+
+
+def log(name, f):
+    """
+    This function is used to log information during the validation. It allows developers to easily track the flow of
+    the solver and inspect the values of variables at different points.
+
+    Parameters:
+    -----------
+    name: Represents the name of the log as a str.
+    f: Represents the content of the log as an object.
+
+    Returns
+    -------
+
+    """
+    print(f"{name} logged:", f)
+    print()
+
+
+def cpp_compare(name, np_matrix):
+    """
+    This function is used to compare a given matrix with a C++ matrix stored in a file. To ensure correct memory
+    alignment, the C++ matrix is loaded from the file and reshaped into a 2D array. Then, the function calculates the
+    sum of squared differences between the C++ matrix and the first rows and cols of the np_matrix. Finally,
+    the function prints the result of the comparison. Matrices without a C++ dump are skipped.
+
+    Parameters:
+    -----------
+    name: Name of the file as a str.
+    np_matrix: Matrix computed by the python solver as a np.ndarray.
+
+    Returns
+    -------
+
+    """
+    file_path = os.path.join(FIXTURES_DIR, f"{name}_cpp.npy")
+    if not os.path.exists(file_path):
+        return
+
+    # reorder cpp matrix as memory alignment is not correct
+    cpp_matrix = np.load(file_path)
+    rows, cols = cpp_matrix.shape
+    cpp_matrix = np.split(np.reshape(cpp_matrix, -1), cols)
+    cpp_matrix = np.stack(cpp_matrix, 1)
+
+    print(f"{name}:", np.sum(np.abs(cpp_matrix - np_matrix[:rows, :cols]) ** 2))
+    print()
+
+
+def internal_solve_weighted_orthogonal_problem(sources, targets, sqrt_weights):
+    """
+    Instrumented copy of face_geometry.internal_solve_weighted_orthogonal_problem.
+
+    Parameters:
+    -----------
+    sources: Source points as a np.ndarray.
+    targets: Target points as a np.ndarray.
+    sqrt_weights: Square root of weights as a np.ndarray.
+
+    Returns
+    -------
+    result: Transformation matrix as a np.ndarray.
+
+    """
+    cpp_compare("sources", sources)
+    cpp_compare("targets", targets)
+
+    weighted_sources = sources * sqrt_weights[None, :]
+    weighted_targets = targets[:, :468] * sqrt_weights[None, :]
+
+    cpp_compare("weighted_sources", weighted_sources)
+    cpp_compare("weighted_targets", weighted_targets)
+
+    total_weight = np.sum(sqrt_weights * sqrt_weights)
+    log("total_weight", total_weight)
+
+    twice_weighted_sources = weighted_sources * sqrt_weights[None, :]
+    source_center_of_mass = np.sum(twice_weighted_sources, axis=1) / total_weight
+    log("source_center_of_mass", source_center_of_mass)
+
+    centered_weighted_sources = weighted_sources - np.matmul(
+        source_center_of_mass[:, None], sqrt_weights[None, :]
+    )
+    cpp_compare("centered_weighted_sources", centered_weighted_sources)
+
+    design_matrix = np.matmul(weighted_targets, centered_weighted_sources.T)
+    cpp_compare("design_matrix", design_matrix)
+    log("design_matrix_norm", np.linalg.norm(design_matrix))
+
+    rotation = compute_optimal_rotation(design_matrix)
+
+    scale = face_geometry.compute_optimal_scale(
+        centered_weighted_sources, weighted_sources, weighted_targets, rotation
+    )
+    log("scale", scale)
+
+    rotation_and_scale = scale * rotation
+
+    pointwise_diffs = weighted_targets - np.matmul(rotation_and_scale, weighted_sources)
+    cpp_compare("pointwise_diffs", pointwise_diffs)
+
+    weighted_pointwise_diffs = pointwise_diffs * sqrt_weights[None, :]
+    cpp_compare("weighted_pointwise_diffs", weighted_pointwise_diffs)
+
+    translation = np.sum(weighted_pointwise_diffs, axis=1) / total_weight
+    log("translation", translation)
+
+    transform_mat = face_geometry.combine_transform_matrix(
+        rotation_and_scale, translation
+    )
+    cpp_compare("transform_mat", transform_mat)
+
+    return transform_mat
+
+
+def compute_optimal_rotation(design_matrix):
+    """
+    Instrumented copy of face_geometry.compute_optimal_rotation.
+
+    Parameters:
+    -----------
+    design_matrix: Design matrix as a np.ndarray.
+
+    Returns
+    -------
+    rotation: Optimal rotation as a np.ndarray.
+
+    """
+    if np.linalg.norm(design_matrix) < 1e-9:
+        print("Design matrix norm is too small!")
+
+    u, _, vh = np.linalg.svd(design_matrix, full_matrices=True)
+
+    postrotation = u
+    prerotation = vh
+
+    if np.linalg.det(postrotation) * np.linalg.det(prerotation) < 0:
+        postrotation[:, 2] = -1 * postrotation[:, 2]
+
+    cpp_compare("postrotation", postrotation)
+    cpp_compare("prerotation", prerotation)
+
+    rotation = np.matmul(postrotation, prerotation)
+
+    cpp_compare("rotation", rotation)
+
+    return rotation
+
+
+class InstrumentedProcrustesSolver(face_geometry.ProcrustesSolver):
+    """
+    ProcrustesSolver that logs its intermediate values and compares them with the C++ dumps.
+    Only the matrices that do not depend on the landmarks subset (design matrix, rotation and transform) can be
+    compared with the C++ solver, which works on all the 468 landmarks.
+    """
+
+    def solve_basis(self, basis_targets):
+        weighted_targets = basis_targets * self.sqrt_weights[None, :]
+
+        design_matrix = np.matmul(weighted_targets, self.centered_weighted_sources.T)
+        cpp_compare("design_matrix", design_matrix)
+        log("design_matrix_norm", np.linalg.norm(design_matrix))
+
+        rotation = compute_optimal_rotation(design_matrix)
+
+        rotated_centered_weighted_sources = np.matmul(
+            rotation, self.centered_weighted_sources
+        )
+        scale = (
+            np.sum(rotated_centered_weighted_sources * weighted_targets)
+            / self.scale_denominator
+        )
+        log("scale", scale)
+
+        rotation_and_scale = scale * rotation
+
+        pointwise_diffs = weighted_targets - np.matmul(
+            rotation_and_scale, self.weighted_sources
+        )
+        weighted_pointwise_diffs = pointwise_diffs * self.sqrt_weights[None, :]
+
+        translation = np.sum(weighted_pointwise_diffs, axis=1) / self.total_weight
+        log("translation", translation)
+
+        transform_mat = face_geometry.combine_transform_matrix(
+            rotation_and_scale, translation
+        )
+        cpp_compare("transform_mat", transform_mat)
+
+        return transform_mat
+
+
+def install_instrumentation(module=face_geometry):
+    """
+    Replaces the solvers of the face_geometry module with the instrumented ones.
+    Modules importing names from face_geometry after this call get the instrumented solvers.
+
+    Parameters:
+    -----------
+    module: The face_geometry module to instrument.
+
+    Returns
+    -------
+
+    """
+    if getattr(module, "_instrumented", False):
+        return
+
+    get_metric_landmarks = module.get_metric_landmarks
+
+    def instrumented_get_metric_landmarks(*args, **kwargs):
+        metric_landmarks, pose_transform_mat = get_metric_landmarks(*args, **kwargs)
+        cpp_compare("pose_transform_mat", pose_transform_mat)
+        return metric_landmarks, pose_transform_mat
+
+    module.procrustes_solver = InstrumentedProcrustesSolver(
+        module.canonical_metric_landmarks, module.landmark_weights
+    )
+    module.compute_optimal_rotation = compute_optimal_rotation
+    module.internal_solve_weighted_orthogonal_problem = (
+        internal_solve_weighted_orthogonal_problem
+    )
+    module.get_metric_landmarks = instrumented_get_metric_landmarks
+    module.DEBUG.set_debug(True)
+    module._instrumented = True
+
+
+def main():
+    global FIXTURES_DIR
+
+    parser = argparse.ArgumentParser(
+        description="Compare the face geometry solver with the C++ MediaPipe dumps"
+    )
+    parser.add_argument(
+        "--landmarks",
+        type=str,
+        required=True,
+        help="Path to a .npy array of 478x3 normalized screen landmarks",
+    )
+    parser.add_argument(
+        "--fixtures",
+        type=str,
+        default=FIXTURES_DIR,
+        help="Directory of the *_cpp.npy dumps",
+    )
+    parser.add_argument("--frame_width", type=int, default=1080)
+    parser.add_argument("--frame_height", type=int, default=1920)
+    parser.add_argument("--fy", type=float, default=1074.520446598223)
+    args = parser.parse_args()
+
+    FIXTURES_DIR = args.fixtures
+    install_instrumentation()
+
+    screen_landmarks = np.load(args.landmarks)
+    pcf = face_geometry.PCF(
+        frame_height=args.frame_height, frame_width=args.frame_width, fy=args.fy
+    )
+
+    _, pose_transform_mat = face_geometry.get_metric_landmarks(
+        screen_landmarks.T.astype(np.float64), pcf
+    )
+
+    print("pose_transform_mat:\n", pose_transform_mat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import types
+
+import numpy as np
+
+try:
+    from .utils import landmarks_to_array
+except ImportError:
+    from utils import landmarks_to_array
+
+
+class FaceROIDetector:
+    def __init__(self, detector, margin=0.5, min_roi_size=96, max_roi_ratio=0.8):
+        """
+        Face mesh detector that only processes the region of the frame around the face found in the previous frame.
+
+        The region of interest (ROI) is the square around the landmarks bounding box of the previous frame, enlarged
+        by margin times the face size on every side. The detector runs on the crop, and the landmarks are mapped back
+        to normalized coordinates of the full frame, so the cost of the model input conversion scales with the size
+        of the face instead of the resolution of the camera. The full frame is processed when no face was found in
+        the previous frame, when the face is lost in the ROI, or when the ROI would cover most of the frame anyway.
+
+        It can be used everywhere a mediapipe FaceMesh is expected (FrameAnalyzer, LandmarkTracker): process returns
+        the faces as a list of (n_landmarks, 3) arrays instead of NormalizedLandmarkList, which get_landmarks accepts.
+
+        Parameters
+        ----------
+        detector: mediapipe FaceMesh
+            Face mesh model run on the ROI or on the full frame
+        margin: float, optional
+            Space kept around the face bounding box on every side, relative to the face size (default is 0.5)
+        min_roi_size: int, optional
+            Minimum side of the ROI in pixels (default is 96)
+        max_roi_ratio: float, optional
+            Maximum side of the ROI relative to the smallest side of the frame, the full frame is processed above it
+            (default is 0.8)
+
+        Methods
+        ----------
+        - process: same as FaceMesh.process, with the landmarks of the faces in full frame normalized coordinates
+        - reset: forgets the face region, the next frame is processed whole
+        - stats: returns the ROI and full frame counters
+        - close: closes the face mesh detector
+        """
+        self.detector = detector
+        self.margin = margin
+        self.min_roi_size = min_roi_size
+        self.max_roi_ratio = max_roi_ratio
+
+        self.roi_frames = 0
+        self.full_frames = 0
+        self.fallbacks = 0
+        self.roi_area = 0.0
+        self.reset()
+
+    def reset(self):
+        # (x0, y0, x1, y1) pixel region of the next frame, None for the full frame
+        self.roi = None
+
+    def stats(self):
+        return {
+            "roi_frames": self.roi_frames,
+            "full_frames": self.full_frames,
+            "fallbacks": self.fallbacks,
+            "avg_roi_area": (
+                round(self.roi_area / self.roi_frames, 3) if self.roi_frames else None
+            ),
+        }
+
+    def close(self):
+        self.detector.close()
+
+    def process(self, image):
+        """
+        Finds the face landmarks of the image
+
+        Parameters
+        ----------
+        image: numpy array
+            3 channels image given to the face mesh detector
+
+        Returns
+        --------
+        results: object
+            multi_face_landmarks attribute: list of (n_landmarks, 3) float32 landmarks arrays of the faces, in
+            normalized coordinates of the whole image, None if no face was found
+        """
+        height, width = image.shape[:2]
+
+        if self.roi is not None:
+            x0, y0, x1, y1 = self.roi
+            # the crop copy is the only full resolution work left, and it is proportional to the ROI
+            crop = np.ascontiguousarray(image[y0:y1, x0:x1])
+            lms = self.detector.process(crop).multi_face_landmarks
+            if lms:
+                faces = landmarks_to_array(lms)
+                # x, y (and z, on the scale of x) from the crop to the full frame
+                faces *= np.array(
+                    [(x1 - x0) / width, (y1 - y0) / height, (x1 - x0) / width],
+                    dtype=np.float32,
+                )
+                faces += np.array([x0 / width, y0 / height, 0.0], dtype=np.float32)
+                self.roi_frames += 1
+                self.roi_area += (x1 - x0) * (y1 - y0) / (width * height)
+                self._update_roi(faces, width, height)
+                return types.SimpleNamespace(multi_face_landmarks=list(faces))
+
+            # the face left the ROI: look for it in the whole frame
+            self.fallbacks += 1
+
+        self.full_frames += 1
+        lms = self.detector.process(image).multi_face_landmarks
+        if not lms:
+            self.reset()
+            return types.SimpleNamespace(multi_face_landmarks=None)
+
+        faces = landmarks_to_array(lms)
+        self._update_roi(faces, width, height)
+        return types.SimpleNamespace(multi_face_landmarks=list(faces))
+
+    def _update_roi(self, faces, width, height):
+        xy = np.clip(faces[:, :, :2], 0.0, 1.0) * (width, height)
+        lows, highs = xy.min(axis=1), xy.max(axis=1)
+        # the biggest face, like get_landmarks
+        extent = highs - lows
+        face = np.argmax(extent[:, 0] * extent[:, 1])
+        (left, top), (right, bottom) = lows[face], highs[face]
+
+        size = max(right - left, bottom - top) * (1 + 2 * self.margin)
+        size = int(np.ceil(max(size, self.min_roi_size)))
+        if size > self.max_roi_ratio * min(width, height):
+            self.roi = None
+            return
+
+        # square ROI centered on the face, shifted inside the frame
+        x0 = int(round((left + right - size) / 2))
+        y0 = int(round((top + bottom - size) / 2))
+        x0 = min(max(x0, 0), width - size)
+        y0 = min(max(y0, 0), height - size)
+        self.roi = (x0, y0, x0 + size, y0 + size)
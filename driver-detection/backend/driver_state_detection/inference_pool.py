@@ -0,0 +1,426 @@
+import itertools
+import multiprocessing as mp
+import queue
+import threading
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+try:
+    from .landmark_tracker import LandmarkTracker, get_tracked_lms_ids
+except ImportError:
+    from landmark_tracker import LandmarkTracker, get_tracked_lms_ids
+
+
+def _worker_main(requests, results, analyzer_factory):
+    """
+    Inference worker process: owns one FrameAnalyzer (face mesh model, estimators and scorer state) per attached
+    stream and analyzes the frames written by the parent process in the stream shared memory ring.
+    The frames are only read: nothing but the landmarks, the metrics and the head pose is sent back, with the
+    sequence number of the frame request.
+    """
+    streams = {}
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+
+        kind, stream_id = message[0], message[1]
+        try:
+            if kind == "attach":
+                shm_name, n_slots, frame_shape, detect_interval = message[2:]
+                shm = shared_memory.SharedMemory(name=shm_name)
+                frames = np.ndarray(
+                    (n_slots,) + frame_shape, dtype=np.uint8, buffer=shm.buf
+                )
+                analyzer = (
+                    streams[stream_id][2]
+                    if stream_id in streams
+                    else analyzer_factory()
+                )
+                if detect_interval > 1:
+                    analyzer.tracker = LandmarkTracker(
+                        analyzer.detector,
+                        tracked_ids=get_tracked_lms_ids(
+                            analyzer.eye_det, analyzer.head_pose
+                        ),
+                        detect_interval=detect_interval,
+                    )
+                else:
+                    analyzer.tracker = None
+                if stream_id in streams:
+                    _release_ring(streams[stream_id])
+                streams[stream_id] = (shm, frames, analyzer)
+
+            elif kind == "analyze":
+                seq, slot, t_now = message[2:]
+                _, frames, analyzer = streams[stream_id]
+                cpu_start = time.thread_time()
+                landmarks, metrics = analyzer.analyze(frames[slot], t_now)
+                cpu_time = time.thread_time() - cpu_start
+                tracker_stats = (
+                    analyzer.tracker.stats() if analyzer.tracker is not None else None
+                )
+                results.put(
+                    (
+                        stream_id,
+                        seq,
+                        landmarks,
+                        metrics,
+                        analyzer.pose,
+                        cpu_time,
+                        tracker_stats,
+                        None,
+                    )
+                )
+
+            elif kind == "detach":
+                stream = streams.pop(stream_id, None)
+                if stream is not None:
+                    _release_ring(stream)
+                    stream[2].detector.close()
+
+        except Exception:
+            seq = message[2] if kind == "analyze" else None
+            results.put(
+                (stream_id, seq, None, None, None, 0.0, None, traceback.format_exc())
+            )
+
+    for stream in streams.values():
+        _release_ring(stream)
+
+
+def _release_ring(stream):
+    shm, frames, _ = stream
+    del frames
+    shm.close()
+
+
+class InferenceWorkerPool:
+    def __init__(self, analyzer_factory, n_workers=None, start_method="spawn"):
+        """
+        Pool of inference worker processes, so that the face mesh model and the geometry code of several streams
+        run on several cores instead of sharing the GIL of a single process.
+
+        Every worker process owns the analyzers (face mesh model, EyeDetector, HeadPoseEstimator and
+        AttentionScorer) of the streams attached to it: a stream is bound to one worker, which keeps its scorer
+        and tracking state across frames. Frames reach the workers through a shared memory ring of the stream,
+        only the slot index goes through the request queue, and only the landmarks, the metrics and the head pose
+        come back.
+
+        Parameters
+        ----------
+        analyzer_factory: callable
+            Picklable function without arguments returning a new FrameAnalyzer, called in the worker processes
+        n_workers: int, optional
+            Number of worker processes (default is the number of CPUs)
+        start_method: str, optional
+            multiprocessing start method of the workers (default is "spawn": forking a process that runs
+            camera and encoder threads is not safe)
+
+        Methods
+        ----------
+        - attach: returns a RemoteAnalyzer running the frames of a new stream on the least loaded worker
+        - close: stops the workers
+        - stats: returns the streams and processed frames of every worker
+        """
+        context = mp.get_context(start_method)
+        self.n_workers = n_workers or mp.cpu_count()
+        self.requests = [context.Queue() for _ in range(self.n_workers)]
+        self.results = [context.Queue() for _ in range(self.n_workers)]
+        self.processes = [
+            context.Process(
+                target=_worker_main,
+                args=(
+                    self.requests[worker_id],
+                    self.results[worker_id],
+                    analyzer_factory,
+                ),
+                name=f"inference-{worker_id}",
+                daemon=True,
+            )
+            for worker_id in range(self.n_workers)
+        ]
+        for process in self.processes:
+            process.start()
+
+        # RemoteAnalyzer of every attached stream, by stream id
+        self.streams = {}
+        self.worker_frames = [0] * self.n_workers
+        self.worker_cpu_time = [0.0] * self.n_workers
+        self._stream_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._dispatchers = [
+            threading.Thread(
+                target=self._dispatch_results,
+                args=(worker_id,),
+                name=f"inference-results-{worker_id}",
+                daemon=True,
+            )
+            for worker_id in range(self.n_workers)
+        ]
+        for dispatcher in self._dispatchers:
+            dispatcher.start()
+
+    def attach(self, detect_interval=1, n_slots=2):
+        """
+        Binds a new stream to the worker with the fewest streams
+
+        Parameters
+        ----------
+        detect_interval: int, optional
+            If > 1, the worker tracks the landmarks with optical flow between detections (default is 1)
+        n_slots: int, optional
+            Number of frames of the stream shared memory ring, i.e. of frames in flight (default is 2)
+
+        Returns
+        --------
+        analyzer: RemoteAnalyzer
+        """
+        with self._lock:
+            loads = [0] * self.n_workers
+            for stream in self.streams.values():
+                loads[stream.worker_id] += 1
+            worker_id = int(np.argmin(loads))
+            stream = RemoteAnalyzer(
+                self, next(self._stream_ids), worker_id, detect_interval, n_slots
+            )
+            self.streams[stream.stream_id] = stream
+        return stream
+
+    def _detach(self, stream):
+        with self._lock:
+            self.streams.pop(stream.stream_id, None)
+        self.requests[stream.worker_id].put(("detach", stream.stream_id))
+
+    def _dispatch_results(self, worker_id):
+        results = self.results[worker_id]
+        while True:
+            message = results.get()
+            if message is None:
+                break
+            stream_id, _, _, _, _, cpu_time, _, _ = message
+            self.worker_frames[worker_id] += 1
+            self.worker_cpu_time[worker_id] += cpu_time
+            stream = self.streams.get(stream_id)
+            if stream is not None:
+                stream.results.put(message)
+
+    def close(self, timeout=5.0):
+        for stream in list(self.streams.values()):
+            stream.close()
+        for requests in self.requests:
+            requests.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        for results in self.results:
+            results.put(None)
+        for dispatcher in self._dispatchers:
+            dispatcher.join(timeout)
+
+    def stats(self):
+        loads = [0] * self.n_workers
+        for stream in list(self.streams.values()):
+            loads[stream.worker_id] += 1
+        return {
+            "workers": [
+                {
+                    "pid": process.pid,
+                    "alive": process.is_alive(),
+                    "streams": loads[worker_id],
+                    "frames": self.worker_frames[worker_id],
+                    "cpu_time_s": round(self.worker_cpu_time[worker_id], 3),
+                }
+                for worker_id, process in enumerate(self.processes)
+            ]
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RemoteAnalyzer:
+    def __init__(
+        self, pool, stream_id, worker_id, detect_interval=1, n_slots=2, timeout=10.0
+    ):
+        """
+        Stand-in for a FrameAnalyzer whose frames are analyzed by a worker process of an InferenceWorkerPool.
+        It can be given to a ThreadedPipeline like a FrameAnalyzer.
+
+        The shared memory ring is allocated on the first frame, sized to its resolution. Frames are copied into a
+        free slot of the ring, which is free again as soon as the worker has analyzed it. Every frame request has a
+        sequence number, echoed in its result, so that the late result of a frame given up after a timeout is
+        discarded (and frees its slot) instead of being taken for the result of a later frame.
+
+        Methods
+        ----------
+        - analyze: same as FrameAnalyzer.analyze, blocks until the worker is done
+        - submit / collect: pipelined version of analyze, up to n_slots frames in flight
+        - close: releases the stream worker state and its shared memory
+
+        A worker that does not answer within timeout seconds, crashed or failed on a frame makes analyze raise a
+        RuntimeError, the next frames can still be analyzed.
+        """
+        self.pool = pool
+        self.stream_id = stream_id
+        self.worker_id = worker_id
+        self.detect_interval = detect_interval
+        self.n_slots = n_slots
+        self.timeout = timeout
+        # the landmark tracker, if any, lives in the worker: its stats come back with the results
+        self.tracker = None
+        self.tracker_stats = None
+        self.cpu_time = 0.0
+        # (rvec, tvec) head pose of the last collected frame, like FrameAnalyzer.pose
+        self.pose = None
+
+        self.results = queue.Queue()
+        self.shm = None
+        self.frames = None
+        self._seqs = itertools.count()
+        # (seq, slot) of the frames sent to the worker, oldest first
+        self._in_flight = []
+        self._free_slots = []
+        # slot by seq of the frames given up while the worker may still read them
+        self._abandoned = {}
+        # results received before their frame was collected, by seq
+        self._done = {}
+
+    def _ensure_ring(self, frame_shape):
+        if self.frames is not None and self.frames.shape[1:] == frame_shape:
+            return
+        if self._in_flight:
+            raise RuntimeError(
+                "Cannot change the frame resolution with frames in flight"
+            )
+        self._release_ring()
+        # the late results of the previous ring do not free slots of the new one
+        self._abandoned.clear()
+
+        size = self.n_slots * int(np.prod(frame_shape))
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.frames = np.ndarray(
+            (self.n_slots,) + frame_shape, dtype=np.uint8, buffer=self.shm.buf
+        )
+        self._free_slots = list(range(self.n_slots))
+        self.pool.requests[self.worker_id].put(
+            (
+                "attach",
+                self.stream_id,
+                self.shm.name,
+                self.n_slots,
+                frame_shape,
+                self.detect_interval,
+            )
+        )
+
+    def submit(self, frame, t_now):
+        """Copies the frame in a free slot of the ring and sends it to the worker"""
+        self._ensure_ring(frame.shape)
+        if not self._free_slots and self._abandoned:
+            # the slots of frames given up after a timeout are free once the worker answers
+            try:
+                while not self._free_slots:
+                    self._receive(self.timeout)
+            except queue.Empty:
+                pass
+        if not self._free_slots:
+            self._check_worker()
+            raise RuntimeError(f"More than {self.n_slots} frames in flight")
+        slot = self._free_slots.pop()
+        np.copyto(self.frames[slot], frame)
+        seq = next(self._seqs)
+        self._in_flight.append((seq, slot))
+        self.pool.requests[self.worker_id].put(
+            ("analyze", self.stream_id, seq, slot, t_now)
+        )
+
+    def _receive(self, timeout):
+        """Waits for the next result of the worker (raises queue.Empty on timeout)"""
+        message = self.results.get(timeout=timeout)
+        seq = message[1]
+        if seq in self._abandoned:
+            self._free_slots.append(self._abandoned.pop(seq))
+        elif seq is None or any(seq == pending for pending, _ in self._in_flight):
+            # seq is None for the failure of a ring attach: reported to the oldest frame
+            self._done[seq] = message
+        # else: late result of a frame of a previous ring
+
+    def _check_worker(self):
+        process = self.pool.processes[self.worker_id]
+        if not process.is_alive():
+            raise RuntimeError(
+                f"Inference worker {self.worker_id} crashed (exit code {process.exitcode})"
+            )
+
+    def _abandon_oldest(self):
+        # the worker may still read the frame: its slot is freed by its late result
+        seq, slot = self._in_flight.pop(0)
+        self._abandoned[seq] = slot
+
+    def collect(self, timeout=None):
+        """
+        Waits for the results of the oldest frame in flight
+
+        Returns
+        --------
+        landmarks: numpy array or None
+        metrics: dict or None
+        """
+        seq, slot = self._in_flight[0]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while seq not in self._done and None not in self._done:
+            try:
+                self._receive(
+                    None if deadline is None else max(deadline - time.monotonic(), 0)
+                )
+            except queue.Empty:
+                self._abandon_oldest()
+                self._check_worker()
+                raise RuntimeError(
+                    f"Inference worker {self.worker_id} did not answer in {timeout}s"
+                )
+
+        if seq not in self._done:
+            self._abandon_oldest()
+            error = self._done.pop(None)[-1]
+            raise RuntimeError(f"Inference worker {self.worker_id} failed:\n{error}")
+
+        message = self._done.pop(seq)
+        _, _, landmarks, metrics, pose, cpu_time, tracker_stats, error = message
+        self._in_flight.pop(0)
+        self._free_slots.append(slot)
+        if error is not None:
+            raise RuntimeError(f"Inference worker {self.worker_id} failed:\n{error}")
+
+        self.cpu_time += cpu_time
+        self.tracker_stats = tracker_stats
+        self.pose = pose
+        return landmarks, metrics
+
+    def analyze(self, frame, t_now, gray_1ch=None, gray=None):
+        """
+        Same as FrameAnalyzer.analyze. Only the 3 channels grayscale frame is sent to the worker when given (it may
+        have a lower inference resolution), else the worker computes it from the frame
+        """
+        self.submit(frame if gray is None else gray, t_now)
+        return self.collect(self.timeout)
+
+    def _release_ring(self):
+        if self.shm is not None:
+            self.frames = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def close(self):
+        self.pool._detach(self)
+        # the worker may still map the ring: unlinking only removes its name
+        self._release_ring()
@@ -0,0 +1,191 @@
+import cv2
+import numpy as np
+
+try:
+    from .utils import get_landmarks
+except ImportError:
+    from utils import get_landmarks
+
+
+def get_tracked_lms_ids(eye_det, head_pose):
+    """
+    Landmarks needed by the eye detector and the head pose estimator: eye keypoints, iris centers
+    and head pose model landmarks
+
+    :param eye_det: EyeDetector object
+    :param head_pose: HeadPoseEstimator object
+    :return: tracked_ids
+        Sorted list of landmark indexes
+    """
+    return sorted(
+        set(
+            eye_det.EYES_LMS_NUMS
+            + [eye_det.LEFT_IRIS_NUM, eye_det.RIGHT_IRIS_NUM]
+            + head_pose.model_lms_ids
+        )
+    )
+
+
+class LandmarkTracker:
+    def __init__(
+        self,
+        detector,
+        tracked_ids,
+        detect_interval=5,
+        min_confidence=0.8,
+        max_fb_error=1.0,
+        win_size=(21, 21),
+        max_level=3,
+    ):
+        """
+        Face landmarks source that runs the face mesh detector only every detect_interval frames and, in between,
+        tracks the landmarks with pyramidal Lucas-Kanade optical flow on the grayscale frame.
+
+        Only the tracked_ids landmarks (the ones used downstream) are tracked. The other landmarks are moved with the
+        similarity transform that best fits the tracked points, so a full landmarks array is returned every frame.
+        The tracking confidence is the fraction of tracked points that pass the forward-backward check: when it
+        drops under min_confidence, the detector runs again.
+
+        Parameters
+        ----------
+        detector: mediapipe FaceMesh
+            Face mesh model used to (re)detect the face landmarks
+        tracked_ids: list of int
+            Indexes of the landmarks tracked with optical flow
+        detect_interval: int, optional
+            Number of frames between two detections (default is 5, 1 means detection on every frame)
+        min_confidence: float, optional
+            Minimum fraction of correctly tracked points to keep tracking (default is 0.8)
+        max_fb_error: float, optional
+            Maximum forward-backward optical flow error in pixels of a correctly tracked point (default is 1.0)
+        win_size: tuple, optional
+            Search window size of the optical flow at each pyramid level (default is (21, 21))
+        max_level: int, optional
+            Maximal pyramid level of the optical flow (default is 3)
+
+        Methods
+        ----------
+        - process: returns the landmarks of the frame, detected or tracked
+        - reset: forgets the tracked face, the next frame is detected
+        - stats: returns detection and tracking counters
+        """
+        self.detector = detector
+        self.tracked_ids = np.asarray(tracked_ids)
+        self.detect_interval = detect_interval
+        self.min_confidence = min_confidence
+        self.max_fb_error = max_fb_error
+        self.lk_params = dict(
+            winSize=win_size,
+            maxLevel=max_level,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03),
+        )
+
+        self.confidence = 0.0
+        self.detections = 0
+        self.tracked_frames = 0
+        self.reset()
+
+    def reset(self):
+        self.prev_gray = None
+        self.prev_landmarks = None
+        self.frames_since_detection = 0
+
+    def stats(self):
+        return {
+            "detect_interval": self.detect_interval,
+            "detections": self.detections,
+            "tracked_frames": self.tracked_frames,
+            "confidence": round(float(self.confidence), 3),
+        }
+
+    def process(self, frame, gray):
+        """
+        Gets the face landmarks of the frame
+
+        Parameters
+        ----------
+        frame: numpy array
+            3 channels image given to the face mesh detector
+        gray: numpy array
+            Single channel grayscale version of the frame, used for the optical flow
+
+        Returns
+        --------
+        landmarks: numpy array or None
+            478 face mesh landmarks of the face, None if no face was found
+        """
+        if (
+            self.prev_landmarks is None
+            or self.frames_since_detection + 1 >= self.detect_interval
+        ):
+            return self._detect(frame, gray)
+
+        landmarks = self._track(gray)
+        if landmarks is None:
+            return self._detect(frame, gray)
+        return landmarks
+
+    def _detect(self, frame, gray):
+        self.detections += 1
+        lms = self.detector.process(frame).multi_face_landmarks
+        if not lms:
+            self.reset()
+            return None
+
+        landmarks = get_landmarks(lms)
+        self._store(gray, landmarks)
+        self.frames_since_detection = 0
+        self.confidence = 1.0
+        return landmarks
+
+    def _track(self, gray):
+        frame_size = np.array((gray.shape[1], gray.shape[0]), dtype=np.float32)
+
+        prev_pts = (self.prev_landmarks[self.tracked_ids, :2] * frame_size).reshape(
+            -1, 1, 2
+        )
+        next_pts, status, _ = cv2.calcOpticalFlowPyrLK(
+            self.prev_gray, gray, prev_pts, None, **self.lk_params
+        )
+        back_pts, back_status, _ = cv2.calcOpticalFlowPyrLK(
+            gray, self.prev_gray, next_pts, None, **self.lk_params
+        )
+
+        fb_error = np.linalg.norm((back_pts - prev_pts).reshape(-1, 2), axis=1)
+        good = (
+            (status.ravel() == 1)
+            & (back_status.ravel() == 1)
+            & (fb_error < self.max_fb_error)
+        )
+        self.confidence = good.mean()
+        if self.confidence < self.min_confidence:
+            return None
+
+        # similarity transform (rotation, scale, translation) of the face between the two frames
+        transform, _ = cv2.estimateAffinePartial2D(prev_pts[good], next_pts[good])
+        if transform is None:
+            return None
+
+        landmarks = self.prev_landmarks.copy()
+        all_pts = landmarks[:, :2] * frame_size
+        landmarks[:, :2] = (all_pts @ transform[:, :2].T + transform[:, 2]) / frame_size
+        # z is on the scale of x: it follows the scale of the face
+        landmarks[:, 2] *= np.hypot(*transform[:, 0])
+
+        # correctly tracked points keep their own optical flow position
+        tracked_ids = self.tracked_ids[good]
+        landmarks[tracked_ids, :2] = next_pts.reshape(-1, 2)[good] / frame_size
+        np.clip(landmarks[:, :2], 0.0, 1.0, out=landmarks[:, :2])
+
+        self._store(gray, landmarks)
+        self.frames_since_detection += 1
+        self.tracked_frames += 1
+        return landmarks
+
+    def _store(self, gray, landmarks):
+        # the caller may reuse the frame buffer: keep a private copy for the next optical flow
+        if self.prev_gray is None or self.prev_gray.shape != gray.shape:
+            self.prev_gray = gray.copy()
+        else:
+            np.copyto(self.prev_gray, gray)
+        self.prev_landmarks = landmarks
@@ -1,5 +1,9 @@
-import time
+import json
 import pprint
+import signal
+import socket
+import sys
+import time
 
 import cv2
 import mediapipe as mp
@@ -7,20 +11,83 @@ import numpy as np
 
 from attention_scorer import AttentionScorer as AttScorer
 from eye_detector import EyeDetector as EyeDet
+from face_roi import FaceROIDetector
+from landmark_tracker import LandmarkTracker, get_tracked_lms_ids
 from parser import get_args
 from pose_estimation import HeadPoseEstimator as HeadPoseEst
-from utils import get_landmarks, load_camera_parameters
+from preprocessing import FramePreprocessor
+from utils import fit_resolution, get_landmarks, load_camera_parameters
+
+# initial rolling PERCLOS buffer size: headless mode skips the display and runs well above the camera frame rate
+HEADLESS_MAX_FPS = 240
+
+
+class MetricsOutput:
+    def __init__(self, target="-"):
+        """
+        Destination of the per-frame metrics in headless mode, one JSON object per line
+
+        Parameters
+        ----------
+        target: str, optional
+            "-" for the standard output, or udp://HOST:PORT to send every line as a datagram to a local socket,
+            which never blocks the capture loop when nobody listens (default is "-")
+
+        Methods
+        ----------
+        - write: sends the metrics of a frame, returns False when the reader went away
+        - close: closes the socket
+        """
+        self.sock = None
+        self.address = None
+        if target != "-":
+            if not target.startswith("udp://"):
+                raise ValueError(f"Unsupported metrics output: {target}")
+            host, _, port = target[len("udp://") :].rpartition(":")
+            self.address = (host or "127.0.0.1", int(port))
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def write(self, metrics):
+        line = json.dumps(metrics, separators=(",", ":"))
+        if self.sock is not None:
+            try:
+                self.sock.sendto(line.encode() + b"\n", self.address)
+            except OSError:
+                # nobody listening (ICMP port unreachable), the next frames are sent anyway
+                pass
+            return True
+        try:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+        except BrokenPipeError:
+            return False
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+def _to_float(value, digits):
+    """Rounded float of a score or of a (1,) angle array, None if missing"""
+    if value is None:
+        return None
+    return round(float(np.ravel(value)[0]), digits)
 
 
 def main():
     args = get_args()
 
+    # in headless mode the standard output may carry the metrics, messages go to stderr
+    log = sys.stderr if args.headless else sys.stdout
+
     if not cv2.useOptimized():
         try:
             cv2.setUseOptimized(True)  # set OpenCV optimization to True
         except Exception as e:
             print(
-                f"OpenCV optimization could not be set to True, the script may be slower than expected.\nError: {e}"
+                f"OpenCV optimization could not be set to True, the script may be slower than expected.\nError: {e}",
+                file=log,
             )
 
     if args.camera_params:
@@ -29,13 +96,13 @@ def main():
         camera_matrix, dist_coeffs = None, None
 
     if args.verbose:
-        print("Arguments and Parameters used:\n")
-        pprint.pp(vars(args), indent=4)
-        print("\nCamera Matrix:")
-        pprint.pp(camera_matrix, indent=4)
-        print("\nDistortion Coefficients:")
-        pprint.pp(dist_coeffs, indent=4)
-        print("\n")
+        print("Arguments and Parameters used:\n", file=log)
+        pprint.pp(vars(args), indent=4, stream=log)
+        print("\nCamera Matrix:", file=log)
+        pprint.pp(camera_matrix, indent=4, stream=log)
+        print("\nDistortion Coefficients:", file=log)
+        pprint.pp(dist_coeffs, indent=4, stream=log)
+        print("\n", file=log)
 
     """instantiation of mediapipe face mesh model. This model give back 478 landmarks
     if the rifine_landmarks parameter is set to True. 468 landmarks for the face and
@@ -47,14 +114,31 @@ def main():
         min_tracking_confidence=0.5,
         refine_landmarks=True,
     )
+    # optional cropping of the frames to the face region before the face mesh model
+    if args.face_roi:
+        Detector = FaceROIDetector(Detector)
 
     # instantiation of the Eye Detector and Head Pose estimator objects
-    Eye_det = EyeDet(show_processing=args.show_eye_proc)
+    Eye_det = EyeDet(show_processing=args.show_eye_proc and not args.headless)
 
     Head_pose = HeadPoseEst(
-        show_axis=args.show_axis, camera_matrix=camera_matrix, dist_coeffs=dist_coeffs
+        show_axis=args.show_axis and not args.headless,
+        camera_matrix=camera_matrix,
+        dist_coeffs=dist_coeffs,
+        pose_mode=args.pose_mode,
+        temporal=args.temporal_pose,
     )
 
+    # optional optical flow tracking of the landmarks between two face mesh detections
+    if args.detect_interval > 1:
+        Tracker = LandmarkTracker(
+            Detector,
+            tracked_ids=get_tracked_lms_ids(Eye_det, Head_pose),
+            detect_interval=args.detect_interval,
+        )
+    else:
+        Tracker = None
+
     # timing variables
     prev_time = time.perf_counter()
     fps = 0.0  # Initial FPS value
@@ -73,18 +157,37 @@ def main():
         ear_time_thresh=args.ear_time_thresh,
         gaze_thresh=args.gaze_thresh,
         pose_time_thresh=args.pose_time_thresh,
-        verbose=args.verbose,
+        max_fps=HEADLESS_MAX_FPS if args.headless else 60,
+        verbose=args.verbose and not args.headless,
     )
 
     # capture the input from the default system camera (camera number 0)
     cap = cv2.VideoCapture(args.camera)
     if not cap.isOpened():  # if the camera can't be opened exit the program
-        print("Cannot open camera")
+        print("Cannot open camera", file=log)
         exit()
+    if args.capture_size is not None:
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, args.capture_size[0])
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, args.capture_size[1])
+
+    # headless mode: no window, the loop stops at the end of the stream or on Ctrl+C
+    Metrics_out = MetricsOutput(args.metrics_output) if args.headless else None
+    stop = []
+    if args.headless:
+        signal.signal(signal.SIGINT, lambda *_: stop.append(True))
+    frame_id = 0
+
+    # if the frame comes from webcam, flip it so it looks like a mirror.
+    # the preprocessing buffers are allocated once, the grayscale ones at the inference resolution
+    Preprocessor = FramePreprocessor(
+        flip=args.camera == 0, inference_size=args.inference_size
+    )
+    captured = None
+    displayed = None
 
     # time.sleep(0.01)  # To prevent zero division error when calculating the FPS
 
-    while True:  # infinite loop for webcam video capture
+    while not stop:  # infinite loop for webcam video capture
         # get current time in seconds
         t_now = time.perf_counter()
 
@@ -96,41 +199,34 @@ def main():
         if elapsed_time > 0:
             fps = np.round(1 / elapsed_time, 3)
 
-        ret, frame = cap.read()  # read a frame from the webcam
+        # read a frame from the webcam, reusing the buffer of the previous one
+        ret, captured = cap.read(captured)
 
         if not ret:  # if a frame can't be read, exit the program
-            print("Can't receive frame from camera/stream end")
+            print("Can't receive frame from camera/stream end", file=log)
             break
 
-        # if the frame comes from webcam, flip it so it looks like a mirror.
-        if args.camera == 0:
-            frame = cv2.flip(frame, 2)
-
         # start the tick counter for computing the processing time for each frame
         e1 = cv2.getTickCount()
 
-        # transform the BGR frame in grayscale
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        # mirror the frame, transform it in grayscale and create a 3D matrix from the gray image to give it to the model
+        frame, gray_1ch, gray = Preprocessor.process(captured)
 
         # get the frame size
         frame_size = frame.shape[1], frame.shape[0]
 
-        # apply a bilateral filter to lower noise but keep frame details. create a 3D matrix from gray image to give it to the model
-        # gray = cv2.bilateralFilter(gray, 5, 10, 10)
-        gray = np.expand_dims(gray, axis=2)
-        gray = np.concatenate([gray, gray, gray], axis=2)
-
-        # find the faces using the face mesh model
-        lms = Detector.process(gray).multi_face_landmarks
-
-        if lms:  # process the frame only if at least a face is found
+        # find the faces using the face mesh model, or track the landmarks of the last detected face
+        if Tracker is not None:
+            landmarks = Tracker.process(gray, gray_1ch)
+        else:
+            lms = Detector.process(gray).multi_face_landmarks
             # getting face landmarks and then take only the bounding box of the biggest face
-            landmarks = get_landmarks(lms)
+            landmarks = get_landmarks(lms) if lms else None
 
-            # shows the eye keypoints (can be commented)
-            Eye_det.show_eye_keypoints(
-                color_frame=frame, landmarks=landmarks, frame_size=frame_size
-            )
+        ear = gaze = perclos_score = roll = pitch = yaw = rvec = tvec = None
+        tired = asleep = looking_away = distracted = False
+
+        if landmarks is not None:  # process the frame only if at least a face is found
 
             # compute the EAR score of the eyes
             ear = Eye_det.get_EAR(landmarks=landmarks)
@@ -141,12 +237,12 @@ def main():
 
             # compute the Gaze Score
             gaze = Eye_det.get_Gaze_Score(
-                frame=gray, landmarks=landmarks, frame_size=frame_size
+                frame=gray, landmarks=landmarks, frame_size=(gray.shape[1], gray.shape[0])
             )
 
-            # compute the head pose
-            frame_det, roll, pitch, yaw = Head_pose.get_pose(
-                frame=frame, landmarks=landmarks, frame_size=frame_size
+            # compute the head pose, at the capture resolution the camera parameters are calibrated for
+            rvec, tvec, roll, pitch, yaw = Head_pose.estimate_pose(
+                landmarks=landmarks, frame_size=frame_size
             )
 
             # evaluate the scores for EAR, GAZE and HEAD POSE
@@ -159,9 +255,58 @@ def main():
                 head_yaw=yaw,
             )
 
+        else:
+            # the face is lost: the next head pose is solved from scratch
+            Head_pose.reset()
+
+        if args.headless:
+            # metrics only: nothing is drawn or displayed
+            proc_time_frame_ms = (
+                (cv2.getTickCount() - e1) / cv2.getTickFrequency()
+            ) * 1000
+            written = Metrics_out.write(
+                {
+                    "frame": frame_id,
+                    "t": round(t_now, 4),
+                    "face_detected": landmarks is not None,
+                    "ear": _to_float(ear, 3),
+                    "gaze": _to_float(gaze, 3),
+                    "perclos": _to_float(perclos_score, 3),
+                    "roll": _to_float(roll, 1),
+                    "pitch": _to_float(pitch, 1),
+                    "yaw": _to_float(yaw, 1),
+                    "tired": bool(tired),
+                    "asleep": bool(asleep),
+                    "looking_away": bool(looking_away),
+                    "distracted": bool(distracted),
+                    "fps": float(fps),
+                    "proc_time_ms": round(proc_time_frame_ms, 2),
+                }
+            )
+            frame_id += 1
+            if not written:
+                break
+            continue
+
+        # the overlays are drawn at the display resolution
+        display_size = fit_resolution(frame_size, args.display_size)
+        if display_size != frame_size:
+            if displayed is None or displayed.shape[:2] != display_size[::-1]:
+                displayed = np.empty(display_size[::-1] + (3,), dtype=np.uint8)
+            frame = cv2.resize(
+                frame, display_size, dst=displayed, interpolation=cv2.INTER_LINEAR
+            )
+
+        if landmarks is not None:
+
+            # shows the eye keypoints (can be commented)
+            Eye_det.show_eye_keypoints(
+                color_frame=frame, landmarks=landmarks, frame_size=display_size
+            )
+
             # if the head pose estimation is successful, show the results
-            if frame_det is not None:
-                frame = frame_det
+            if rvec is not None and Head_pose.show_axis:
+                Head_pose.draw_axes(frame, rvec, tvec, landmarks, display_size)
 
             # show the real-time EAR score
             if ear is not None:
@@ -317,7 +462,10 @@ def main():
             break
 
     cap.release()
-    cv2.destroyAllWindows()
+    if args.headless:
+        Metrics_out.close()
+    else:
+        cv2.destroyAllWindows()
 
     return
 
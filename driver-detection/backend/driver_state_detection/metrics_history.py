@@ -0,0 +1,184 @@
+import threading
+
+import numpy as np
+
+# per-frame metrics kept by the history, NaN on the frames without a face
+HISTORY_METRICS = ("ear", "gaze", "perclos", "roll", "pitch", "yaw")
+
+
+class MetricsHistory:
+    def __init__(self, capacity=108000, metrics=HISTORY_METRICS):
+        """
+        Fixed memory columnar ring buffer of the per-frame metrics: one float32 array per metric and one float64
+        array of timestamps, preallocated for capacity frames. Once full, every new frame overwrites the oldest one,
+        so the history covers the last capacity frames (one hour at 30 fps by default).
+
+        Frames are appended by the pipeline inference thread and the history can be queried from another thread:
+        a query only holds the lock while copying the frames of its time window.
+
+        Parameters
+        ----------
+        capacity: int, optional
+            Number of frames kept (default is 108000)
+        metrics: tuple of str, optional
+            Names of the metrics kept (default is HISTORY_METRICS)
+
+        Methods
+        ----------
+        - append: adds the metrics of a frame
+        - query: returns the min, max and mean of every metric over fixed time buckets of a time window
+        - clear: forgets all the frames
+        - time_range: returns the timestamps of the oldest and newest frames
+        - stats: returns the capacity, frames and time span of the history
+        """
+        self.capacity = capacity
+        self.metrics = tuple(metrics)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.columns = {
+            name: np.full(capacity, np.nan, dtype=np.float32) for name in self.metrics
+        }
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.size = 0
+            self._next = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp, metrics):
+        """
+        Adds a frame to the history
+
+        Parameters
+        ----------
+        timestamp: float
+            Time of the frame in seconds, raised to the time of the previous frame if older (e.g. after a clock
+            adjustment) so that the frames stay in time order
+        metrics: dict or None
+            Metrics of the frame, missing or None values (or no metrics at all) are stored as NaN
+        """
+        with self._lock:
+            i = self._next
+            if self.size:
+                timestamp = max(timestamp, self.timestamps[i - 1])
+            self.timestamps[i] = timestamp
+            for name, column in self.columns.items():
+                value = metrics.get(name) if metrics is not None else None
+                column[i] = np.nan if value is None else value
+            self._next = (i + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+
+    def _segments(self):
+        # the frames in time order, as one or two slices of the ring
+        if self.size < self.capacity:
+            return [slice(0, self.size)]
+        return [slice(self._next, self.capacity), slice(0, self._next)]
+
+    def window(self, t_from=None, t_to=None):
+        """
+        Copies the frames of a time window
+
+        Returns
+        --------
+        timestamps: numpy array
+            (n,) timestamps of the frames with t_from <= timestamp <= t_to, in time order
+        columns: dict
+            (n,) values of every metric
+        """
+        with self._lock:
+            parts = []
+            for segment in self._segments():
+                timestamps = self.timestamps[segment]
+                start = 0 if t_from is None else np.searchsorted(timestamps, t_from, "left")
+                stop = (
+                    len(timestamps)
+                    if t_to is None
+                    else np.searchsorted(timestamps, t_to, "right")
+                )
+                if stop > start:
+                    parts.append(
+                        slice(segment.start + start, segment.start + stop)
+                    )
+            timestamps = np.concatenate(
+                [self.timestamps[part] for part in parts] or [np.empty(0)]
+            )
+            columns = {
+                name: np.concatenate(
+                    [column[part] for part in parts] or [np.empty(0, np.float32)]
+                )
+                for name, column in self.columns.items()
+            }
+        return timestamps, columns
+
+    def query(self, t_from=None, t_to=None, resolution=None, max_buckets=500):
+        """
+        Downsamples the frames of a time window into fixed time buckets
+
+        Parameters
+        ----------
+        t_from, t_to: float, optional
+            Time window, default is the oldest and the newest frame
+        resolution: float, optional
+            Duration of a bucket in seconds (default is the window duration divided by max_buckets)
+        max_buckets: int, optional
+            Number of buckets of the window when no resolution is given (default is 500)
+
+        Returns
+        --------
+        series: dict
+            "from", "to" and "resolution" of the buckets, "t": (n,) start time of the buckets that contain frames,
+            "count": (n,) number of frames per bucket, and for every metric a dict of (n,) "min", "max" and "mean"
+            arrays, NaN where the bucket has no value of the metric
+        """
+        timestamps, columns = self.window(t_from, t_to)
+        if t_from is None:
+            t_from = timestamps[0] if len(timestamps) else 0.0
+        if t_to is None:
+            t_to = timestamps[-1] if len(timestamps) else t_from
+        if resolution is None:
+            resolution = max(t_to - t_from, 1e-3) / max_buckets
+
+        series = {"from": t_from, "to": t_to, "resolution": resolution}
+        # frames are in time order: the frames of a bucket are contiguous
+        buckets = ((timestamps - t_from) // resolution).astype(np.int64)
+        starts = np.flatnonzero(np.diff(buckets, prepend=-1))
+        ids = buckets[starts]
+        counts = np.diff(np.append(starts, len(buckets)))
+        series["t"] = t_from + ids * resolution
+        series["count"] = counts
+
+        for name, values in columns.items():
+            if not len(values):
+                series[name] = {"min": values, "max": values, "mean": values}
+                continue
+            valid = ~np.isnan(values)
+            # per bucket sums over the valid values only
+            n_valid = np.add.reduceat(valid, starts, dtype=np.int64)
+            sums = np.add.reduceat(np.where(valid, values, 0.0), starts, dtype=np.float64)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                means = np.where(n_valid > 0, sums / n_valid, np.nan)
+            mins = np.minimum.reduceat(np.where(valid, values, np.inf), starts)
+            maxs = np.maximum.reduceat(np.where(valid, values, -np.inf), starts)
+            mins[n_valid == 0] = np.nan
+            maxs[n_valid == 0] = np.nan
+            series[name] = {"min": mins, "max": maxs, "mean": means.astype(np.float32)}
+        return series
+
+    def time_range(self):
+        """Returns the (oldest, newest) timestamps, None if the history is empty"""
+        with self._lock:
+            if not self.size:
+                return None
+            oldest = self.timestamps[self._segments()[0].start]
+            return float(oldest), float(self.timestamps[self._next - 1])
+
+    def stats(self):
+        time_range = self.time_range()
+        return {
+            "capacity": self.capacity,
+            "frames": self.size,
+            "span_s": round(time_range[1] - time_range[0], 3) if time_range else 0.0,
+        }
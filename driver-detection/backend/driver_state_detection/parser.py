@@ -1,5 +1,18 @@
 import argparse
 
+try:
+    from .utils import parse_resolution
+except ImportError:
+    from utils import parse_resolution
+
+
+def resolution(value):
+    """argparse type of the WIDTHxHEIGHT resolutions"""
+    try:
+        return parse_resolution(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
 
 def get_args():
     parser = argparse.ArgumentParser(description="Driver State Detection")
@@ -20,6 +33,63 @@ def get_args():
         help="Path to the camera parameters file (JSON or YAML).",
     )
 
+    # capture, inference and display resolutions
+    parser.add_argument(
+        "--capture_size",
+        type=resolution,
+        default=None,
+        metavar="",
+        help="Resolution requested from the camera as WIDTHxHEIGHT (e.g. 1920x1080), the camera parameters file "
+        "must be calibrated for it, default is the camera default",
+    )
+    parser.add_argument(
+        "--inference_size",
+        type=resolution,
+        default=None,
+        metavar="",
+        help="Maximum resolution of the frames given to the face mesh model as WIDTHxHEIGHT (e.g. 640x480), the "
+        "aspect ratio is kept, default is the capture resolution",
+    )
+    parser.add_argument(
+        "--display_size",
+        type=resolution,
+        default=None,
+        metavar="",
+        help="Maximum resolution of the displayed frames as WIDTHxHEIGHT, the aspect ratio is kept, "
+        "default is the capture resolution",
+    )
+
+    # landmarks tracking parameters
+    parser.add_argument(
+        "--detect_interval",
+        type=int,
+        default=1,
+        metavar="",
+        help="Run the face mesh detector every N frames and track the landmarks with optical flow in between, "
+        "default is 1 (detection on every frame)",
+    )
+    parser.add_argument(
+        "--face_roi",
+        action="store_true",
+        help="Run the face mesh detector on the region around the face of the previous frame instead of the "
+        "full frame",
+    )
+
+    # headless mode: metrics only, no rendering nor display
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="Skip all rendering and display, and emit the metrics of every frame as JSON lines",
+    )
+    parser.add_argument(
+        "--metrics_output",
+        type=str,
+        default="-",
+        metavar="",
+        help="Destination of the headless metrics: - for stdout or udp://HOST:PORT for a local socket, "
+        "default is stdout",
+    )
+
     # visualisation parameters
     parser.add_argument(
         "--show_fps",
@@ -58,6 +128,30 @@ def get_args():
     )
 
     # Attention Scorer parameters (EAR, Gaze Score, Pose)
+    add_scorer_args(parser)
+
+    # parse the arguments and store them in the args variable dictionary
+    args, _ = parser.parse_known_args()
+
+    return args
+
+
+def add_scorer_args(parser):
+    """Adds the head pose options and the Attention Scorer thresholds options to the parser"""
+    parser.add_argument(
+        "--pose_mode",
+        type=str,
+        default="pnp",
+        choices=("pnp", "procrustes"),
+        metavar="",
+        help="Head pose solver: pnp (cv2.solvePnP) or procrustes (faster, reuses the face model alignment), "
+        "default is pnp",
+    )
+    parser.add_argument(
+        "--temporal_pose",
+        action="store_true",
+        help="pnp head pose: refine the pose of the previous frame instead of solving every frame from scratch",
+    )
     parser.add_argument(
         "--smooth_factor",
         type=float,
@@ -122,7 +216,67 @@ def get_args():
         help="Sets the Pose time threshold (seconds) for the Attention Scorer, default is 2.5 seconds",
     )
 
-    # parse the arguments and store them in the args variable dictionary
-    args, _ = parser.parse_known_args()
 
-    return args
+def get_batch_args():
+    parser = argparse.ArgumentParser(
+        description="Driver State Detection - offline analysis of recorded videos"
+    )
+
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="Video files and/or directories of video files to analyze",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default="driver_state_metrics.npz",
+        metavar="",
+        help="Columnar output file, .npz or .parquet (requires pyarrow), default is driver_state_metrics.npz",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        metavar="",
+        help="Number of videos analyzed in parallel by worker processes, default is the number of CPUs",
+    )
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        help="Search the input directories recursively",
+    )
+    parser.add_argument(
+        "--camera_params",
+        type=str,
+        help="Path to the camera parameters file (JSON or YAML) of the recording camera.",
+    )
+    parser.add_argument(
+        "--inference_size",
+        type=resolution,
+        default=None,
+        metavar="",
+        help="Maximum resolution of the frames given to the face mesh model as WIDTHxHEIGHT (e.g. 640x480), the "
+        "aspect ratio is kept, default is the video resolution",
+    )
+    parser.add_argument(
+        "--detect_interval",
+        type=int,
+        default=1,
+        metavar="",
+        help="Run the face mesh detector every N frames and track the landmarks with optical flow in between, "
+        "default is 1 (detection on every frame)",
+    )
+    parser.add_argument(
+        "--face_roi",
+        action="store_true",
+        help="Run the face mesh detector on the region around the face of the previous frame instead of the "
+        "full frame",
+    )
+
+    # Attention Scorer parameters (EAR, Gaze Score, Pose)
+    add_scorer_args(parser)
+
+    return parser.parse_args()
@@ -0,0 +1,682 @@
+import queue
+import threading
+import time
+from typing import NamedTuple, Optional
+
+import cv2
+import numpy as np
+
+try:
+    from .eye_detector import EyeDetector
+    from .face_roi import FaceROIDetector
+    from .pose_estimation import HeadPoseEstimator
+    from .preprocessing import FrameBufferPool, FramePreprocessor
+    from .utils import fit_resolution, get_landmarks
+except ImportError:
+    from eye_detector import EyeDetector
+    from face_roi import FaceROIDetector
+    from pose_estimation import HeadPoseEstimator
+    from preprocessing import FrameBufferPool, FramePreprocessor
+    from utils import fit_resolution, get_landmarks
+
+
+class FrameResult(NamedTuple):
+    """
+    Immutable result of running the full detection pipeline on a single captured frame.
+
+    Attributes
+    ----------
+    frame_id: int
+        Monotonic id of the frame inside the capture stream
+    timestamp: float
+        time.perf_counter() value taken when the frame was captured
+    frame: numpy array
+        Captured BGR frame, without overlays (read-only)
+    landmarks: numpy array or None
+        478 face mesh landmarks of the selected face, None if no face was found
+    metrics: dict
+        Serializable metrics (EAR, gaze, PERCLOS, head pose, alerts, timings) of the frame
+    pose: tuple or None
+        (rvec, tvec) head pose of the selected face, used to draw the head pose axis. None if the pose was not found
+    """
+
+    frame_id: int
+    timestamp: float
+    frame: np.ndarray
+    landmarks: Optional[np.ndarray]
+    metrics: dict
+    pose: Optional[tuple] = None
+
+
+class FrameAnalyzer:
+    def __init__(self, detector, eye_det, head_pose, scorer, tracker=None):
+        """
+        Runs the face mesh detector and the driver state estimators on a single frame.
+        It groups the objects that are otherwise driven one by one in the capture loop, so that a frame
+        is analyzed exactly once no matter how many consumers need the result.
+        Nothing is drawn on the frame: the overlays are rendered from the results by an OverlayRenderer,
+        only when somebody watches the video.
+
+        Parameters
+        ----------
+        detector: mediapipe FaceMesh
+            Face mesh model used to find the face landmarks
+        eye_det: EyeDetector
+            Eye detector used for the EAR and Gaze scores
+        head_pose: HeadPoseEstimator
+            Head pose estimator used for roll, pitch and yaw
+        scorer: AttentionScorer
+            Attention scorer used for PERCLOS and the driver state alerts
+        tracker: LandmarkTracker, optional
+            If given, the landmarks are obtained from the tracker, which runs the detector only every few frames
+            and tracks the landmarks with optical flow in between (default is None: detection on every frame)
+
+        Methods
+        ----------
+        - analyze: detects the face in the frame and computes all the metrics
+
+        After analyze, the pose attribute holds the (rvec, tvec) head pose of the frame, None if not found.
+        """
+        self.detector = detector
+        self.eye_det = eye_det
+        self.head_pose = head_pose
+        self.scorer = scorer
+        self.tracker = tracker
+        self.preprocessor = FramePreprocessor(flip=False)
+        self.pose = None
+
+    def analyze(self, frame, t_now, gray_1ch=None, gray=None):
+        """
+        Detects the face and computes EAR, PERCLOS, Gaze Score, head pose and attention alerts.
+
+        Parameters
+        ----------
+        frame: numpy array
+            BGR frame to analyze
+        t_now: float
+            Current time in seconds
+        gray_1ch: numpy array, optional
+            Single channel grayscale version of the frame, computed if not given. It may have a lower (inference)
+            resolution than the frame
+        gray: numpy array, optional
+            3 channels grayscale version of the frame given to the model, computed if not given
+
+        Returns
+        --------
+        landmarks: numpy array or None
+            478 face mesh landmarks of the biggest face, None if no face was found
+        metrics: dict or None
+            Computed metrics of the frame, None if no face was found
+        """
+        self.pose = None
+        if gray is None:
+            # create a 3D matrix from the gray image to give it to the model
+            _, gray_1ch, gray = self.preprocessor.process(frame)
+
+        if self.tracker is not None:
+            landmarks = self.tracker.process(gray, gray_1ch)
+        else:
+            lms = self.detector.process(gray).multi_face_landmarks
+            landmarks = get_landmarks(lms) if lms else None
+        if landmarks is None:
+            # the face is lost: the next head pose is solved from scratch
+            self.head_pose.reset()
+            return None, None
+
+        frame_size = (frame.shape[1], frame.shape[0])
+
+        ear = self.eye_det.get_EAR(landmarks=landmarks)
+        tired, perclos = self.scorer.get_rolling_PERCLOS(t_now, ear)
+
+        gaze = self.eye_det.get_Gaze_Score(
+            frame=gray, landmarks=landmarks, frame_size=(gray.shape[1], gray.shape[0])
+        )
+
+        rvec, tvec, roll, pitch, yaw = self.head_pose.estimate_pose(
+            landmarks=landmarks, frame_size=frame_size
+        )
+        if rvec is not None:
+            self.pose = (rvec, tvec)
+
+        asleep, looking_away, distracted = self.scorer.eval_scores(
+            t_now=t_now,
+            ear_score=ear,
+            gaze_score=gaze,
+            head_roll=roll,
+            head_pitch=pitch,
+            head_yaw=yaw,
+        )
+
+        metrics = {
+            "ear": round(float(ear), 3) if ear else None,
+            "gaze": round(float(gaze), 3) if gaze else None,
+            "perclos": round(float(perclos), 3),
+            "perclos_windows": {
+                str(window): round(float(score), 3)
+                for window, score in self.scorer.get_rolling_PERCLOS_windows().items()
+            },
+            "roll": float(roll[0]) if roll is not None and len(roll) > 0 else None,
+            "pitch": float(pitch[0]) if pitch is not None and len(pitch) > 0 else None,
+            "yaw": float(yaw[0]) if yaw is not None and len(yaw) > 0 else None,
+            "tired": bool(tired),
+            "asleep": bool(asleep),
+            "looking_away": bool(looking_away),
+            "distracted": bool(distracted),
+        }
+        return landmarks, metrics
+
+
+def draw_overlays(frame, metrics):
+    """Draw the metrics and the alerts on the frame"""
+    if metrics.get("ear") is not None:
+        cv2.putText(
+            frame,
+            f"EAR: {metrics['ear']:.3f}",
+            (10, 50),
+            cv2.FONT_HERSHEY_PLAIN,
+            2,
+            (255, 255, 255),
+            1,
+            cv2.LINE_AA,
+        )
+
+    if metrics.get("gaze") is not None:
+        cv2.putText(
+            frame,
+            f"Gaze: {metrics['gaze']:.3f}",
+            (10, 80),
+            cv2.FONT_HERSHEY_PLAIN,
+            2,
+            (255, 255, 255),
+            1,
+            cv2.LINE_AA,
+        )
+
+    cv2.putText(
+        frame,
+        f"PERCLOS: {metrics['perclos']:.3f}",
+        (10, 110),
+        cv2.FONT_HERSHEY_PLAIN,
+        2,
+        (255, 255, 255),
+        1,
+        cv2.LINE_AA,
+    )
+
+    if metrics.get("roll") is not None:
+        cv2.putText(
+            frame,
+            f"Roll: {metrics['roll']:.1f}",
+            (450, 40),
+            cv2.FONT_HERSHEY_PLAIN,
+            1.5,
+            (255, 0, 255),
+            1,
+            cv2.LINE_AA,
+        )
+
+    if metrics.get("pitch") is not None:
+        cv2.putText(
+            frame,
+            f"Pitch: {metrics['pitch']:.1f}",
+            (450, 70),
+            cv2.FONT_HERSHEY_PLAIN,
+            1.5,
+            (255, 0, 255),
+            1,
+            cv2.LINE_AA,
+        )
+
+    if metrics.get("yaw") is not None:
+        cv2.putText(
+            frame,
+            f"Yaw: {metrics['yaw']:.1f}",
+            (450, 100),
+            cv2.FONT_HERSHEY_PLAIN,
+            1.5,
+            (255, 0, 255),
+            1,
+            cv2.LINE_AA,
+        )
+
+    cv2.putText(
+        frame,
+        f"FPS: {metrics['fps']:.0f}",
+        (10, 400),
+        cv2.FONT_HERSHEY_PLAIN,
+        2,
+        (255, 0, 255),
+        1,
+    )
+
+    # Show processing time frame
+    if metrics.get("proc_time"):
+        cv2.putText(
+            frame,
+            f"PROC. TIME FRAME: {metrics['proc_time']:.0f}ms",
+            (10, 430),
+            cv2.FONT_HERSHEY_PLAIN,
+            2,
+            (255, 0, 255),
+            1,
+        )
+
+    # Alerts
+    if metrics.get("tired"):
+        cv2.putText(
+            frame,
+            "TIRED!",
+            (10, 280),
+            cv2.FONT_HERSHEY_PLAIN,
+            1,
+            (0, 0, 255),
+            1,
+            cv2.LINE_AA,
+        )
+
+    if metrics.get("asleep"):
+        cv2.putText(
+            frame,
+            "ASLEEP!",
+            (10, 300),
+            cv2.FONT_HERSHEY_PLAIN,
+            1,
+            (0, 0, 255),
+            1,
+            cv2.LINE_AA,
+        )
+
+    if metrics.get("looking_away"):
+        cv2.putText(
+            frame,
+            "LOOKING AWAY!",
+            (10, 320),
+            cv2.FONT_HERSHEY_PLAIN,
+            1,
+            (0, 0, 255),
+            1,
+            cv2.LINE_AA,
+        )
+
+    if metrics.get("distracted"):
+        cv2.putText(
+            frame,
+            "DISTRACTED!",
+            (10, 340),
+            cv2.FONT_HERSHEY_PLAIN,
+            1,
+            (0, 0, 255),
+            1,
+            cv2.LINE_AA,
+        )
+
+    return frame
+
+
+class OverlayRenderer:
+    def __init__(self, eye_det=None, head_pose=None, pool_size=4, display_size=None):
+        """
+        Overlay stage: draws the eye keypoints, the head pose axis and the metrics of a FrameResult on a copy of
+        its frame. The analysis never draws, so the overlays only cost something when a video consumer asks
+        for them.
+
+        Parameters
+        ----------
+        eye_det: EyeDetector, optional
+            Eye detector giving the eye keypoints to draw (default is a new EyeDetector)
+        head_pose: HeadPoseEstimator, optional
+            Head pose estimator giving the camera parameters used to project the axis
+            (default is a new HeadPoseEstimator, with the default camera parameters)
+        pool_size: int, optional
+            Maximum number of rendered frame buffers kept (default is 4)
+        display_size: tuple, optional
+            (width, height) bounding resolution of the rendered frames: larger frames are scaled down, keeping
+            their aspect ratio, before drawing (default is None: the resolution of the published frames)
+
+        Methods
+        ----------
+        - render: returns the annotated copy of the frame of a FrameResult
+        - stats: returns the rendered frames, time and buffer pool counters
+
+        render may be called from several threads (e.g. the encode workers).
+        """
+        if eye_det is None:
+            eye_det = EyeDetector(show_processing=False)
+        if head_pose is None:
+            head_pose = HeadPoseEstimator()
+        self.eye_det = eye_det
+        self.head_pose = head_pose
+        self.display_size = display_size
+        self.pool = FrameBufferPool(max_size=pool_size)
+        self.frames = 0
+        self.busy_time = 0.0
+        self.cpu_time = 0.0
+        self._lock = threading.Lock()
+
+    def render(self, result):
+        """
+        Draws the overlays of a FrameResult
+
+        Parameters
+        ----------
+        result: FrameResult
+            Published frame result, left untouched
+
+        Returns
+        --------
+        frame: numpy array
+            Annotated copy of the frame, at the display resolution
+        """
+        t_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        height, width = result.frame.shape[:2]
+        width, height = fit_resolution((width, height), self.display_size)
+        with self._lock:
+            frame = self.pool.acquire(
+                (height, width) + result.frame.shape[2:], result.frame.dtype
+            )
+        if frame.shape == result.frame.shape:
+            np.copyto(frame, result.frame)
+        else:
+            cv2.resize(
+                result.frame, (width, height), dst=frame, interpolation=cv2.INTER_LINEAR
+            )
+
+        if result.landmarks is not None:
+            frame_size = (frame.shape[1], frame.shape[0])
+            self.eye_det.show_eye_keypoints(
+                color_frame=frame, landmarks=result.landmarks, frame_size=frame_size
+            )
+            if result.pose is not None:
+                with self._lock:
+                    # the camera parameters are computed once per display resolution
+                    self.head_pose.draw_axes(
+                        frame, *result.pose, result.landmarks, frame_size
+                    )
+
+        draw_overlays(frame, result.metrics)
+
+        with self._lock:
+            self.frames += 1
+            self.busy_time += time.perf_counter() - t_start
+            self.cpu_time += time.thread_time() - cpu_start
+        return frame
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "avg_time_ms": (
+                (self.busy_time / self.frames) * 1000 if self.frames else None
+            ),
+            "cpu_time_s": round(self.cpu_time, 3),
+            "frame_pool": self.pool.stats(),
+        }
+
+
+DEFAULT_METRICS = {
+    "fps": 0.0,
+    "ear": None,
+    "gaze": None,
+    "perclos": 0.0,
+    "perclos_windows": {},
+    "roll": None,
+    "pitch": None,
+    "yaw": None,
+    "tired": False,
+    "asleep": False,
+    "looking_away": False,
+    "distracted": False,
+    "proc_time": None,
+}
+
+
+class StageStats:
+    """Counters of a single pipeline stage, updated by the stage worker thread"""
+
+    def __init__(self, name, stage_queue=None):
+        self.name = name
+        self.queue = stage_queue
+        self.frames = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+        self.busy_time = 0.0
+        self.cpu_time = 0.0
+        self._cpu_mark = None
+
+    def account_cpu(self):
+        """Add the CPU time used by the calling thread since the previous call (to call from the stage thread)"""
+        cpu_now = time.thread_time()
+        if self._cpu_mark is not None:
+            self.cpu_time += cpu_now - self._cpu_mark
+        self._cpu_mark = cpu_now
+
+    def as_dict(self):
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "queue_size": self.queue.maxsize if self.queue is not None else 0,
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "avg_time_ms": (
+                (self.busy_time / self.frames) * 1000 if self.frames else None
+            ),
+            "cpu_time_s": round(self.cpu_time, 3),
+        }
+
+
+class ThreadedPipeline:
+    def __init__(
+        self,
+        camera,
+        analyzer,
+        on_result,
+        render=None,
+        flip=True,
+        queue_size=2,
+        inference_size=None,
+        history=None,
+    ):
+        """
+        Runs capture and inference on dedicated worker threads connected by a bounded queue, so that the
+        blocking OpenCV and MediaPipe calls never run on the caller's thread (e.g. the asyncio event loop).
+
+        When the inference stage falls behind, the oldest captured frame is dropped: results always refer to
+        the freshest frame available instead of accumulating latency.
+
+        Parameters
+        ----------
+        camera: cv2.VideoCapture
+            Opened video source
+        analyzer: FrameAnalyzer
+            Analyzer used on every captured frame
+        on_result: callable
+            Called from the inference thread with every FrameResult
+        render: callable, optional
+            Called as render(frame, metrics) to draw overlays before the frame is published. Prefer an
+            OverlayRenderer on the consumer side, which only draws the frames that are watched
+        flip: bool, optional
+            If set to True, flips the frame horizontally for a mirror effect (default is True)
+        queue_size: int, optional
+            Maximum number of captured frames waiting for inference (default is 2)
+        inference_size: tuple, optional
+            (width, height) bounding resolution of the frames given to the face mesh model, the published frames
+            keep the capture resolution (default is None: the capture resolution)
+        history: MetricsHistory, optional
+            If given, the metrics of every analyzed frame are appended to it, with Unix timestamps, NaN when no face
+            was found (default is None)
+
+        Methods
+        ----------
+        - start: starts the worker threads
+        - stop: stops the worker threads and waits for them to finish
+        - stats: returns the per-stage counters and queue depths
+        """
+        self.camera = camera
+        self.analyzer = analyzer
+        self.on_result = on_result
+        self.render = render
+        self.flip = flip
+        self.preprocessor = FramePreprocessor(flip=flip, inference_size=inference_size)
+        self.history = history
+        # from the perf_counter capture times to Unix times
+        self._clock_offset = time.time() - time.perf_counter()
+        # queued frames, the one being analyzed and the one being read
+        self.capture_pool = FrameBufferPool(max_size=queue_size + 2)
+
+        self.metrics = dict(DEFAULT_METRICS)
+        self.frame_queue = queue.Queue(maxsize=queue_size)
+        self.capture_stats = StageStats("capture", self.frame_queue)
+        self.inference_stats = StageStats("inference")
+
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._frame_id = 0
+        self._prev_time = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._threads = [
+            threading.Thread(target=self._capture_loop, name="capture", daemon=True),
+            threading.Thread(
+                target=self._inference_loop, name="inference", daemon=True
+            ),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=2.0):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def cpu_time(self):
+        """CPU time in seconds used by the capture and inference threads"""
+        return self.capture_stats.cpu_time + self.inference_stats.cpu_time
+
+    @property
+    def is_running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def stats(self):
+        stats = {
+            "capture": self.capture_stats.as_dict(),
+            "inference": self.inference_stats.as_dict(),
+        }
+        stats["capture"]["frame_pool"] = self.capture_pool.stats()
+        stats["inference"]["frame_pool"] = self.preprocessor.stats()
+        if self.analyzer.tracker is not None:
+            stats["inference"]["tracker"] = self.analyzer.tracker.stats()
+        # local analyzers only: the detector of a RemoteAnalyzer lives in the worker process
+        if isinstance(getattr(self.analyzer, "detector", None), FaceROIDetector):
+            stats["inference"]["face_roi"] = self.analyzer.detector.stats()
+        return stats
+
+    def _capture_loop(self):
+        frame_shape = None
+        self.capture_stats.account_cpu()
+        while not self._stop_event.is_set():
+            self.capture_stats.account_cpu()
+            t_start = time.perf_counter()
+            if frame_shape is None:
+                ret, frame = self.camera.read()
+            else:
+                # decode into a free buffer of the pool (reallocated by OpenCV if the resolution changes)
+                ret, frame = self.camera.read(self.capture_pool.acquire(frame_shape))
+            if not ret:
+                time.sleep(0.1)
+                continue
+            t_now = time.perf_counter()
+            frame_shape = frame.shape
+
+            self.capture_stats.frames += 1
+            self.capture_stats.busy_time += t_now - t_start
+
+            # keep only the freshest frames: drop the oldest one when inference is behind
+            while True:
+                try:
+                    self.frame_queue.put_nowait((t_now, frame))
+                    break
+                except queue.Full:
+                    try:
+                        self.frame_queue.get_nowait()
+                        self.capture_stats.dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def _inference_loop(self):
+        self.inference_stats.account_cpu()
+        while not self._stop_event.is_set():
+            self.inference_stats.account_cpu()
+            try:
+                t_now, frame = self.frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            try:
+                result = self.process(frame, t_now)
+            except RuntimeError as e:
+                # e.g. an inference worker that timed out or crashed: skip the frame, keep the stream alive
+                error = str(e).splitlines()[0]
+                if error != self.inference_stats.last_error:
+                    print(f"Inference error: {e}")
+                self.inference_stats.errors += 1
+                self.inference_stats.last_error = error
+                continue
+            self.on_result(result)
+
+    def process(self, frame, t_now):
+        """
+        Analyzes a captured frame and builds its FrameResult
+
+        Parameters
+        ----------
+        frame: numpy array
+            BGR frame as read from the camera
+        t_now: float
+            Capture time of the frame in seconds
+
+        Returns
+        --------
+        result: FrameResult
+        """
+        e1 = cv2.getTickCount()
+
+        # mirrored frame and grayscale versions, written into reused buffers
+        frame, gray_1ch, gray = self.preprocessor.process(frame)
+
+        if self._prev_time is not None and t_now > self._prev_time:
+            self.metrics["fps"] = 1 / (t_now - self._prev_time)
+        self._prev_time = t_now
+
+        landmarks, frame_metrics = self.analyzer.analyze(
+            frame, t_now, gray_1ch=gray_1ch, gray=gray
+        )
+
+        e2 = cv2.getTickCount()
+        proc_time = (e2 - e1) / cv2.getTickFrequency()
+        if frame_metrics is not None:
+            self.metrics.update(frame_metrics)
+            self.metrics["proc_time"] = proc_time * 1000
+        if self.history is not None:
+            self.history.append(t_now + self._clock_offset, frame_metrics)
+        self.inference_stats.frames += 1
+        self.inference_stats.busy_time += proc_time
+
+        metrics = dict(self.metrics)
+        if self.render is not None:
+            self.render(frame, metrics)
+
+        # the published frame is shared by all the consumers: make it read-only
+        frame.flags.writeable = False
+        self._frame_id += 1
+        return FrameResult(
+            frame_id=self._frame_id,
+            timestamp=t_now,
+            frame=frame,
+            landmarks=landmarks,
+            metrics=metrics,
+            pose=self.analyzer.pose,
+        )
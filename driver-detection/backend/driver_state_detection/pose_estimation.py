@@ -1,15 +1,67 @@
 import cv2
 import numpy as np
 try:
-    from .face_geometry import PCF, get_metric_landmarks, procrustes_landmark_basis
-    from .utils import rot_mat_to_euler
+    from .face_geometry import (
+        PCF,
+        get_metric_landmarks,
+        get_pose_transform_batch,
+        procrustes_landmark_basis,
+    )
+    from .utils import rot_mat_to_euler, rot_mat_to_euler_batch
 except ImportError:
-    from face_geometry import PCF, get_metric_landmarks, procrustes_landmark_basis
-    from utils import rot_mat_to_euler
+    from face_geometry import (
+        PCF,
+        get_metric_landmarks,
+        get_pose_transform_batch,
+        procrustes_landmark_basis,
+    )
+    from utils import rot_mat_to_euler, rot_mat_to_euler_batch
+
+# the Procrustes pose maps the canonical face model to the metric space of face_geometry (x right, y up, z towards
+# the camera): CV_FROM_METRIC turns it into the OpenCV camera frame (y down, z forward) in which solvePnP works,
+# and EULER_AXES applies the (z, x, y) reordering of the rotation vector done by get_pose before the Euler angles
+CV_FROM_METRIC = np.diag([1.0, -1.0, -1.0])
+EULER_AXES = np.array([[0.0, 0.0, 1.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+
+# "pnp": solvePnP + solvePnPRefineVVS on the metric landmarks, "procrustes": pose of the Procrustes alignment of
+# get_metric_landmarks, without the OpenCV solvers
+POSE_MODES = ("pnp", "procrustes")
+NO_LANDMARKS = np.empty(0, dtype=np.intp)
+
+
+def pose_transforms_to_euler(pose_transform_mats):
+    """
+    Roll, pitch and yaw of Procrustes pose transformation matrixes, in the convention of HeadPoseEstimator.get_pose
+
+    Parameters
+    ----------
+    pose_transform_mats: numpy array
+        (T, 4, 4) pose transformation matrixes (see face_geometry.get_pose_transform_batch)
+
+    Returns
+    --------
+    eulers: numpy array
+        (T, 3) roll, pitch and yaw in degrees, NaN where the rotation is invalid
+    """
+    rotations = pose_transform_mats[:, :3, :3]
+    # remove the scale of the similarity transform
+    rotations = rotations / np.linalg.norm(rotations[:, :, 0], axis=1)[:, None, None]
+    rmats = EULER_AXES @ CV_FROM_METRIC @ rotations @ EULER_AXES.T
+    return rot_mat_to_euler_batch(rmats)
 
 
 class HeadPoseEstimator:
-    def __init__(self, camera_matrix=None, dist_coeffs=None, show_axis: bool = False):
+    def __init__(
+        self,
+        camera_matrix=None,
+        dist_coeffs=None,
+        show_axis: bool = False,
+        pose_mode: str = "pnp",
+        temporal: bool = False,
+        warm_iterations: int = 2,
+        max_reprojection_error: float = 2.0,
+        calibration_size=None,
+    ):
         """
         Class for estimating the head pose using the image/frame, face mesh landmarks, and camera parameters.
 
@@ -22,17 +74,46 @@ class HeadPoseEstimator:
             Camera matrix of the camera used to capture the image/frame.
         dist_coeffs : numpy array
             Distortion coefficients of the camera used to capture the image/frame.
+        calibration_size : tuple
+            Width and height of the frames camera_matrix was calibrated for (default is the size of the first frame).
+            The camera parameters and the PCF are computed once per frame size, camera_matrix being rescaled to
+            it, so the same estimator works on frames of any resolution of the camera (e.g. inference and display
+            resolutions lower than the capture one).
+        pose_mode : str
+            "pnp" solves the pose with cv2.solvePnP and cv2.solvePnPRefineVVS on the metric landmarks, "procrustes"
+            derives it from the pose transform that get_metric_landmarks already computes, skipping both OpenCV
+            solvers (default is "pnp"). With the default camera parameters the metric landmarks reproject exactly
+            onto the image landmarks, so both modes give the same pose (see benchmarks/bench_pose_modes.py).
+        temporal : bool
+            "pnp" mode only: if set to True, the pose of the previous frame is the initial guess of a short
+            Levenberg-Marquardt refinement (cv2.solvePnPRefineLM) instead of solving the pose from scratch, since the
+            head barely moves between two frames (default is False).
+        warm_iterations : int
+            Iteration budget of the warm-started refinement (default is 2).
+        max_reprojection_error : float
+            RMS reprojection error in pixels above which a warm-started pose is discarded and the pose is solved
+            from scratch (default is 2.0). A frame without pose (see reset) also triggers a cold solve.
 
         Methods
         -------
         get_pose(frame, landmarks, frame_size)
             Estimate the head pose using the provided frame, landmarks, and frame size.
+        estimate_pose(landmarks, frame_size)
+            Estimate the head pose without drawing anything.
+        draw_axes(frame, rvec, tvec, landmarks, frame_size)
+            Draw the head pose axis of a previous estimation on the frame.
+        get_pose_batch(landmarks, frame_size)
+            Estimate the head pose of a stack of faces at once, from the Procrustes alignment of the face model.
+        reset()
+            Forget the pose of the previous frame (tracking loss), the next pose is solved from scratch.
+        stats()
+            Return the number of warm-started and cold solves.
         _get_model_lms_ids()
             Get the model landmark IDs used for pose estimation.
         _draw_nose_axes(frame, rvec, tvec, model_img_lms)
             Draw the nose axes on the frame.
         _get_camera_parameters(frame_size)
-            Get the camera parameters for pose estimation.
+            Select the camera parameters and the PCF of the frame size, computed once per size.
         """
 
         self.NOSE_AXES_POINTS = np.array(
@@ -40,12 +121,32 @@ class HeadPoseEstimator:
         )
         self.JAW_LMS_NUMS = [61, 291, 199]
 
+        if pose_mode not in POSE_MODES:
+            raise ValueError(f"Unknown pose mode {pose_mode!r}, expected one of {POSE_MODES}")
         self.show_axis = show_axis
+        self.pose_mode = pose_mode
+        self.temporal = temporal
+        self.warm_criteria = (
+            cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT,
+            warm_iterations,
+            np.finfo(np.float32).eps,
+        )
+        self.max_reprojection_error = max_reprojection_error
+        # (rvec, tvec) of the previous frame, the initial guess of the temporal mode
+        self.prev_pose = None
+        self.warm_solves = 0
+        self.cold_solves = 0
+        self.calibration_matrix = camera_matrix
+        self.calibration_dist_coeffs = dist_coeffs
+        self.calibration_size = calibration_size
+        # camera matrix, distortion coefficients, focal length and PCF of every frame size, the attributes hold the
+        # ones of the last frame size
+        self.camera_params = {}
+        self.frame_size = None
         self.camera_matrix = camera_matrix
         self.dist_coeffs = dist_coeffs
         self.focal_length = None
-
-        self.pcf_calculated = False
+        self.pcf = None
 
         self.model_lms_ids = self._get_model_lms_ids()
 
@@ -57,6 +158,17 @@ class HeadPoseEstimator:
 
         return model_lms_ids
 
+    def reset(self):
+        """Forgets the pose of the previous frame, to call when the face is lost"""
+        self.prev_pose = None
+
+    def stats(self):
+        return {
+            "temporal": self.temporal,
+            "warm_solves": self.warm_solves,
+            "cold_solves": self.cold_solves,
+        }
+
     def get_pose(self, frame, landmarks, frame_size):
         """
         Estimate head pose using the head pose estimator object instantiated attribute
@@ -73,25 +185,86 @@ class HeadPoseEstimator:
         - if successful: image_frame, yaw, pitch, roll  (tuple)
         - if unsuccessful: None,None,None,None (tuple)
 
+        """
+        rvec, tvec, roll, pitch, yaw = self.estimate_pose(landmarks, frame_size)
+        if rvec is None:
+            return None, None, None, None
+
+        if self.show_axis:
+            self.draw_axes(frame, rvec, tvec, landmarks, frame_size)
+
+        return frame, roll, pitch, yaw
+
+    def estimate_pose(self, landmarks, frame_size):
+        """
+        Estimate head pose without drawing on the frame
+
+        Parameters
+        ----------
+        landmarks: numpy array
+            mediapiep face mesh detected 478 landmarks of the head
+        frame_size: tuple
+            Width and height of the frame
+
+        Returns
+        --------
+        - if successful: rvec, tvec, roll, pitch, yaw (tuple), rvec and tvec being the pose of the face model in
+          the camera frame, used to draw the axis
+        - if unsuccessful: None,None,None,None,None (tuple)
         """
 
         rvec = None
         tvec = None
         model_img_lms = None
         eulers = None
-        metric_lms = None
 
-        if not self.pcf_calculated:
-            self._get_camera_parameters(frame_size)
+        self._get_camera_parameters(frame_size)
+
+        if self.pose_mode == "procrustes":
+            return self._estimate_procrustes_pose(landmarks)
 
         model_img_lms = (
             np.clip(landmarks[self.model_lms_ids, :2], 0.0, 1.0) * frame_size
         )
 
-        metric_lms = get_metric_landmarks(landmarks.T.copy(), self.pcf)[0].T
+        # sparse mode: metric coordinates are computed only for the model landmarks
+        model_metric_lms = get_metric_landmarks(
+            landmarks.T, self.pcf, landmark_ids=self.model_lms_ids
+        )[0].T
+
+        pose = None
+        if self.temporal and self.prev_pose is not None:
+            pose = self._warm_solve(model_metric_lms, model_img_lms)
+        if pose is None:
+            pose = self._cold_solve(model_metric_lms, model_img_lms)
+        if pose is None:
+            self.prev_pose = None
+            return None, None, None, None, None
+        rvec, tvec = pose
+        if self.temporal:
+            self.prev_pose = (rvec, tvec)
+
+        rvec1 = np.array([rvec[2, 0], rvec[0, 0], rvec[1, 0]]).reshape((3, 1))
+
+        # cv2.Rodrigues: convert a rotation vector to a rotation matrix (also known as a Rodrigues rotation matrix)
+        rmat, _ = cv2.Rodrigues(rvec1)
+
+        eulers = rot_mat_to_euler(rmat).reshape((-1, 1))
+
+        """
+        We use the rotationMatrixToEulerAngles function to compute the euler angles (roll, pitch, yaw) from the
+        Rotation Matrix. This function also checks if we have a gymbal lock.
+        The angles are converted from radians to degrees 
+        
+        An alternative method to compute the euler angles is the following:
+    
+        P = np.hstack((Rmat,tvec)) -> computing the projection matrix
+        euler_angles = -cv2.decomposeProjectionMatrix(P)[6] -> extracting euler angles for yaw pitch and roll from the projection matrix
+        """
 
-        model_metric_lms = metric_lms[self.model_lms_ids, :]
+        return rvec, tvec, eulers[0], eulers[1], eulers[2]
 
+    def _cold_solve(self, model_metric_lms, model_img_lms):
         (solve_pnp_success, rvec, tvec) = cv2.solvePnP(
             model_metric_lms,
             model_img_lms,
@@ -106,42 +279,102 @@ class HeadPoseEstimator:
         The method used is iterative (cv2.SOLVEPNP_ITERATIVE)
         An alternative method can be the cv2.SOLVEPNP_SQPNP
         """
+        if not solve_pnp_success:
+            return None
+        self.cold_solves += 1
         tvec = tvec.round(2)
 
-        if solve_pnp_success:
-            rvec, tvec = cv2.solvePnPRefineVVS(
-                model_metric_lms,
-                model_img_lms,
-                self.camera_matrix,
-                self.dist_coeffs,
-                rvec,
-                tvec,
-            )
+        return cv2.solvePnPRefineVVS(
+            model_metric_lms,
+            model_img_lms,
+            self.camera_matrix,
+            self.dist_coeffs,
+            rvec,
+            tvec,
+        )
 
-            rvec1 = np.array([rvec[2, 0], rvec[0, 0], rvec[1, 0]]).reshape((3, 1))
+    def _warm_solve(self, model_metric_lms, model_img_lms):
+        # the refinement updates the guess in place: the previous pose may still be used by an overlay
+        rvec, tvec = cv2.solvePnPRefineLM(
+            model_metric_lms,
+            model_img_lms,
+            self.camera_matrix,
+            self.dist_coeffs,
+            self.prev_pose[0].copy(),
+            self.prev_pose[1].copy(),
+            criteria=self.warm_criteria,
+        )
+        projected, _ = cv2.projectPoints(
+            model_metric_lms, rvec, tvec, self.camera_matrix, self.dist_coeffs
+        )
+        error = np.sqrt(np.mean(np.sum((projected[:, 0] - model_img_lms) ** 2, axis=1)))
+        # NaN errors fail the check too
+        if not error <= self.max_reprojection_error:
+            return None
+        self.warm_solves += 1
+        return rvec, tvec
+
+    def _estimate_procrustes_pose(self, landmarks):
+        # only the pose transform is needed: no metric landmark is computed
+        _, pose_transform_mat = get_metric_landmarks(
+            landmarks.T, self.pcf, landmark_ids=NO_LANDMARKS
+        )
+        eulers = pose_transforms_to_euler(pose_transform_mat[None])[0]
+        if np.isnan(eulers).any():
+            return None, None, None, None, None
 
-            # cv2.Rodrigues: convert a rotation vector to a rotation matrix (also known as a Rodrigues rotation matrix)
-            rmat, _ = cv2.Rodrigues(rvec1)
+        rotation = pose_transform_mat[:3, :3] / np.linalg.norm(pose_transform_mat[:3, 0])
+        rvec, _ = cv2.Rodrigues(CV_FROM_METRIC @ rotation)
+        tvec = (CV_FROM_METRIC @ pose_transform_mat[:3, 3]).reshape((3, 1))
 
-            eulers = rot_mat_to_euler(rmat).reshape((-1, 1))
+        eulers = eulers.reshape((-1, 1))
+        return rvec, tvec, eulers[0], eulers[1], eulers[2]
 
-            """
-            We use the rotationMatrixToEulerAngles function to compute the euler angles (roll, pitch, yaw) from the
-            Rotation Matrix. This function also checks if we have a gymbal lock.
-            The angles are converted from radians to degrees 
-            
-            An alternative method to compute the euler angles is the following:
-        
-            P = np.hstack((Rmat,tvec)) -> computing the projection matrix
-            euler_angles = -cv2.decomposeProjectionMatrix(P)[6] -> extracting euler angles for yaw pitch and roll from the projection matrix
-            """
+    def get_pose_batch(self, landmarks, frame_size):
+        """
+        Estimate the head pose of T faces at once, e.g. the landmarks of a recorded session.
 
-            self._draw_nose_axes(frame, rvec, tvec, model_img_lms)
+        The rotation comes from the weighted Procrustes alignment of the canonical face model on the metric landmarks
+        (the pose transform of get_metric_landmarks), solved for all the faces with stacked SVDs, instead of a
+        solvePnP per face. The angles follow the get_pose convention.
 
-            return frame, eulers[0], eulers[1], eulers[2]
+        Parameters
+        ----------
+        landmarks: numpy array
+            (T, 478, 3) mediapipe face mesh landmarks
+        frame_size: tuple
+            Width and height of the frames
 
-        else:
-            return None, None, None, None
+        Returns
+        --------
+        eulers: numpy array
+            (T, 3) roll, pitch and yaw in degrees
+        """
+        self._get_camera_parameters(frame_size)
+
+        return pose_transforms_to_euler(get_pose_transform_batch(landmarks, self.pcf))
+
+    def draw_axes(self, frame, rvec, tvec, landmarks, frame_size):
+        """
+        Draw the head pose axis projected from the nose keypoint
+
+        Parameters
+        ----------
+        frame: numpy array
+            Image/frame to draw on (in place)
+        rvec, tvec: numpy array
+            Head pose returned by estimate_pose
+        landmarks: numpy array
+            mediapiep face mesh detected 478 landmarks of the head
+        frame_size: tuple
+            Width and height of the frame
+        """
+        self._get_camera_parameters(frame_size)
+
+        model_img_lms = (
+            np.clip(landmarks[self.model_lms_ids[:1], :2], 0.0, 1.0) * frame_size
+        )
+        self._draw_nose_axes(frame, rvec, tvec, model_img_lms)
 
     def _draw_nose_axes(self, frame, rvec, tvec, model_img_lms):
         (nose_axes_point2D, _) = cv2.projectPoints(
@@ -158,12 +391,24 @@ class HeadPoseEstimator:
         cv2.line(frame, nose, nose_z, (0, 0, 255), 2)
 
     def _get_camera_parameters(self, frame_size):
+        frame_size = (int(frame_size[0]), int(frame_size[1]))
+        if frame_size == self.frame_size:
+            return
+
+        params = self.camera_params.get(frame_size)
+        if params is None:
+            params = self._compute_camera_parameters(frame_size)
+            self.camera_params[frame_size] = params
+        self.camera_matrix, self.dist_coeffs, self.focal_length, self.pcf = params
+        self.frame_size = frame_size
+
+    def _compute_camera_parameters(self, frame_size):
         fr_w = frame_size[0]
         fr_h = frame_size[1]
-        if self.camera_matrix is None:
+        if self.calibration_matrix is None:
             fr_center = (fr_w // 2, fr_h // 2)
             focal_length = fr_w
-            self.camera_matrix = np.array(
+            camera_matrix = np.array(
                 [
                     [focal_length, 0, fr_center[0]],
                     [0, focal_length, fr_center[1]],
@@ -171,12 +416,25 @@ class HeadPoseEstimator:
                 ],
                 dtype="double",
             )
-            self.focal_length = focal_length
         else:
-            self.focal_length = self.camera_matrix[0, 0]
-        if self.dist_coeffs is None:
-            self.dist_coeffs = np.zeros((5, 1))
+            if self.calibration_size is None:
+                self.calibration_size = frame_size
+            # the focal lengths and the principal point scale with the resolution, the distortion coefficients
+            # apply to normalized coordinates and do not change
+            scale = np.array(
+                [
+                    [fr_w / self.calibration_size[0]],
+                    [fr_h / self.calibration_size[1]],
+                    [1.0],
+                ]
+            )
+            camera_matrix = np.asarray(self.calibration_matrix, dtype="double") * scale
+            focal_length = camera_matrix[0, 0]
+        if self.calibration_dist_coeffs is None:
+            dist_coeffs = np.zeros((5, 1))
+        else:
+            dist_coeffs = self.calibration_dist_coeffs
 
-        self.pcf = PCF(frame_height=fr_h, frame_width=fr_w, fy=self.focal_length)
+        pcf = PCF(frame_height=fr_h, frame_width=fr_w, fy=focal_length)
 
-        self.pcf_calculated = True
+        return camera_matrix, dist_coeffs, focal_length, pcf
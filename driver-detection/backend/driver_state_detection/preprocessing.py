@@ -0,0 +1,162 @@
+import sys
+
+import cv2
+import numpy as np
+
+try:
+    from .utils import fit_resolution
+except ImportError:
+    from utils import fit_resolution
+
+
+def _free_refcount():
+    # reference count of a list item referenced only by its list, as seen by sys.getrefcount
+    # (depends on the interpreter: the argument reference may be borrowed)
+    items = [np.empty(0)]
+    return sys.getrefcount(items[0])
+
+
+FREE_REFCOUNT = _free_refcount()
+
+
+class FrameBufferPool:
+    def __init__(self, max_size=4):
+        """
+        Pool of preallocated image buffers of a single shape, reused once nobody else references them.
+
+        Buffers handed out by the pool may be published to other consumers (e.g. frames encoded by other threads
+        after the next frame was captured), so a buffer is only given out again when the pool holds the last
+        reference to it. Views of a buffer keep a reference to it, so they are covered as well.
+        When every buffer is still in use, a new one is allocated until the pool holds max_size buffers,
+        after that the extra buffers are not kept.
+
+        Parameters
+        ----------
+        max_size: int, optional
+            Maximum number of buffers kept by the pool (default is 4)
+
+        Methods
+        ----------
+        - acquire: returns a free buffer of the given shape and dtype
+        - stats: returns allocation counters
+        """
+        self.max_size = max_size
+        self.buffers = []
+        self.shape = None
+        self.dtype = None
+        self.allocations = 0
+        self.reuses = 0
+        self._next = 0
+
+    def acquire(self, shape, dtype=np.uint8):
+        """
+        Returns a buffer of the given shape and dtype that is not referenced outside of the pool.
+        Its content is undefined.
+        """
+        if shape != self.shape or dtype != self.dtype:
+            # resolution changed: the old buffers are released to their last users
+            self.buffers = []
+            self.shape = shape
+            self.dtype = dtype
+
+        n_buffers = len(self.buffers)
+        for offset in range(n_buffers):
+            i = (self._next + offset) % n_buffers
+            if sys.getrefcount(self.buffers[i]) <= FREE_REFCOUNT:
+                self._next = (i + 1) % n_buffers
+                self.reuses += 1
+                buffer = self.buffers[i]
+                buffer.flags.writeable = True
+                return buffer
+
+        self.allocations += 1
+        buffer = np.empty(shape, dtype=dtype)
+        if n_buffers < self.max_size:
+            self.buffers.append(buffer)
+        return buffer
+
+    def stats(self):
+        return {
+            "buffers": len(self.buffers),
+            "allocations": self.allocations,
+            "reuses": self.reuses,
+        }
+
+
+class FramePreprocessor:
+    def __init__(self, flip=False, pool_size=4, inference_size=None):
+        """
+        Prepares a captured BGR frame for the detection pipeline without allocating memory per frame.
+
+        The mirrored color frame, the single channel grayscale frame and its 3 channels version given to the face
+        mesh model are written in place, with OpenCV dst outputs, into reused buffers. The color frame keeps the
+        capture resolution, the grayscale frames have the inference resolution. The grayscale buffers are only
+        used while the frame is analyzed and are reused on every frame, the color frame may be published and comes
+        from a FrameBufferPool.
+
+        Parameters
+        ----------
+        flip: bool, optional
+            If set to True, flips the frame horizontally for a mirror effect (default is False)
+        pool_size: int, optional
+            Maximum number of color frame buffers kept (default is 4)
+        inference_size: tuple, optional
+            (width, height) bounding resolution of the grayscale frames: larger frames are scaled down, keeping
+            their aspect ratio, before the grayscale conversion (default is None: the capture resolution)
+
+        Methods
+        ----------
+        - process: returns the color, grayscale and 3 channels grayscale versions of the frame
+        - stats: returns the color frame pool counters
+        """
+        self.flip = flip
+        self.pool = FrameBufferPool(max_size=pool_size)
+        self.inference_size = inference_size
+        self.small = None
+        self.gray_1ch = None
+        self.gray = None
+
+    def process(self, frame):
+        """
+        Preprocesses a captured frame
+
+        Parameters
+        ----------
+        frame: numpy array
+            BGR frame as read from the camera
+
+        Returns
+        --------
+        frame: numpy array
+            BGR frame, mirrored if flip is set (else the input frame itself), to annotate and publish
+        gray_1ch: numpy array
+            Single channel grayscale frame at the inference resolution, overwritten by the next call
+        gray: numpy array
+            3 channels grayscale frame given to the face mesh model, overwritten by the next call
+        """
+        width, height = fit_resolution(
+            (frame.shape[1], frame.shape[0]), self.inference_size
+        )
+        if self.gray_1ch is None or self.gray_1ch.shape != (height, width):
+            self.gray_1ch = np.empty((height, width), dtype=np.uint8)
+            self.gray = np.empty((height, width, 3), dtype=np.uint8)
+            self.small = None
+
+        if self.flip:
+            frame = cv2.flip(frame, 1, dst=self.pool.acquire(frame.shape, frame.dtype))
+
+        source = frame
+        if frame.shape[:2] != (height, width):
+            # scaling the color frame down first is cheaper than converting it at the capture resolution
+            if self.small is None:
+                self.small = np.empty((height, width, 3), dtype=np.uint8)
+            source = cv2.resize(
+                frame, (width, height), dst=self.small, interpolation=cv2.INTER_LINEAR
+            )
+
+        cv2.cvtColor(source, cv2.COLOR_BGR2GRAY, dst=self.gray_1ch)
+        cv2.cvtColor(self.gray_1ch, cv2.COLOR_GRAY2RGB, dst=self.gray)
+        return frame, self.gray_1ch, self.gray
+
+    def stats(self):
+        return self.pool.stats()
@@ -37,25 +37,52 @@ def resize(frame, scale_percent):
     return resized
 
 
-def get_landmarks(lms):
-    surface = 0
-    for lms0 in lms:
-        landmarks = [np.array([point.x, point.y, point.z]) for point in lms0.landmark]
+def landmarks_to_array(lms):
+    """
+    Converts the mediapipe multi_face_landmarks into a single contiguous array, without allocating
+    a numpy array for each landmark point
+
+    :param lms: mediapipe multi_face_landmarks (list of NormalizedLandmarkList), or list of (n_landmarks, 3)
+        arrays (FaceROIDetector)
+    :return: faces
+        Numpy float32 array of shape (n_faces, n_landmarks, 3) with the x,y,z coordinates of every face
+    """
+    if isinstance(lms[0], np.ndarray):
+        return np.stack(lms).astype(np.float32, copy=False)
+
+    n_faces = len(lms)
+    n_points = len(lms[0].landmark)
+    coords = np.fromiter(
+        (
+            coord
+            for face in lms
+            for point in face.landmark
+            for coord in (point.x, point.y, point.z)
+        ),
+        dtype=np.float32,
+        count=n_faces * n_points * 3,
+    )
+    return coords.reshape(n_faces, n_points, 3)
 
-        landmarks = np.array(landmarks)
 
-        landmarks[landmarks[:, 0] < 0.0, 0] = 0.0
-        landmarks[landmarks[:, 0] > 1.0, 0] = 1.0
-        landmarks[landmarks[:, 1] < 0.0, 1] = 0.0
-        landmarks[landmarks[:, 1] > 1.0, 1] = 1.0
+def get_landmarks(lms):
+    """
+    Gets the landmarks of the biggest face found by the face mesh model, with the x,y coordinates
+    clipped to the [0, 1] normalized frame range
+
+    :param lms: mediapipe multi_face_landmarks (list of NormalizedLandmarkList, see landmarks_to_array)
+    :return: biggest_face
+        Numpy float32 array of shape (n_landmarks, 3) of the face with the biggest bounding box
+    """
+    faces = landmarks_to_array(lms)
+    xy = faces[:, :, :2]
+    np.clip(xy, 0.0, 1.0, out=xy)
 
-        dx = landmarks[:, 0].max() - landmarks[:, 0].min()
-        dy = landmarks[:, 1].max() - landmarks[:, 1].min()
-        new_surface = dx * dy
-        if new_surface > surface:
-            biggest_face = landmarks
+    # the face with the biggest bounding box area is the closest to the camera
+    extent = xy.max(axis=1) - xy.min(axis=1)
+    surfaces = extent[:, 0] * extent[:, 1]
 
-    return biggest_face
+    return faces[np.argmax(surfaces)]
 
 
 def get_face_area(face):
@@ -168,6 +195,45 @@ def rot_mat_to_euler(rmat):
         print("Isn't rotation matrix")
 
 
+def rot_mat_to_euler_batch(rmats):
+    """
+    Vectorized version of rot_mat_to_euler for a stack of rotation matrices: same angles, same gimbal lock handling
+    and same sign adjustments, computed for all the matrices at once.
+
+    Parameters
+    ----------
+    rmats: Rotation matrices as a np.ndarray of shape (T, 3, 3).
+
+    Returns
+    -------
+    Euler angles in degrees as a np.ndarray of shape (T, 3), rounded to two decimal places.
+    The rows of the matrices that are not rotation matrices are NaN.
+
+    """
+    rmats = np.asarray(rmats)
+    r_identity = np.matmul(np.transpose(rmats, (0, 2, 1)), rmats)
+    valid = np.linalg.norm(r_identity - np.identity(3), axis=(1, 2)) < 1e-6
+
+    sy = np.sqrt(rmats[:, 0, 0] ** 2 + rmats[:, 1, 0] ** 2)
+    singular = sy < 1e-6
+
+    # gimbal lock: different formula for x, and z = 0
+    x = np.where(
+        singular,
+        np.arctan2(-rmats[:, 1, 2], rmats[:, 1, 1]),
+        np.arctan2(rmats[:, 2, 1], rmats[:, 2, 2]),
+    )
+    y = np.arctan2(-rmats[:, 2, 0], sy)
+    z = np.where(singular, 0.0, np.arctan2(rmats[:, 1, 0], rmats[:, 0, 0]))
+
+    x = np.where(x > 0, np.pi - x, -(np.pi + x))
+    z = np.where(z > 0, np.pi - z, -(np.pi + z))
+
+    eulers = (np.stack([x, y, z], axis=1) * 180.0 / np.pi).round(2)
+    eulers[~valid] = np.nan
+    return eulers
+
+
 def draw_pose_info(frame, img_point, point_proj, roll=None, pitch=None, yaw=None):
     """
     Draw 3d orthogonal axis given a frame, a point in the frame, the projection point array.
@@ -227,3 +293,36 @@ def draw_pose_info(frame, img_point, point_proj, roll=None, pitch=None, yaw=None
         )
 
     return frame
+
+
+def parse_resolution(value):
+    """
+    Parses a WIDTHxHEIGHT resolution, e.g. 1920x1080
+
+    :param value: str
+    :return: (width, height) tuple of int, raises ValueError if value is not a valid resolution
+    """
+    try:
+        width, height = (int(size) for size in value.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"Invalid resolution {value!r}, expected WIDTHxHEIGHT (e.g. 640x480)")
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Invalid resolution {value!r}, width and height must be positive")
+    return width, height
+
+
+def fit_resolution(frame_size, max_size):
+    """
+    Size of a frame scaled down, keeping its aspect ratio, to fit in max_size (frames are never scaled up)
+
+    :param frame_size: (width, height) of the frame
+    :param max_size: (width, height) bounding resolution, or None
+    :return: (width, height) tuple of int
+    """
+    if max_size is None:
+        return tuple(frame_size)
+    scale = min(max_size[0] / frame_size[0], max_size[1] / frame_size[1], 1.0)
+    return (
+        max(1, int(round(frame_size[0] * scale))),
+        max(1, int(round(frame_size[1] * scale))),
+    )
@@ -0,0 +1,399 @@
+"""
+Detection sessions of the API server: one session per camera source
+
+Every session owns its camera, its face mesh model and estimators, its AttentionScorer state, its capture and
+inference threads, its latest published frame and its encoded frames, so several cabin cameras can be monitored
+at once by the same server. The SessionManager caps the number of sessions.
+
+With inference workers, the face mesh model, estimators and scorer state of every session live in a process of an
+InferenceWorkerPool instead, so that the sessions run on several cores.
+"""
+import asyncio
+import os
+import time
+
+import cv2
+import mediapipe as mp
+
+from driver_state_detection.attention_scorer import AttentionScorer
+from driver_state_detection.eye_detector import EyeDetector
+from driver_state_detection.face_roi import FaceROIDetector
+from driver_state_detection.inference_pool import InferenceWorkerPool
+from driver_state_detection.landmark_tracker import LandmarkTracker, get_tracked_lms_ids
+from driver_state_detection.metrics_history import MetricsHistory
+from driver_state_detection.pipeline import (
+    DEFAULT_METRICS,
+    FrameAnalyzer,
+    OverlayRenderer,
+    ThreadedPipeline,
+)
+from driver_state_detection.pose_estimation import HeadPoseEstimator
+from streaming import EncodedFrameCache
+
+DEFAULT_SESSION_ID = "default"
+# head pose solver of the sessions, "pnp" or "procrustes" (see HeadPoseEstimator), also read by the worker processes
+POSE_MODE = os.environ.get("DRIVER_DETECTION_POSE_MODE", "pnp")
+# "1" warm-starts the pnp head pose of every frame from the pose of the previous one
+TEMPORAL_POSE = os.environ.get("DRIVER_DETECTION_TEMPORAL_POSE", "0") == "1"
+# "1" runs the face mesh model on the region around the face of the previous frame instead of the full frame
+FACE_ROI = os.environ.get("DRIVER_DETECTION_FACE_ROI", "0") == "1"
+# frames kept by the metrics history of every session (one hour at 30 fps, about 3.5 MB)
+HISTORY_FRAMES = int(os.environ.get("DRIVER_DETECTION_HISTORY_FRAMES", "108000"))
+
+
+class SessionLimitError(Exception):
+    """Raised when creating a session would exceed the maximum number of sessions"""
+
+
+class LatestFrame:
+    """
+    Latest-value slot holding the most recent FrameResult published by the frame producer.
+    Consumers never read the camera themselves: they wait for a newer frame id and skip the frames
+    they were too slow to see, so inference runs once per captured frame regardless of the viewers.
+    """
+
+    def __init__(self):
+        self.result = None
+        self._event = asyncio.Event()
+
+    def publish(self, result):
+        """Store the new result and wake up every waiting consumer"""
+        self.result = result
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    def clear(self):
+        """Drop the stored result and wake up the consumers so they can notice the stop"""
+        self.publish(None)
+
+    async def wait_next(self, last_frame_id=None, timeout=1.0):
+        """
+        Wait for a result newer than last_frame_id
+
+        Returns the latest FrameResult, or None if nothing new was published before the timeout
+        """
+        result = self.result
+        if result is not None and result.frame_id != last_frame_id:
+            return result
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        result = self.result
+        if result is not None and result.frame_id != last_frame_id:
+            return result
+        return None
+
+
+def create_analyzer():
+    """
+    Face mesh model, estimators and scorer of a session, with the server thresholds
+    (also called in the inference worker processes)
+    """
+    detector = mp.solutions.face_mesh.FaceMesh(
+        static_image_mode=False,
+        min_detection_confidence=0.5,
+        min_tracking_confidence=0.5,
+        refine_landmarks=True,
+    )
+    if FACE_ROI:
+        detector = FaceROIDetector(detector)
+    scorer = AttentionScorer(
+        t_now=time.perf_counter(),
+        ear_thresh=0.2,
+        gaze_thresh=0.3,
+        ear_time_thresh=2.0,
+        gaze_time_thresh=2.0,
+        roll_thresh=15,
+        pitch_thresh=15,
+        yaw_thresh=15,
+        pose_time_thresh=2.0,
+        perclos_windows=(300, 900),
+        verbose=False,
+    )
+    return FrameAnalyzer(
+        detector=detector,
+        eye_det=EyeDetector(show_processing=False),
+        head_pose=HeadPoseEstimator(
+            show_axis=False, pose_mode=POSE_MODE, temporal=TEMPORAL_POSE
+        ),
+        scorer=scorer,
+    )
+
+
+def parse_source(source):
+    """Camera index if source is a number, else a video file path or stream URL"""
+    if isinstance(source, str) and source.isdigit():
+        return int(source)
+    return source
+
+
+class DetectionSession:
+    def __init__(self, session_id, source=0, encode=None, inference_pool=None):
+        """
+        Detection pipeline of a single camera source and the state shared by its viewers
+
+        Parameters
+        ----------
+        session_id: str
+            Id of the session in the API routes
+        source: int or str, optional
+            Camera index, video file path or stream URL (default is 0)
+        encode: coroutine function
+            Called as encode(frame, quality, scale, stats) to JPEG-encode the published frames, stats being the
+            session encode counters
+        inference_pool: InferenceWorkerPool, optional
+            If given, the frames are analyzed by a worker process of the pool instead of the session inference
+            thread (default is None)
+
+        Methods
+        ----------
+        - start: opens the camera and starts the capture and inference threads
+        - stop: stops the threads and releases the camera (blocking)
+        - publish: publishes a FrameResult to the viewers (on the event loop)
+        - status: returns the latest metrics of the session
+        - pipeline_stats: returns the per-stage, CPU and clients stats of the session
+        - close: stops the session and releases its face mesh model
+        """
+        self.id = session_id
+        self.source = parse_source(source)
+        self.inference_pool = inference_pool
+        # local analyzer, or RemoteAnalyzer of the current run when the frames are analyzed by a worker process
+        self.analyzer = create_analyzer() if inference_pool is None else None
+        self.remote_analyzer = None
+        self.camera = None
+        self.pipeline = None
+        self.is_running = False
+        self.started_at = None
+        self.stopped_at = None
+
+        self.metrics = dict(DEFAULT_METRICS)
+        # per-frame metrics of all the runs of the session, fed by the pipeline
+        self.history = MetricsHistory(capacity=HISTORY_FRAMES)
+        self.latest_frame = LatestFrame()
+        self.encode_stats = {"frames": 0, "busy_time": 0.0, "cpu_time": 0.0}
+        # the overlays are only drawn on the frames that a viewer asks for
+        self.overlay = OverlayRenderer()
+        self.encoded_frames = EncodedFrameCache(
+            lambda frame, quality, scale: encode(frame, quality, scale, self.encode_stats),
+            render=self.overlay.render,
+        )
+        # AdaptiveStreamer of every connected WebSocket client, by client id
+        self.clients = {}
+
+    def start(
+        self,
+        loop,
+        detect_interval=1,
+        source=None,
+        capture_size=None,
+        inference_size=None,
+        display_size=None,
+    ):
+        """
+        Opens the camera and starts the pipeline, the results are published on the given event loop
+
+        detect_interval > 1 runs the face mesh detector every detect_interval frames and tracks
+        the landmarks with optical flow in between
+
+        capture_size is the (width, height) resolution requested from the camera, inference_size and display_size
+        bound the resolution of the frames given to the face mesh model and of the rendered frames (None keeps
+        the resolution of the camera)
+
+        Returns False if the camera cannot be opened
+        """
+        if source is not None:
+            self.source = parse_source(source)
+
+        self.camera = cv2.VideoCapture(self.source)
+        if not self.camera.isOpened():
+            self.camera.release()
+            self.camera = None
+            return False
+        if capture_size is not None:
+            self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, capture_size[0])
+            self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, capture_size[1])
+
+        self.is_running = True
+        self.started_at = time.perf_counter()
+        self.stopped_at = None
+        # the CPU accounting covers the current run, like the pipeline counters
+        self.encode_stats.update(frames=0, busy_time=0.0, cpu_time=0.0)
+        self.overlay = OverlayRenderer(display_size=display_size)
+        self.encoded_frames.render = self.overlay.render
+        # frame ids restart with the new pipeline
+        self.encoded_frames.clear()
+        if self.inference_pool is not None:
+            # the worker process builds the tracker itself
+            self.remote_analyzer = self.inference_pool.attach(detect_interval=detect_interval)
+            analyzer = self.remote_analyzer
+        else:
+            analyzer = self.analyzer
+            if detect_interval > 1:
+                analyzer.tracker = LandmarkTracker(
+                    analyzer.detector,
+                    tracked_ids=get_tracked_lms_ids(analyzer.eye_det, analyzer.head_pose),
+                    detect_interval=detect_interval,
+                )
+            else:
+                analyzer.tracker = None
+        self.pipeline = ThreadedPipeline(
+            camera=self.camera,
+            analyzer=analyzer,
+            on_result=lambda result: loop.call_soon_threadsafe(self.publish, result),
+            inference_size=inference_size,
+            history=self.history,
+        )
+        self.pipeline.start()
+        return True
+
+    def stop(self):
+        """Stops the pipeline threads and releases the camera, blocks until the threads are done"""
+        if self.is_running:
+            self.stopped_at = time.perf_counter()
+        self.is_running = False
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.remote_analyzer is not None:
+            self.remote_analyzer.close()
+        if self.camera is not None:
+            self.camera.release()
+            self.camera = None
+
+    def close(self):
+        self.stop()
+        if self.analyzer is not None:
+            self.analyzer.detector.close()
+
+    def publish(self, result):
+        """Publish a FrameResult coming from the pipeline (runs on the event loop)"""
+        if not self.is_running:
+            return
+        self.metrics.update(result.metrics)
+        self.latest_frame.publish(result)
+
+    def clear(self):
+        """Wake up the viewers after a stop and forget the published frames (runs on the event loop)"""
+        self.latest_frame.clear()
+        self.encoded_frames.clear()
+
+    def cpu_stats(self):
+        """CPU time used by the session threads and its share of a core during the current (or last) run"""
+        pipeline_cpu = self.pipeline.cpu_time() if self.pipeline is not None else 0.0
+        worker_cpu = self.remote_analyzer.cpu_time if self.remote_analyzer is not None else 0.0
+        cpu_time = pipeline_cpu + worker_cpu + self.encode_stats["cpu_time"] + self.overlay.cpu_time
+        elapsed = 0.0
+        if self.started_at is not None:
+            elapsed = (self.stopped_at or time.perf_counter()) - self.started_at
+        return {
+            "cpu_time_s": round(cpu_time, 3),
+            "encode_cpu_time_s": round(self.encode_stats["cpu_time"], 3),
+            "worker_cpu_time_s": round(worker_cpu, 3),
+            "overlay_cpu_time_s": round(self.overlay.cpu_time, 3),
+            "cpu_percent": round(100 * cpu_time / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+    def pipeline_stats(self):
+        stages = self.pipeline.stats() if self.pipeline is not None else {}
+        if self.remote_analyzer is not None and "inference" in stages:
+            stages["inference"]["worker"] = {
+                "id": self.remote_analyzer.worker_id,
+                "tracker": self.remote_analyzer.tracker_stats,
+            }
+        frames = self.encode_stats["frames"]
+        stages["encode"] = {
+            "frames": frames,
+            "avg_time_ms": (self.encode_stats["busy_time"] / frames) * 1000 if frames else None,
+            "cache": self.encoded_frames.stats(),
+        }
+        stages["overlay"] = self.overlay.stats()
+        return {
+            "stages": stages,
+            "cpu": self.cpu_stats(),
+            "clients": [
+                dict(streamer.stats(), id=client_id) for client_id, streamer in self.clients.items()
+            ],
+        }
+
+    def status(self):
+        status = {"is_running": self.is_running}
+        status.update(self.metrics)
+        return status
+
+    def info(self):
+        return {
+            "id": self.id,
+            "source": self.source,
+            "is_running": self.is_running,
+            "clients": len(self.clients),
+            "cpu": self.cpu_stats(),
+            "history": self.history.stats(),
+        }
+
+
+class SessionManager:
+    def __init__(self, encode, max_sessions=4, inference_workers=0):
+        """
+        Registry of the detection sessions
+
+        Parameters
+        ----------
+        encode: coroutine function
+            JPEG encoder given to the sessions, see DetectionSession
+        max_sessions: int, optional
+            Maximum number of sessions that can exist at the same time (default is 4)
+        inference_workers: int, optional
+            Number of inference worker processes shared by the sessions, 0 to analyze the frames in the session
+            threads (default is 0). The workers are started with the first session.
+        """
+        self.encode = encode
+        self.max_sessions = max_sessions
+        self.inference_workers = inference_workers
+        self.inference_pool = None
+        self.sessions = {}
+
+    def get(self, session_id):
+        """Returns the session, None if it does not exist"""
+        return self.sessions.get(session_id)
+
+    def get_or_create(self, session_id, source=0):
+        """Returns the session, creating it if needed. Raises SessionLimitError when the cap is reached"""
+        session = self.sessions.get(session_id)
+        if session is None:
+            if len(self.sessions) >= self.max_sessions:
+                raise SessionLimitError(f"Maximum number of sessions reached ({self.max_sessions})")
+            if self.inference_workers > 0 and self.inference_pool is None:
+                self.inference_pool = InferenceWorkerPool(
+                    create_analyzer, n_workers=self.inference_workers
+                )
+            session = DetectionSession(
+                session_id, source, encode=self.encode, inference_pool=self.inference_pool
+            )
+            self.sessions[session_id] = session
+        return session
+
+    def remove(self, session_id):
+        """Removes the session from the registry and returns it, the caller has to stop it"""
+        return self.sessions.pop(session_id, None)
+
+    def close(self):
+        """Stops all the sessions and the inference workers"""
+        for session in self:
+            session.close()
+        if self.inference_pool is not None:
+            self.inference_pool.close()
+            self.inference_pool = None
+
+    def stats(self):
+        return {
+            "max_sessions": self.max_sessions,
+            "inference_workers": (
+                self.inference_pool.stats()["workers"] if self.inference_pool is not None else []
+            ),
+        }
+
+    def running(self):
+        return [session for session in self.sessions.values() if session.is_running]
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
@@ -0,0 +1,409 @@
+"""
+Wire protocol of the /ws/video WebSocket stream
+
+Binary protocol (default, version 1):
+- on connect the server sends a text hello message:
+    {"type": "hello", "protocol": "binary", "version": 1}
+- every video frame is a binary message: a fixed little-endian header followed by the JPEG bytes
+    version     uint8   protocol version (1)
+    type        uint8   message type (1: JPEG frame)
+    header_size uint16  size of the header in bytes, the JPEG data starts at this offset
+    frame_id    uint64  id of the frame in the capture stream
+    timestamp   float64 capture time of the frame, in seconds of the server monotonic clock
+- metrics are compact text messages holding only the metrics that changed since the previous message:
+    {"type": "metrics", "frame_id": 42, "metrics": {"ear": 0.31, ...}}
+  the first one holds all the metrics. Timing metrics (fps, proc_time) change on every frame, they are sent at
+  most once per TIMING_METRICS_INTERVAL seconds.
+
+Legacy JSON protocol (/ws/video?protocol=json): one text message per frame
+    {"image": "data:image/jpeg;base64,...", "metrics": {...}}
+
+Both protocols are adaptive: every connection has an AdaptiveStreamer that picks the JPEG quality, resolution
+and frame rate of the frames sent to the client from the time their sending takes.
+
+Frames are encoded once per (quality, scale) tier by the EncodedFrameCache, and the same bytes objects are sent
+to every WebSocket and MJPEG client. The overlays are drawn by the cache too, once per frame and only on the frames
+that a client asks for.
+"""
+import asyncio
+import base64
+import json
+import struct
+from functools import cached_property
+from typing import NamedTuple
+
+PROTOCOL_VERSION = 1
+MSG_JPEG_FRAME = 1
+
+# version, message type, header size, frame id, timestamp
+FRAME_HEADER = struct.Struct("<BBHQd")
+
+TIMING_METRICS = ("fps", "proc_time")
+TIMING_METRICS_INTERVAL = 1.0
+
+
+def hello_message():
+    return json.dumps(
+        {"type": "hello", "protocol": "binary", "version": PROTOCOL_VERSION},
+        separators=(",", ":"),
+    )
+
+
+def pack_frame(frame_id, timestamp, jpeg):
+    """Binary frame message: fixed header followed by the JPEG bytes"""
+    header = FRAME_HEADER.pack(
+        PROTOCOL_VERSION, MSG_JPEG_FRAME, FRAME_HEADER.size, frame_id, timestamp
+    )
+    return header + jpeg
+
+
+def unpack_frame(message):
+    """Inverse of pack_frame: returns (frame_id, timestamp, jpeg)"""
+    version, msg_type, header_size, frame_id, timestamp = FRAME_HEADER.unpack_from(message)
+    if version != PROTOCOL_VERSION or msg_type != MSG_JPEG_FRAME:
+        raise ValueError(f"Unsupported frame message: version {version}, type {msg_type}")
+    return frame_id, timestamp, message[header_size:]
+
+
+def legacy_json_message(jpeg, metrics, is_running):
+    """
+    Message of the legacy JSON protocol, the JPEG being embedded as a base64 data URL. The metrics keep the legacy
+    schema, the one of /api/status: is_running followed by the metrics of the frame
+    """
+    return json.dumps(
+        {
+            "image": "data:image/jpeg;base64," + base64.b64encode(jpeg).decode("ascii"),
+            "metrics": {"is_running": is_running, **metrics},
+        }
+    )
+
+
+class MetricsDiffer:
+    def __init__(self, timing_interval=TIMING_METRICS_INTERVAL):
+        """
+        Builds the metrics messages of a single client: only the metrics that changed since the last message
+        are sent, and the timing metrics are throttled to one update every timing_interval seconds.
+        """
+        self.timing_interval = timing_interval
+        self.sent = {}
+        self.last_timing_update = None
+
+    def message(self, frame_id, metrics, t_now):
+        """
+        Returns the JSON metrics message of the frame, None if nothing has to be sent
+
+        Parameters
+        ----------
+        frame_id: int
+            Id of the frame the metrics were computed on
+        metrics: dict
+            All the metrics of the frame
+        t_now: float
+            Current time in seconds, used to throttle the timing metrics
+        """
+        send_timing = (
+            self.last_timing_update is None
+            or t_now - self.last_timing_update >= self.timing_interval
+        )
+        changed = {
+            key: value
+            for key, value in metrics.items()
+            if (send_timing or key not in TIMING_METRICS)
+            and (key not in self.sent or self.sent[key] != value)
+        }
+        if not changed:
+            return None
+
+        if send_timing and any(key in changed for key in TIMING_METRICS):
+            self.last_timing_update = t_now
+        self.sent.update(changed)
+        return json.dumps(
+            {"type": "metrics", "frame_id": frame_id, "metrics": changed},
+            separators=(",", ":"),
+        )
+
+
+class StreamTier(NamedTuple):
+    """Encoding settings of the frames sent to a client"""
+
+    quality: int
+    scale: float
+    max_fps: float
+
+
+# from the best to the cheapest settings
+STREAM_LADDER = (
+    StreamTier(quality=90, scale=1.0, max_fps=60),
+    StreamTier(quality=80, scale=1.0, max_fps=30),
+    StreamTier(quality=70, scale=0.75, max_fps=30),
+    StreamTier(quality=60, scale=0.75, max_fps=20),
+    StreamTier(quality=50, scale=0.5, max_fps=15),
+    StreamTier(quality=40, scale=0.5, max_fps=10),
+    StreamTier(quality=30, scale=0.25, max_fps=5),
+)
+DEFAULT_TIER = 1
+
+
+class AdaptiveStreamer:
+    def __init__(
+        self,
+        target_latency=0.05,
+        ladder=STREAM_LADDER,
+        start_tier=DEFAULT_TIER,
+        smoothing=0.2,
+        downgrade_cooldown=0.5,
+        upgrade_after=2.0,
+    ):
+        """
+        Per-client controller of the video stream quality, driven by backpressure.
+
+        The time a frame takes to be sent (the WebSocket send only completes once the transport buffer has room,
+        so it grows when the client or the network falls behind) is smoothed and compared with target_latency:
+        - above the target, the stream moves one tier down the ladder (lower quality, resolution and frame rate),
+          at most once every downgrade_cooldown seconds
+        - under half the target for upgrade_after seconds, the stream moves one tier up
+
+        Frames are never queued for a client: the stream always takes the latest published frame and the frames
+        published while the previous one was encoded or sent are counted as dropped.
+
+        Parameters
+        ----------
+        target_latency: float, optional
+            Target send time of a frame in seconds (default is 0.05)
+        ladder: tuple of StreamTier, optional
+            Available encoding settings, from the best to the cheapest (default is STREAM_LADDER)
+        start_tier: int, optional
+            Index of the tier used for the first frames (default is DEFAULT_TIER)
+        smoothing: float, optional
+            Weight of the last frame in the exponential moving averages (default is 0.2)
+        downgrade_cooldown: float, optional
+            Minimum time in seconds between a tier change and the next downgrade (default is 0.5)
+        upgrade_after: float, optional
+            Time in seconds the stream must stay fast before moving one tier up (default is 2.0)
+
+        Methods
+        ----------
+        - wait_time: returns how long to wait before sending the next frame, to respect the tier frame rate
+        - on_frame: records a frame to send, counting the frames skipped since the previous one
+        - on_sent: records the timings of a sent frame and adapts the tier
+        - stats: returns the client stream counters
+        """
+        self.target_latency = target_latency
+        self.ladder = ladder
+        self.tier_index = start_tier
+        self.smoothing = smoothing
+        self.downgrade_cooldown = downgrade_cooldown
+        self.upgrade_after = upgrade_after
+
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+        self.tier_changes = 0
+        self.avg_send_time = None
+        self.avg_encode_time = None
+        self.avg_latency = None
+
+        self._last_frame_id = None
+        self._last_sent = None
+        self._last_change = None
+        self._fast_since = None
+
+    @property
+    def tier(self):
+        return self.ladder[self.tier_index]
+
+    def wait_time(self, t_now):
+        if self._last_sent is None:
+            return 0.0
+        return max(0.0, self._last_sent + 1 / self.tier.max_fps - t_now)
+
+    def on_frame(self, frame_id):
+        if self._last_frame_id is not None and frame_id > self._last_frame_id + 1:
+            self.frames_dropped += frame_id - self._last_frame_id - 1
+        self._last_frame_id = frame_id
+
+    def on_sent(self, n_bytes, capture_time, encode_time, send_time, t_now):
+        """
+        Records a sent frame and adapts the tier
+
+        Parameters
+        ----------
+        n_bytes: int
+            Size of the sent message
+        capture_time: float
+            Capture time of the frame, on the same clock as t_now
+        encode_time: float
+            Time spent encoding the frame in seconds
+        send_time: float
+            Time spent sending the frame in seconds
+        t_now: float
+            Current time in seconds
+        """
+        self.frames_sent += 1
+        self.bytes_sent += n_bytes
+        self._last_sent = t_now
+        self.avg_send_time = self._smooth(self.avg_send_time, send_time)
+        self.avg_encode_time = self._smooth(self.avg_encode_time, encode_time)
+        self.avg_latency = self._smooth(self.avg_latency, t_now - capture_time)
+
+        if self.avg_send_time > self.target_latency:
+            self._fast_since = None
+            can_change = (
+                self._last_change is None
+                or t_now - self._last_change >= self.downgrade_cooldown
+            )
+            if can_change and self.tier_index < len(self.ladder) - 1:
+                self._set_tier(self.tier_index + 1, t_now)
+        elif self.avg_send_time < self.target_latency / 2:
+            if self._fast_since is None:
+                self._fast_since = t_now
+            elif t_now - self._fast_since >= self.upgrade_after and self.tier_index > 0:
+                self._set_tier(self.tier_index - 1, t_now)
+        else:
+            self._fast_since = None
+
+    def _set_tier(self, tier_index, t_now):
+        self.tier_index = tier_index
+        self.tier_changes += 1
+        self._last_change = t_now
+        self._fast_since = None
+        # the average refers to the previous settings: restart from the next frame
+        self.avg_send_time = None
+
+    def _smooth(self, average, value):
+        if average is None:
+            return value
+        return (1 - self.smoothing) * average + self.smoothing * value
+
+    def stats(self):
+        def to_ms(value):
+            return round(value * 1000, 3) if value is not None else None
+
+        return {
+            "tier": self.tier._asdict(),
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+            "bytes_sent": self.bytes_sent,
+            "tier_changes": self.tier_changes,
+            "avg_send_ms": to_ms(self.avg_send_time),
+            "avg_encode_ms": to_ms(self.avg_encode_time),
+            "avg_latency_ms": to_ms(self.avg_latency),
+            "target_latency_ms": to_ms(self.target_latency),
+        }
+
+
+class EncodedFrame:
+    def __init__(self, result, jpeg):
+        """
+        JPEG encoding of a published frame at one tier, shared by all the clients of that tier.
+        The messages built from it are computed on first use and then reused by the other clients.
+        """
+        self.frame_id = result.frame_id
+        self.timestamp = result.timestamp
+        self.metrics = result.metrics
+        self.jpeg = jpeg
+        # legacy JSON messages by is_running state
+        self._json_messages = {}
+
+    @cached_property
+    def binary_message(self):
+        return pack_frame(self.frame_id, self.timestamp, self.jpeg)
+
+    def json_message(self, is_running):
+        message = self._json_messages.get(is_running)
+        if message is None:
+            message = legacy_json_message(self.jpeg, self.metrics, is_running)
+            self._json_messages[is_running] = message
+        return message
+
+    @cached_property
+    def mjpeg_part(self):
+        return b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + self.jpeg + b"\r\n"
+
+
+class EncodedFrameCache:
+    def __init__(self, encode, render=None, max_frames=2):
+        """
+        Encode-once cache of the published frames, so that the encoding cost does not grow with the number
+        of viewers: the first client asking for a frame at a given quality and scale starts the encoding,
+        the other clients of the same tier wait for it and get the same EncodedFrame.
+
+        Parameters
+        ----------
+        encode: coroutine function
+            Called as encode(frame, quality, scale) to get the JPEG bytes of a frame
+        render: callable, optional
+            Called as render(result) to get the frame to encode with its overlays (e.g. OverlayRenderer.render).
+            It runs on the default executor, once per frame id whatever the number of tiers (default is None:
+            the frame is encoded as published)
+        max_frames: int, optional
+            Number of most recent frame ids whose encodings are kept (default is 2)
+
+        Methods
+        ----------
+        - get: returns the EncodedFrame of a FrameResult at a quality and scale
+        - clear: forgets all the encodings, to call when the frame ids restart
+        - stats: returns the encodings, renders and hits counters
+        """
+        self.encode = encode
+        self.render = render
+        self.max_frames = max_frames
+        self.entries = {}
+        # rendered frame futures, by frame id
+        self.rendered = {}
+        self.encodes = 0
+        self.renders = 0
+        self.hits = 0
+
+    async def get(self, result, quality, scale=1.0):
+        key = (result.frame_id, quality, scale)
+        future = self.entries.get(key)
+        if future is None:
+            self.encodes += 1
+            future = asyncio.ensure_future(self._encode(result, quality, scale))
+            self.entries[key] = future
+            self._evict(result.frame_id)
+        else:
+            self.hits += 1
+        # a client disconnecting must not cancel an encoding shared with the others
+        return await asyncio.shield(future)
+
+    async def _encode(self, result, quality, scale):
+        try:
+            frame = result.frame
+            if self.render is not None:
+                frame = await self._rendered_frame(result)
+            jpeg = await self.encode(frame, quality, scale)
+        except Exception:
+            # let the next client retry
+            self.entries.pop((result.frame_id, quality, scale), None)
+            self.rendered.pop(result.frame_id, None)
+            raise
+        return EncodedFrame(result, jpeg)
+
+    def _rendered_frame(self, result):
+        future = self.rendered.get(result.frame_id)
+        if future is None:
+            self.renders += 1
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(None, self.render, result)
+            self.rendered[result.frame_id] = future
+        return future
+
+    def _evict(self, frame_id):
+        for key in [key for key in self.entries if key[0] <= frame_id - self.max_frames]:
+            del self.entries[key]
+        for key in [key for key in self.rendered if key <= frame_id - self.max_frames]:
+            del self.rendered[key]
+
+    def clear(self):
+        self.entries = {}
+        self.rendered = {}
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "encodes": self.encodes,
+            "renders": self.renders,
+            "hits": self.hits,
+        }
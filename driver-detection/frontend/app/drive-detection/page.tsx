@@ -46,20 +46,29 @@ export default function DriveDetection() {
         throw new Error("Failed to start backend detection");
       }
       
-      // Connect to WebSocket for video stream
+      // Connect to WebSocket for video stream (binary protocol, see backend/streaming.py)
       const ws = new WebSocket('ws://localhost:8001/ws/video');
+      ws.binaryType = "arraybuffer";
       
       ws.onmessage = (event) => {
-        const data = JSON.parse(event.data);
-        
-        // Update image frame
-        if (data.image) {
-          setImageSrc(data.image);
+        // Update image frame: fixed header followed by the JPEG bytes
+        if (event.data instanceof ArrayBuffer) {
+          const headerSize = new DataView(event.data).getUint16(2, true);
+          const jpeg = new Blob([event.data.slice(headerSize)], { type: "image/jpeg" });
+          const url = URL.createObjectURL(jpeg);
+          setImageSrc((previous) => {
+            if (previous) {
+              URL.revokeObjectURL(previous);
+            }
+            return url;
+          });
+          return;
         }
-        
-        // Update metrics
-        if (data.metrics) {
-          setMetrics(data.metrics);
+
+        // Update metrics: only the changed ones are sent
+        const data = JSON.parse(event.data);
+        if (data.type === "metrics") {
+          setMetrics((previous) => ({ ...previous, ...data.metrics }) as DetectionMetrics);
         }
       };
       